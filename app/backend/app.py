@@ -1,36 +1,27 @@
+import asyncio
 import dataclasses
 import io
 import json
 import logging
+import math
 import mimetypes
 import os
 import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Union, cast
-
-from azure.cognitiveservices.speech import (
-    ResultReason,
-    SpeechConfig,
-    SpeechSynthesisOutputFormat,
-    SpeechSynthesisResult,
-    SpeechSynthesizer,
-)
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Dict, Optional, Union, cast
+from urllib.parse import urlparse
+
 from azure.core.exceptions import ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
-from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.storage.blob.aio import ContainerClient
 from azure.storage.blob.aio import StorageStreamDownloader as BlobDownloader
-from azure.storage.filedatalake.aio import FileSystemClient
+from azure.storage.filedatalake.aio import DataLakeFileClient, FileSystemClient
 from azure.storage.filedatalake.aio import StorageStreamDownloader as DatalakeDownloader
 from openai import AsyncAzureOpenAI, AsyncOpenAI
-from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
-from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
-from opentelemetry.instrumentation.httpx import (
-    HTTPXClientInstrumentor,
-)
-from opentelemetry.instrumentation.openai import OpenAIInstrumentor
+from openai_messages_token_helper import get_token_limit
 from quart import (
     Blueprint,
     Quart,
@@ -40,27 +31,33 @@ from quart import (
     make_response,
     request,
     send_file,
-    send_from_directory,
+    websocket,
 )
 from quart_cors import cors
 import requests
 
-from approaches.approach import Approach
+from approaches.approach import Approach, InvalidOverrideError
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
+from approaches.deadline import Deadline
+from approaches.historycompactor import HistoryCompactor
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from config import (
+    CONFIG_ADMISSION_CONTROLLER,
+    CONFIG_ALLOWED_ORIGIN,
     CONFIG_ASK_APPROACH,
     CONFIG_ASK_VISION_APPROACH,
     CONFIG_AUTH_CLIENT,
     CONFIG_BLOB_CONTAINER_CLIENT,
     CONFIG_CHAT_APPROACH,
     CONFIG_CHAT_VISION_APPROACH,
+    CONFIG_CONVERSATION_STORE,
     CONFIG_CREDENTIAL,
     CONFIG_GPT4V_DEPLOYED,
     CONFIG_INGESTER,
     CONFIG_OPENAI_CLIENT,
+    CONFIG_REQUEST_DEADLINE,
     CONFIG_SEARCH_CLIENT,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
     CONFIG_SPEECH_INPUT_ENABLED,
@@ -70,23 +67,40 @@ from config import (
     CONFIG_SPEECH_SERVICE_LOCATION,
     CONFIG_SPEECH_SERVICE_TOKEN,
     CONFIG_SPEECH_SERVICE_VOICE,
+    CONFIG_STARTUP_TIMINGS,
+    CONFIG_UPLOAD_QUEUE,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
-from core.authentication import AuthenticationHelper
+from core.admission import AdmissionController, AdmissionRejectedError, AdmissionSlot, Priority
+from core.authentication import AuthenticationHelper, AuthError
+from core.chatsocket import ChatSocket
+from core.conversationstore import (
+    BlobConversationPersistence,
+    Conversation,
+    ConversationNotFoundError,
+    ConversationStore,
+)
+from core.metrics import metrics
+from core.staticfiles import (
+    IMMUTABLE_MAX_AGE,
+    STATIC_MAX_AGE,
+    jsonify_with_etag,
+    send_static,
+)
+from core.uploadstream import is_partial_file, receive_file
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
-from prepdocs import (
-    clean_key_if_exists,
-    setup_embeddings_service,
-    setup_file_processors,
-    setup_search_info,
-)
-from prepdocslib.filestrategy import UploadUserFileStrategy
-from prepdocslib.listfilestrategy import File
+
+if TYPE_CHECKING:
+    # core.uploadqueue imports prepdocslib, which is only imported at runtime when user upload is enabled,
+    # see setup_clients
+    from core.uploadqueue import UploadQueue
 
 bp = Blueprint("routes", __name__, static_folder="static")
+# The frontend build output, see app/frontend/vite.config.ts
+STATIC_FOLDER = Path(__file__).resolve().parent / "static"
 # Fix Windows registry issue with mimetypes
 mimetypes.add_type("application/javascript", ".js")
 mimetypes.add_type("text/css", ".css")
@@ -106,7 +120,7 @@ def verify_recaptcha(recaptcha_token):
 
 @bp.route("/")
 async def index():
-    return await bp.send_static_file("index.html")
+    return await send_static(STATIC_FOLDER, "index.html")
 
 
 # Empty page is recommended for login redirect to work.
@@ -118,27 +132,27 @@ async def redirect():
 
 @bp.route("/favicon.ico")
 async def favicon():
-    return await bp.send_static_file("favicon.ico")
+    return await send_static(STATIC_FOLDER, "favicon.ico", max_age=STATIC_MAX_AGE)
 
 
 @bp.route("/logo.png")
 async def chatlogo():
-    return await bp.send_static_file("logo.png")
+    return await send_static(STATIC_FOLDER, "logo.png", max_age=STATIC_MAX_AGE)
 
 
 @bp.route("/CI_Logo_Powered_green.png")
 async def CI_logo():
-    return await bp.send_static_file("CI_Logo_Powered_green.png")
+    return await send_static(STATIC_FOLDER, "CI_Logo_Powered_green.png", max_age=STATIC_MAX_AGE)
 
 
 @bp.route("/icon.png")
 async def chaticon():
-    return await bp.send_static_file("icon.png")
+    return await send_static(STATIC_FOLDER, "icon.png", max_age=STATIC_MAX_AGE)
 
 
 @bp.route("/assets/<path:path>")
 async def assets(path):
-    return await send_from_directory(Path(__file__).resolve().parent / "static" / "assets", path)
+    return await send_static(STATIC_FOLDER / "assets", path, max_age=IMMUTABLE_MAX_AGE, immutable=True)
 
 
 @bp.route("/content/<path>")
@@ -186,6 +200,24 @@ async def content_file(path: str, auth_claims: Dict[str, Any]):
     return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
 
 
+def request_deadline(context: dict[str, Any]) -> Deadline:
+    """
+    The deadline starts now, so it includes any time spent waiting for admission.
+    The deadline override can shorten the server's deadline, but not lengthen or remove it.
+    """
+    server_seconds = current_app.config[CONFIG_REQUEST_DEADLINE] or None
+    value = context.get("overrides", {}).get("deadline")
+    if value is None:
+        return Deadline(server_seconds)
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise InvalidOverrideError("deadline", value)
+    if not 0 < seconds < math.inf:
+        return Deadline(server_seconds)
+    return Deadline(min(seconds, server_seconds) if server_seconds else seconds)
+
+
 @bp.route("/ask", methods=["POST"])
 @authenticated
 async def ask(auth_claims: Dict[str, Any]):
@@ -195,16 +227,61 @@ async def ask(auth_claims: Dict[str, Any]):
     context = request_json.get("context", {})
     context["auth_claims"] = auth_claims
     try:
+        context["deadline"] = request_deadline(context)
         use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
         approach: Approach
         if use_gpt4v and CONFIG_ASK_VISION_APPROACH in current_app.config:
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
-        r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
-        )
+        admission_controller: AdmissionController = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+        async with admission_controller.admit(Priority.BATCH):
+            r = await approach.run(
+                request_json["messages"], context=context, session_state=request_json.get("session_state")
+            )
         return jsonify(r)
+    except AdmissionRejectedError as error:
+        return admission_rejected_response(error)
+    except InvalidOverrideError as error:
+        return invalid_override_response(error)
+    except Exception as error:
+        return error_response(error, "/ask")
+
+
+@bp.route("/ask/stream", methods=["POST"])
+@authenticated
+async def ask_stream(auth_claims: Dict[str, Any]):
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    context = request_json.get("context", {})
+    context["auth_claims"] = auth_claims
+    try:
+        context["deadline"] = request_deadline(context)
+        use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
+        approach: Approach
+        if use_gpt4v and CONFIG_ASK_VISION_APPROACH in current_app.config:
+            approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
+        else:
+            approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
+        admission_controller: AdmissionController = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+        # Like the first turn of a chat, the user is waiting for the answer to start
+        slot = await admission_controller.slot(Priority.INTERACTIVE)
+        try:
+            result = await approach.run_stream(
+                request_json["messages"], context=context, session_state=request_json.get("session_state")
+            )
+        except BaseException:
+            slot.release()
+            raise
+        response = await make_response(format_as_ndjson(release_when_finished(result, slot)))
+        response.timeout = None  # type: ignore
+        response.mimetype = "application/json-lines"
+        return response
+    except AdmissionRejectedError as error:
+        return admission_rejected_response(error)
+    except InvalidOverrideError as error:
+        return invalid_override_response(error)
     except Exception as error:
         return error_response(error, "/ask")
 
@@ -223,6 +300,86 @@ async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str,
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps(error_dict(error))
+    finally:
+        # When the client disconnects, this stops the approach's upstream calls now, not when it is garbage collected
+        await r.aclose()
+
+
+async def load_conversation(
+    request_json: dict[str, Any], auth_claims: Dict[str, Any]
+) -> tuple[list, Any, Optional[Conversation]]:
+    """
+    With the conversation store enabled, clients only send the new messages, along with the conversation_id
+    from session_state. Returns the whole conversation, the session state and the stored conversation.
+    """
+    messages = request_json["messages"]
+    session_state = request_json.get("session_state")
+    conversation_store: Optional[ConversationStore] = current_app.config[CONFIG_CONVERSATION_STORE]
+    if conversation_store is None or not (session_state is None or isinstance(session_state, dict)):
+        return messages, session_state, None
+    user_id = auth_claims.get("oid", "")
+    conversation_id = (session_state or {}).get("conversation_id")
+    if conversation_id:
+        conversation = await conversation_store.get(conversation_id, user_id)
+        if conversation is None:
+            raise ConversationNotFoundError(conversation_id)
+    else:
+        conversation = conversation_store.create(user_id)
+    return (
+        conversation.messages + messages,
+        {**(session_state or {}), "conversation_id": conversation.id},
+        conversation,
+    )
+
+
+async def save_conversation(
+    conversation_store: ConversationStore, conversation: Conversation, messages: list, answer: Optional[str]
+):
+    conversation_store.add_messages(conversation, messages + [{"role": "assistant", "content": answer or ""}])
+    await conversation_store.save(conversation)
+
+
+async def save_streamed_conversation(
+    r: AsyncGenerator[dict, None], conversation_store: ConversationStore, conversation: Conversation, messages: list
+) -> AsyncGenerator[dict, None]:
+    answer = ""
+    try:
+        async for event in r:
+            answer += (event.get("delta") or {}).get("content") or ""
+            yield event
+    finally:
+        await r.aclose()
+    # Only complete turns are stored
+    await save_conversation(conversation_store, conversation, messages, answer)
+
+
+async def release_when_finished(r: AsyncGenerator[dict, None], slot: AdmissionSlot) -> AsyncGenerator[dict, None]:
+    """
+    Holds the request's admission slot until the answer has been streamed, or the client has disconnected.
+    If the response is abandoned before it starts, this never runs, and the slot is released once it's collected.
+    """
+    try:
+        async for event in r:
+            yield event
+    finally:
+        try:
+            await r.aclose()
+        finally:
+            slot.release()
+
+
+def admission_rejected_response(error: AdmissionRejectedError):
+    return jsonify({"error": str(error)}), 503, {"Retry-After": str(error.retry_after)}
+
+
+def conversation_not_found_response(error: ConversationNotFoundError):
+    logging.info("%s, asking the client for the whole conversation", error)
+    return jsonify({"error": str(error)}), 409
+
+
+def invalid_override_response(error: InvalidOverrideError):
+    logging.info("%s", error)
+    return jsonify({"error": str(error)}), 400
 
 
 @bp.route("/chat", methods=["POST"])
@@ -233,6 +390,14 @@ async def chat(auth_claims: Dict[str, Any]):
     request_json = await request.get_json()
     context = request_json.get("context", {})
     context["auth_claims"] = auth_claims
+    try:
+        context["deadline"] = request_deadline(context)
+        messages, session_state, conversation = await load_conversation(request_json, auth_claims)
+    except ConversationNotFoundError as error:
+        return conversation_not_found_response(error)
+    except InvalidOverrideError as error:
+        return invalid_override_response(error)
+    context["conversation"] = conversation
     try:
         use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
         approach: Approach
@@ -241,12 +406,25 @@ async def chat(auth_claims: Dict[str, Any]):
         else:
             approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
 
-        result = await approach.run(
-            request_json["messages"],
-            context=context,
-            session_state=request_json.get("session_state"),
-        )
+        admission_controller: AdmissionController = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+        async with admission_controller.admit(Priority.BATCH):
+            result = await approach.run(
+                messages,
+                context=context,
+                session_state=session_state,
+            )
+        if conversation:
+            await save_conversation(
+                current_app.config[CONFIG_CONVERSATION_STORE],
+                conversation,
+                request_json["messages"],
+                result["message"]["content"],
+            )
         return jsonify(result)
+    except AdmissionRejectedError as error:
+        return admission_rejected_response(error)
+    except InvalidOverrideError as error:
+        return invalid_override_response(error)
     except Exception as error:
         return error_response(error, "/chat")
 
@@ -259,6 +437,15 @@ async def chat_stream(auth_claims: Dict[str, Any]):
     request_json = await request.get_json()
     context = request_json.get("context", {})
     context["auth_claims"] = auth_claims
+    # Checked before reCAPTCHA, so that the client can retry with the same token
+    try:
+        context["deadline"] = request_deadline(context)
+        messages, session_state, conversation = await load_conversation(request_json, auth_claims)
+    except ConversationNotFoundError as error:
+        return conversation_not_found_response(error)
+    except InvalidOverrideError as error:
+        return invalid_override_response(error)
+    context["conversation"] = conversation
 
     recaptcha_token = request_json.get("recaptcha_token")
 
@@ -271,36 +458,148 @@ async def chat_stream(auth_claims: Dict[str, Any]):
         return jsonify({"error": "Invalid reCAPTCHA token"}), 400
 
     try:
-        use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
-        approach: Approach
-        if use_gpt4v and CONFIG_CHAT_VISION_APPROACH in current_app.config:
-            approach = cast(Approach, current_app.config[CONFIG_CHAT_VISION_APPROACH])
-        else:
-            approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
-
-        result = await approach.run_stream(
-            request_json["messages"],
-            context=context,
-            session_state=request_json.get("session_state"),
-        )
+        result = await start_chat_stream(request_json, context, messages, session_state)
         response = await make_response(format_as_ndjson(result))
         response.timeout = None  # type: ignore
         response.mimetype = "application/json-lines"
         return response
+    except AdmissionRejectedError as error:
+        return admission_rejected_response(error)
+    except InvalidOverrideError as error:
+        return invalid_override_response(error)
     except Exception as error:
         return error_response(error, "/chat")
 
 
+async def start_chat_stream(
+    request_json: dict[str, Any], context: dict[str, Any], messages: list, session_state: Any
+) -> AsyncGenerator[dict, None]:
+    """Starts streaming the answer to a chat turn, which holds an admission slot until it's done"""
+    use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
+    approach: Approach
+    if use_gpt4v and CONFIG_CHAT_VISION_APPROACH in current_app.config:
+        approach = cast(Approach, current_app.config[CONFIG_CHAT_VISION_APPROACH])
+    else:
+        approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
+
+    admission_controller: AdmissionController = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+    # The user is waiting for the first answer of a new chat, so it goes ahead of later turns and batch requests
+    slot = await admission_controller.slot(Priority.INTERACTIVE if len(messages) == 1 else Priority.CHAT)
+    try:
+        result = await approach.run_stream(
+            messages,
+            context=context,
+            session_state=session_state,
+        )
+    except BaseException:
+        slot.release()
+        raise
+    conversation = context.get("conversation")
+    if conversation:
+        # The response is streamed outside of the app context
+        result = save_streamed_conversation(
+            result, current_app.config[CONFIG_CONVERSATION_STORE], conversation, request_json["messages"]
+        )
+    return release_when_finished(result, slot)
+
+
+# The subprotocol that a websocket client requests along with its access token, see websocket_access_token
+WEBSOCKET_TOKEN_PROTOCOL = "bearer"
+
+
+@bp.websocket("/chat/ws")
+async def chat_socket():
+    """
+    A persistent alternative to /chat/stream, which authenticates the user and checks reCAPTCHA once per connection,
+    and then streams the answers to any number of turns. See ChatSocket for the messages.
+    """
+    if not is_allowed_websocket_origin():
+        abort(403)
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    headers = dict(websocket.headers)
+    if access_token := websocket_access_token():
+        headers["Authorization"] = f"Bearer {access_token}"
+    try:
+        auth_claims = await auth_helper.get_auth_claims_if_enabled(headers)
+    except AuthError:
+        abort(403)
+    # The claims are only valid for as long as the token they came from
+    expires_at = AuthenticationHelper.get_token_expiry(access_token) if auth_claims and access_token else None
+
+    recaptcha_token = websocket.args.get("recaptcha_token")
+    if not recaptcha_token:
+        return jsonify({"error": "reCAPTCHA token is missing"}), 400
+    if not verify_recaptcha(recaptcha_token):
+        return jsonify({"error": "Invalid reCAPTCHA token"}), 400
+
+    async def start_turn(request_json: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        # The claims of the connection are reused, so turns don't validate the token again
+        context = request_json.get("context", {})
+        context["auth_claims"] = auth_claims
+        context["deadline"] = request_deadline(context)
+        messages, session_state, conversation = await load_conversation(request_json, auth_claims)
+        context["conversation"] = conversation
+        return await start_chat_stream(request_json, context, messages, session_state)
+
+    async def send(event: dict[str, Any]):
+        await websocket.send(json.dumps(event, ensure_ascii=False, cls=JSONEncoder))
+
+    await websocket.accept(subprotocol=WEBSOCKET_TOKEN_PROTOCOL if access_token else None)
+    serving = ChatSocket(websocket.receive, send, start_turn, socket_error_event).serve()
+    if expires_at is None:
+        await serving
+        return
+    try:
+        await asyncio.wait_for(serving, timeout=max(0, expires_at - time.time()))
+    except asyncio.TimeoutError:
+        # The client reconnects with a new token to carry on
+        await websocket.close(1008, "The access token has expired")
+
+
+def websocket_access_token() -> Optional[str]:
+    """
+    Browsers can't set the headers of a websocket, so they send the access token as the second of the subprotocols
+    [WEBSOCKET_TOKEN_PROTOCOL, token], which unlike a query parameter doesn't end up in the logs of the proxies
+    """
+    protocols = websocket.requested_subprotocols
+    if len(protocols) == 2 and protocols[0] == WEBSOCKET_TOKEN_PROTOCOL:
+        return protocols[1]
+    return None
+
+
+def is_allowed_websocket_origin() -> bool:
+    """
+    Websockets aren't subject to the same-origin policy, so a page on any other site could open one.
+    Browsers send the page's origin, which has to be this app or ALLOWED_ORIGIN. Other clients don't send one.
+    """
+    origin = websocket.origin
+    if not origin:
+        return True
+    return urlparse(origin).netloc == websocket.host or origin == current_app.config[CONFIG_ALLOWED_ORIGIN]
+
+
+def socket_error_event(error: Exception) -> dict[str, Any]:
+    """The websocket equivalent of the error responses of /chat/stream, with the status code they would have"""
+    if isinstance(error, ConversationNotFoundError):
+        return {"error": str(error), "status": 409}
+    if isinstance(error, AdmissionRejectedError):
+        return {"error": str(error), "status": 503, "retry_after": error.retry_after}
+    if isinstance(error, InvalidOverrideError):
+        return {"error": str(error), "status": 400}
+    logging.exception("Exception in /chat/ws: %s", error)
+    return error_dict(error)
+
+
 # Send MSAL.js settings to the client UI
 @bp.route("/auth_setup", methods=["GET"])
-def auth_setup():
+async def auth_setup():
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
-    return jsonify(auth_helper.get_auth_setup_for_client())
+    return await jsonify_with_etag(auth_helper.get_auth_setup_for_client())
 
 
 @bp.route("/config", methods=["GET"])
-def config():
-    return jsonify(
+async def config():
+    return await jsonify_with_etag(
         {
             "showGPT4VOptions": current_app.config[CONFIG_GPT4V_DEPLOYED],
             "showSemanticRankerOption": current_app.config[CONFIG_SEMANTIC_RANKER_DEPLOYED],
@@ -328,6 +627,15 @@ async def speech():
     request_json = await request.get_json()
     text = request_json["text"]
     try:
+        # The Speech SDK loads a native library, so only import it once speech output is actually used
+        from azure.cognitiveservices.speech import (
+            ResultReason,
+            SpeechConfig,
+            SpeechSynthesisOutputFormat,
+            SpeechSynthesisResult,
+            SpeechSynthesizer,
+        )
+
         # Construct a token as described in documentation:
         # https://learn.microsoft.com/azure/ai-services/speech-service/how-to-configure-azure-ad-auth?pivots=programming-language-python
         auth_token = (
@@ -360,30 +668,69 @@ async def speech():
 @bp.post("/upload")
 @authenticated
 async def upload(auth_claims: dict[str, Any]):
-    request_files = await request.files
-    if "file" not in request_files:
-        # If no files were included in the request, return an error response
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
         return jsonify({"message": "No file part in the request", "status": "failed"}), 400
 
     user_oid = auth_claims["oid"]
-    file = request_files.getlist("file")[0]
+    upload_queue: UploadQueue = current_app.config[CONFIG_UPLOAD_QUEUE]
+    if upload_queue.queue.full():
+        return upload_queue_full_response()
     user_blob_container_client: FileSystemClient = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
-    user_directory_client = user_blob_container_client.get_directory_client(user_oid)
+
+    async def get_file_client(filename: str) -> DataLakeFileClient:
+        user_directory_client = user_blob_container_client.get_directory_client(user_oid)
+        try:
+            await user_directory_client.get_directory_properties()
+        except ResourceNotFoundError:
+            current_app.logger.info("Creating directory for user %s", user_oid)
+            await user_directory_client.create_directory()
+        await user_directory_client.set_access_control(owner=user_oid)
+        return user_directory_client.get_file_client(filename)
+
+    # The file is written to the data lake block by block as the request body arrives, instead of being
+    # buffered whole by the form parser first
+    received = await receive_file(
+        request.body, boundary.encode(), "file", get_file_client, metadata={"UploadedBy": user_oid}
+    )
+    if received is None:
+        return jsonify({"message": "No file part in the request", "status": "failed"}), 400
+    from core.uploadqueue import UploadJob
+    from prepdocslib.listfilestrategy import File
+
+    async def open_file() -> File:
+        # Each attempt reads the local copy, which is removed once the job is finished
+        return File(
+            content=open(received.path, "rb"),
+            acls={"oids": [user_oid]},
+            url=received.url,
+            content_hash=received.content_hash,
+        )
+
+    # The file is parsed, split, embedded and indexed in the background, see /upload/status for its progress
     try:
-        await user_directory_client.get_directory_properties()
-    except ResourceNotFoundError:
-        current_app.logger.info("Creating directory for user %s", user_oid)
-        await user_directory_client.create_directory()
-    await user_directory_client.set_access_control(owner=user_oid)
-    file_client = user_directory_client.get_file_client(file.filename)
-    file_io = file
-    file_io.name = file.filename
-    file_io = io.BufferedReader(file_io)
-    await file_client.upload_data(file_io, overwrite=True, metadata={"UploadedBy": user_oid})
-    file_io.seek(0)
-    ingester: UploadUserFileStrategy = current_app.config[CONFIG_INGESTER]
-    await ingester.add_file(File(content=file_io, acls={"oids": [user_oid]}, url=file_client.url))
-    return jsonify({"message": "File uploaded successfully"}), 200
+        upload_queue.submit(
+            UploadJob(user_oid=user_oid, filename=received.filename, open_file=open_file, close=received.remove)
+        )
+    except asyncio.QueueFull:
+        received.remove()
+        return upload_queue_full_response()
+    return jsonify({"message": "File uploaded successfully", "status": "queued"}), 202
+
+
+def upload_queue_full_response():
+    return (
+        jsonify({"message": "Too many files are waiting to be processed, please try again later", "status": "failed"}),
+        503,
+    )
+
+
+@bp.get("/upload/status")
+@authenticated
+async def upload_status(auth_claims: dict[str, Any]):
+    # Only the uploads received by this worker process, see UploadQueue
+    upload_queue: UploadQueue = current_app.config[CONFIG_UPLOAD_QUEUE]
+    return jsonify([job.serialize() for job in upload_queue.get_jobs(auth_claims["oid"])]), 200
 
 
 @bp.post("/delete_uploaded")
@@ -396,6 +743,8 @@ async def delete_uploaded(auth_claims: dict[str, Any]):
     user_directory_client = user_blob_container_client.get_directory_client(user_oid)
     file_client = user_directory_client.get_file_client(filename)
     await file_client.delete_file()
+    # An ingestion already in progress is stopped before the file's sections are removed, so it can't add them back
+    await current_app.config[CONFIG_UPLOAD_QUEUE].cancel(user_oid, filename)
     ingester = current_app.config[CONFIG_INGESTER]
     await ingester.remove_file(filename, user_oid)
     return jsonify({"message": f"File {filename} deleted successfully"}), 200
@@ -410,20 +759,67 @@ async def list_uploaded(auth_claims: dict[str, Any]):
     try:
         all_paths = user_blob_container_client.get_paths(path=user_oid)
         async for path in all_paths:
-            files.append(path.name.split("/", 1)[1])
+            filename = path.name.split("/", 1)[1]
+            # Files that are still being uploaded aren't listed until they are complete
+            if not is_partial_file(filename):
+                files.append(filename)
     except ResourceNotFoundError as error:
         if error.status_code != 404:
             current_app.logger.exception("Error listing uploaded files", error)
+    # Include the files that are still waiting to be ingested
+    upload_queue: UploadQueue = current_app.config[CONFIG_UPLOAD_QUEUE]
+    files.extend(job.filename for job in upload_queue.get_jobs(user_oid) if job.filename not in files)
     return jsonify(files), 200
 
 
+@contextmanager
+def startup_phase(name: str):
+    """Records how long a phase of setup_clients takes, so slow worker start-up can be diagnosed"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        current_app.config[CONFIG_STARTUP_TIMINGS][name] = elapsed
+        current_app.logger.info("Startup phase '%s' took %.3fs", name, elapsed)
+
+
+def load_ingestion_dependencies():
+    """Imports the ingestion library and loads the tokenizer used by its text splitter"""
+    import prepdocs  # noqa: F401
+    from prepdocslib.textsplitter import get_bpe
+
+    get_bpe()
+
+
+def preload_shared_state():
+    """
+    Loads the large, read-only state (modules and tokenizers) that every worker needs.
+    When gunicorn runs with preload_app, this is called once in the master process,
+    so that the forked workers share the memory copy-on-write instead of each loading their own copy.
+    Network clients are not created here, as they can't be shared across a fork: setup_clients creates them per worker.
+    """
+    from openai_messages_token_helper.model_helper import encoding_for_model
+
+    for model in (os.getenv("AZURE_OPENAI_CHATGPT_MODEL"), os.getenv("AZURE_OPENAI_GPT4V_MODEL")):
+        if model:
+            encoding_for_model(model, default_to_cl100k=True)
+    if os.getenv("USE_USER_UPLOAD", "").lower() == "true":
+        load_ingestion_dependencies()
+
+
 @bp.before_app_serving
 async def setup_clients():
+    current_app.config[CONFIG_STARTUP_TIMINGS] = {}
+    setup_start = time.perf_counter()
+
     # Replace these with your own values, either in environment variables or directly here
     AZURE_STORAGE_ACCOUNT = os.environ["AZURE_STORAGE_ACCOUNT"]
     AZURE_STORAGE_CONTAINER = os.environ["AZURE_STORAGE_CONTAINER"]
     AZURE_USERSTORAGE_ACCOUNT = os.environ.get("AZURE_USERSTORAGE_ACCOUNT")
     AZURE_USERSTORAGE_CONTAINER = os.environ.get("AZURE_USERSTORAGE_CONTAINER")
+    # Optional container in AZURE_STORAGE_ACCOUNT that shares conversations between worker processes and app instances
+    AZURE_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_CONVERSATIONS_CONTAINER")
     AZURE_SEARCH_SERVICE = os.environ["AZURE_SEARCH_SERVICE"]
     AZURE_SEARCH_INDEX = os.environ["AZURE_SEARCH_INDEX"]
     # Shared by all OpenAI deployments
@@ -439,6 +835,13 @@ async def setup_clients():
         os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT") if OPENAI_HOST.startswith("azure") else None
     )
     AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST.startswith("azure") else None
+    # Used to summarise long chat histories, defaults to the chat model
+    OPENAI_SUMMARY_MODEL = os.getenv("AZURE_OPENAI_SUMMARY_MODEL", OPENAI_CHATGPT_MODEL)
+    AZURE_OPENAI_SUMMARY_DEPLOYMENT = (
+        os.getenv("AZURE_OPENAI_SUMMARY_DEPLOYMENT", AZURE_OPENAI_CHATGPT_DEPLOYMENT)
+        if OPENAI_HOST.startswith("azure")
+        else None
+    )
     AZURE_OPENAI_CUSTOM_URL = os.getenv("AZURE_OPENAI_CUSTOM_URL")
     AZURE_VISION_ENDPOINT = os.getenv("AZURE_VISION_ENDPOINT", "")
     # Used only with non-Azure OpenAI deployments
@@ -471,201 +874,246 @@ async def setup_clients():
     USE_SPEECH_INPUT_BROWSER = os.getenv("USE_SPEECH_INPUT_BROWSER", "").lower() == "true"
     USE_SPEECH_OUTPUT_BROWSER = os.getenv("USE_SPEECH_OUTPUT_BROWSER", "").lower() == "true"
     USE_SPEECH_OUTPUT_AZURE = os.getenv("USE_SPEECH_OUTPUT_AZURE", "").lower() == "true"
-
-    # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
-    # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
-    # keys for each service
-    # If you encounter a blocking error during a DefaultAzureCredential resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
-    azure_credential = DefaultAzureCredential(exclude_shared_token_cache_credential=True)
-
-    # Set up clients for AI Search and Storage
-    search_client = SearchClient(
-        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-        index_name=AZURE_SEARCH_INDEX,
-        credential=azure_credential,
-    )
-
-    blob_container_client = ContainerClient(
-        f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", AZURE_STORAGE_CONTAINER, credential=azure_credential
-    )
-
-    # Set up authentication helper
-    search_index = None
-    if AZURE_USE_AUTHENTICATION:
-        current_app.logger.info("AZURE_USE_AUTHENTICATION is true, setting up search index client")
-        search_index_client = SearchIndexClient(
+    USE_CHAT_HISTORY_SUMMARY = os.getenv("USE_CHAT_HISTORY_SUMMARY", "").lower() == "true"
+    USE_CONVERSATION_STORE = os.getenv("USE_CONVERSATION_STORE", "").lower() == "true"
+
+    with startup_phase("clients"):
+        # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
+        # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
+        # keys for each service
+        # If you encounter a blocking error during a DefaultAzureCredential resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
+        azure_credential = DefaultAzureCredential(exclude_shared_token_cache_credential=True)
+
+        # Set up clients for AI Search and Storage
+        search_client = SearchClient(
             endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+            index_name=AZURE_SEARCH_INDEX,
             credential=azure_credential,
         )
-        search_index = await search_index_client.get_index(AZURE_SEARCH_INDEX)
-        await search_index_client.close()
-    auth_helper = AuthenticationHelper(
-        search_index=search_index,
-        use_authentication=AZURE_USE_AUTHENTICATION,
-        server_app_id=AZURE_SERVER_APP_ID,
-        server_app_secret=AZURE_SERVER_APP_SECRET,
-        client_app_id=AZURE_CLIENT_APP_ID,
-        tenant_id=AZURE_AUTH_TENANT_ID,
-        require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
-        enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
-        enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
-    )
 
-    if USE_USER_UPLOAD:
-        current_app.logger.info("USE_USER_UPLOAD is true, setting up user upload feature")
-        if not AZURE_USERSTORAGE_ACCOUNT or not AZURE_USERSTORAGE_CONTAINER:
-            raise ValueError(
-                "AZURE_USERSTORAGE_ACCOUNT and AZURE_USERSTORAGE_CONTAINER must be set when USE_USER_UPLOAD is true"
-            )
-        user_blob_container_client = FileSystemClient(
-            f"https://{AZURE_USERSTORAGE_ACCOUNT}.dfs.core.windows.net",
-            AZURE_USERSTORAGE_CONTAINER,
+        blob_container_client = ContainerClient(
+            f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+            AZURE_STORAGE_CONTAINER,
             credential=azure_credential,
         )
-        current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT] = user_blob_container_client
-
-        # Set up ingester
-        file_processors = setup_file_processors(
-            azure_credential=azure_credential,
-            document_intelligence_service=os.getenv("AZURE_DOCUMENTINTELLIGENCE_SERVICE"),
-            local_pdf_parser=os.getenv("USE_LOCAL_PDF_PARSER", "").lower() == "true",
-            local_html_parser=os.getenv("USE_LOCAL_HTML_PARSER", "").lower() == "true",
-            search_images=USE_GPT4V,
-        )
-        search_info = await setup_search_info(
-            search_service=AZURE_SEARCH_SERVICE, index_name=AZURE_SEARCH_INDEX, azure_credential=azure_credential
-        )
-        text_embeddings_service = setup_embeddings_service(
-            azure_credential=azure_credential,
-            openai_host=OPENAI_HOST,
-            openai_model_name=OPENAI_EMB_MODEL,
-            openai_service=AZURE_OPENAI_SERVICE,
-            openai_custom_url=AZURE_OPENAI_CUSTOM_URL,
-            openai_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
-            openai_dimensions=OPENAI_EMB_DIMENSIONS,
-            openai_key=clean_key_if_exists(OPENAI_API_KEY),
-            openai_org=OPENAI_ORGANIZATION,
-            disable_vectors=os.getenv("USE_VECTORS", "").lower() == "false",
-        )
-        ingester = UploadUserFileStrategy(
-            search_info=search_info, embeddings=text_embeddings_service, file_processors=file_processors
-        )
-        current_app.config[CONFIG_INGESTER] = ingester
-
-    # Used by the OpenAI SDK
-    openai_client: AsyncOpenAI
-
-    if USE_SPEECH_OUTPUT_AZURE:
-        current_app.logger.info("USE_SPEECH_OUTPUT_AZURE is true, setting up Azure speech service")
-        if not AZURE_SPEECH_SERVICE_ID or AZURE_SPEECH_SERVICE_ID == "":
-            raise ValueError("Azure speech resource not configured correctly, missing AZURE_SPEECH_SERVICE_ID")
-        if not AZURE_SPEECH_SERVICE_LOCATION or AZURE_SPEECH_SERVICE_LOCATION == "":
-            raise ValueError("Azure speech resource not configured correctly, missing AZURE_SPEECH_SERVICE_LOCATION")
-        current_app.config[CONFIG_SPEECH_SERVICE_ID] = AZURE_SPEECH_SERVICE_ID
-        current_app.config[CONFIG_SPEECH_SERVICE_LOCATION] = AZURE_SPEECH_SERVICE_LOCATION
-        current_app.config[CONFIG_SPEECH_SERVICE_VOICE] = AZURE_SPEECH_VOICE
-        # Wait until token is needed to fetch for the first time
-        current_app.config[CONFIG_SPEECH_SERVICE_TOKEN] = None
-        current_app.config[CONFIG_CREDENTIAL] = azure_credential
-
-    if OPENAI_HOST.startswith("azure"):
-        api_version = os.getenv("AZURE_OPENAI_API_VERSION") or "2024-03-01-preview"
-        if OPENAI_HOST == "azure_custom":
-            current_app.logger.info("OPENAI_HOST is azure_custom, setting up Azure OpenAI custom client")
-            if not AZURE_OPENAI_CUSTOM_URL:
-                raise ValueError("AZURE_OPENAI_CUSTOM_URL must be set when OPENAI_HOST is azure_custom")
-            endpoint = AZURE_OPENAI_CUSTOM_URL
-        else:
-            current_app.logger.info("OPENAI_HOST is azure, setting up Azure OpenAI client")
-            if not AZURE_OPENAI_SERVICE:
-                raise ValueError("AZURE_OPENAI_SERVICE must be set when OPENAI_HOST is azure")
-            endpoint = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
-        if api_key := os.getenv("AZURE_OPENAI_API_KEY_OVERRIDE"):
-            current_app.logger.info("AZURE_OPENAI_API_KEY_OVERRIDE found, using as api_key for Azure OpenAI client")
-            openai_client = AsyncAzureOpenAI(api_version=api_version, azure_endpoint=endpoint, api_key=api_key)
-        else:
-            current_app.logger.info("Using Azure credential (passwordless authentication) for Azure OpenAI client")
-            token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
-            openai_client = AsyncAzureOpenAI(
-                api_version=api_version,
-                azure_endpoint=endpoint,
-                azure_ad_token_provider=token_provider,
+
+    async def fetch_search_index():
+        if not AZURE_USE_AUTHENTICATION:
+            return None
+        with startup_phase("search_index"):
+            current_app.logger.info("AZURE_USE_AUTHENTICATION is true, setting up search index client")
+            search_index_client = SearchIndexClient(
+                endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+                credential=azure_credential,
             )
-    elif OPENAI_HOST == "local":
-        current_app.logger.info("OPENAI_HOST is local, setting up local OpenAI client for OPENAI_BASE_URL with no key")
-        openai_client = AsyncOpenAI(
-            base_url=os.environ["OPENAI_BASE_URL"],
-            api_key="no-key-required",
-        )
-    else:
-        current_app.logger.info(
-            "OPENAI_HOST is not azure, setting up OpenAI client using OPENAI_API_KEY and OPENAI_ORGANIZATION environment variables"
-        )
-        openai_client = AsyncOpenAI(
-            api_key=OPENAI_API_KEY,
-            organization=OPENAI_ORGANIZATION,
+            search_index = await search_index_client.get_index(AZURE_SEARCH_INDEX)
+            await search_index_client.close()
+            return search_index
+
+    async def setup_ingester():
+        if not USE_USER_UPLOAD:
+            return None
+        with startup_phase("user_upload"):
+            current_app.logger.info("USE_USER_UPLOAD is true, setting up user upload feature")
+            if not AZURE_USERSTORAGE_ACCOUNT or not AZURE_USERSTORAGE_CONTAINER:
+                raise ValueError(
+                    "AZURE_USERSTORAGE_ACCOUNT and AZURE_USERSTORAGE_CONTAINER must be set when USE_USER_UPLOAD is true"
+                )
+            # Importing the ingestion library and loading its tokenizer is CPU bound,
+            # so do it in a thread while the search index is being fetched
+            await asyncio.to_thread(load_ingestion_dependencies)
+            from prepdocs import (
+                clean_key_if_exists,
+                setup_embeddings_service,
+                setup_file_processors,
+                setup_search_info,
+            )
+            from prepdocslib.filestrategy import UploadUserFileStrategy
+
+            file_processors = setup_file_processors(
+                azure_credential=azure_credential,
+                document_intelligence_service=os.getenv("AZURE_DOCUMENTINTELLIGENCE_SERVICE"),
+                local_pdf_parser=os.getenv("USE_LOCAL_PDF_PARSER", "").lower() == "true",
+                local_html_parser=os.getenv("USE_LOCAL_HTML_PARSER", "").lower() == "true",
+                search_images=USE_GPT4V,
+            )
+            search_info = await setup_search_info(
+                search_service=AZURE_SEARCH_SERVICE, index_name=AZURE_SEARCH_INDEX, azure_credential=azure_credential
+            )
+            text_embeddings_service = setup_embeddings_service(
+                azure_credential=azure_credential,
+                openai_host=OPENAI_HOST,
+                openai_model_name=OPENAI_EMB_MODEL,
+                openai_service=AZURE_OPENAI_SERVICE,
+                openai_custom_url=AZURE_OPENAI_CUSTOM_URL,
+                openai_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+                openai_dimensions=OPENAI_EMB_DIMENSIONS,
+                openai_key=clean_key_if_exists(OPENAI_API_KEY),
+                openai_org=OPENAI_ORGANIZATION,
+                disable_vectors=os.getenv("USE_VECTORS", "").lower() == "false",
+            )
+            return UploadUserFileStrategy(
+                search_info=search_info, embeddings=text_embeddings_service, file_processors=file_processors
+            )
+
+    # The search index (needed for access control) and the user upload ingester don't depend on each other
+    search_index, ingester = await asyncio.gather(fetch_search_index(), setup_ingester())
+    if ingester and search_index:
+        # Indexes created before uploads were hashed can't be searched for copies until prepdocs adds the field
+        ingester.deduplicate = any(field.name == "contentHash" for field in search_index.fields)
+
+    with startup_phase("auth"):
+        # Set up authentication helper
+        auth_helper = AuthenticationHelper(
+            search_index=search_index,
+            use_authentication=AZURE_USE_AUTHENTICATION,
+            server_app_id=AZURE_SERVER_APP_ID,
+            server_app_secret=AZURE_SERVER_APP_SECRET,
+            client_app_id=AZURE_CLIENT_APP_ID,
+            tenant_id=AZURE_AUTH_TENANT_ID,
+            require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
+            enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
+            enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
         )
 
-    current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
-    current_app.config[CONFIG_SEARCH_CLIENT] = search_client
-    current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
-    current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
-
-    current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
-    current_app.config[CONFIG_SEMANTIC_RANKER_DEPLOYED] = AZURE_SEARCH_SEMANTIC_RANKER != "disabled"
-    current_app.config[CONFIG_VECTOR_SEARCH_ENABLED] = os.getenv("USE_VECTORS", "").lower() != "false"
-    current_app.config[CONFIG_USER_UPLOAD_ENABLED] = bool(USE_USER_UPLOAD)
-    current_app.config[CONFIG_SPEECH_INPUT_ENABLED] = USE_SPEECH_INPUT_BROWSER
-    current_app.config[CONFIG_SPEECH_OUTPUT_BROWSER_ENABLED] = USE_SPEECH_OUTPUT_BROWSER
-    current_app.config[CONFIG_SPEECH_OUTPUT_AZURE_ENABLED] = USE_SPEECH_OUTPUT_AZURE
-
-    # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
-    # or some derivative, here we include several for exploration purposes
-    current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
-        search_client=search_client,
-        openai_client=openai_client,
-        auth_helper=auth_helper,
-        chatgpt_model=OPENAI_CHATGPT_MODEL,
-        chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-        embedding_model=OPENAI_EMB_MODEL,
-        embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
-        embedding_dimensions=OPENAI_EMB_DIMENSIONS,
-        sourcepage_field=KB_FIELDS_SOURCEPAGE,
-        content_field=KB_FIELDS_CONTENT,
-        query_language=AZURE_SEARCH_QUERY_LANGUAGE,
-        query_speller=AZURE_SEARCH_QUERY_SPELLER,
-    )
+        if USE_USER_UPLOAD:
+            # setup_ingester has already checked that the user storage is configured
+            assert AZURE_USERSTORAGE_CONTAINER is not None
+            user_blob_container_client = FileSystemClient(
+                f"https://{AZURE_USERSTORAGE_ACCOUNT}.dfs.core.windows.net",
+                AZURE_USERSTORAGE_CONTAINER,
+                credential=azure_credential,
+            )
+            current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT] = user_blob_container_client
+            current_app.config[CONFIG_INGESTER] = ingester
+            from core.uploadqueue import UploadQueue
+
+            upload_queue = UploadQueue(ingester, workers=int(os.getenv("USER_UPLOAD_WORKERS", 2)))
+            upload_queue.start()
+            current_app.config[CONFIG_UPLOAD_QUEUE] = upload_queue
+
+    with startup_phase("openai_client"):
+        # Used by the OpenAI SDK
+        openai_client: AsyncOpenAI
+
+        if USE_SPEECH_OUTPUT_AZURE:
+            current_app.logger.info("USE_SPEECH_OUTPUT_AZURE is true, setting up Azure speech service")
+            if not AZURE_SPEECH_SERVICE_ID or AZURE_SPEECH_SERVICE_ID == "":
+                raise ValueError("Azure speech resource not configured correctly, missing AZURE_SPEECH_SERVICE_ID")
+            if not AZURE_SPEECH_SERVICE_LOCATION or AZURE_SPEECH_SERVICE_LOCATION == "":
+                raise ValueError(
+                    "Azure speech resource not configured correctly, missing AZURE_SPEECH_SERVICE_LOCATION"
+                )
+            current_app.config[CONFIG_SPEECH_SERVICE_ID] = AZURE_SPEECH_SERVICE_ID
+            current_app.config[CONFIG_SPEECH_SERVICE_LOCATION] = AZURE_SPEECH_SERVICE_LOCATION
+            current_app.config[CONFIG_SPEECH_SERVICE_VOICE] = AZURE_SPEECH_VOICE
+            # Wait until token is needed to fetch for the first time
+            current_app.config[CONFIG_SPEECH_SERVICE_TOKEN] = None
+            current_app.config[CONFIG_CREDENTIAL] = azure_credential
+
+        if OPENAI_HOST.startswith("azure"):
+            api_version = os.getenv("AZURE_OPENAI_API_VERSION") or "2024-03-01-preview"
+            # Earlier API versions reject stream_options, which asks for the usage of a streamed completion
+            stream_usage = api_version >= "2024-09-01"
+            if OPENAI_HOST == "azure_custom":
+                current_app.logger.info("OPENAI_HOST is azure_custom, setting up Azure OpenAI custom client")
+                if not AZURE_OPENAI_CUSTOM_URL:
+                    raise ValueError("AZURE_OPENAI_CUSTOM_URL must be set when OPENAI_HOST is azure_custom")
+                endpoint = AZURE_OPENAI_CUSTOM_URL
+            else:
+                current_app.logger.info("OPENAI_HOST is azure, setting up Azure OpenAI client")
+                if not AZURE_OPENAI_SERVICE:
+                    raise ValueError("AZURE_OPENAI_SERVICE must be set when OPENAI_HOST is azure")
+                endpoint = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+            if api_key := os.getenv("AZURE_OPENAI_API_KEY_OVERRIDE"):
+                current_app.logger.info("AZURE_OPENAI_API_KEY_OVERRIDE found, using as api_key for Azure OpenAI client")
+                openai_client = AsyncAzureOpenAI(api_version=api_version, azure_endpoint=endpoint, api_key=api_key)
+            else:
+                current_app.logger.info("Using Azure credential (passwordless authentication) for Azure OpenAI client")
+                token_provider = get_bearer_token_provider(
+                    azure_credential, "https://cognitiveservices.azure.com/.default"
+                )
+                openai_client = AsyncAzureOpenAI(
+                    api_version=api_version,
+                    azure_endpoint=endpoint,
+                    azure_ad_token_provider=token_provider,
+                )
+        elif OPENAI_HOST == "local":
+            current_app.logger.info(
+                "OPENAI_HOST is local, setting up local OpenAI client for OPENAI_BASE_URL with no key"
+            )
+            stream_usage = False
+            openai_client = AsyncOpenAI(
+                base_url=os.environ["OPENAI_BASE_URL"],
+                api_key="no-key-required",
+            )
+        else:
+            current_app.logger.info(
+                "OPENAI_HOST is not azure, setting up OpenAI client using OPENAI_API_KEY and OPENAI_ORGANIZATION environment variables"
+            )
+            openai_client = AsyncOpenAI(
+                api_key=OPENAI_API_KEY,
+                organization=OPENAI_ORGANIZATION,
+            )
+            stream_usage = True
+
+    with startup_phase("approaches"):
+        current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
+        current_app.config[CONFIG_SEARCH_CLIENT] = search_client
+        current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
+        current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
+
+        current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
+        current_app.config[CONFIG_SEMANTIC_RANKER_DEPLOYED] = AZURE_SEARCH_SEMANTIC_RANKER != "disabled"
+        current_app.config[CONFIG_VECTOR_SEARCH_ENABLED] = os.getenv("USE_VECTORS", "").lower() != "false"
+        current_app.config[CONFIG_USER_UPLOAD_ENABLED] = bool(USE_USER_UPLOAD)
+        current_app.config[CONFIG_SPEECH_INPUT_ENABLED] = USE_SPEECH_INPUT_BROWSER
+        current_app.config[CONFIG_SPEECH_OUTPUT_BROWSER_ENABLED] = USE_SPEECH_OUTPUT_BROWSER
+        current_app.config[CONFIG_SPEECH_OUTPUT_AZURE_ENABLED] = USE_SPEECH_OUTPUT_AZURE
+
+        conversation_store = None
+        if USE_CONVERSATION_STORE:
+            current_app.logger.info("USE_CONVERSATION_STORE is true, keeping chat conversations on the server")
+            conversation_persistence = None
+            if AZURE_CONVERSATIONS_CONTAINER:
+                conversation_persistence = BlobConversationPersistence(
+                    ContainerClient(
+                        f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+                        AZURE_CONVERSATIONS_CONTAINER,
+                        credential=azure_credential,
+                    )
+                )
+            else:
+                current_app.logger.warning(
+                    "AZURE_CONVERSATIONS_CONTAINER is not set, so each worker process only continues its own conversations"
+                )
+            conversation_store = ConversationStore(
+                chatgpt_model=OPENAI_CHATGPT_MODEL,
+                persistence=conversation_persistence,
+                ttl=int(os.getenv("CONVERSATION_STORE_TTL", 3600)),
+                max_conversations_per_user=int(os.getenv("CONVERSATION_STORE_MAX_PER_USER", 20)),
+                # Older messages wouldn't fit in the prompt anyway
+                max_history_tokens=get_token_limit(OPENAI_CHATGPT_MODEL, default_to_minimum=True),
+            )
+        current_app.config[CONFIG_CONVERSATION_STORE] = conversation_store
 
-    current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
-        search_client=search_client,
-        openai_client=openai_client,
-        auth_helper=auth_helper,
-        chatgpt_model=OPENAI_CHATGPT_MODEL,
-        chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-        embedding_model=OPENAI_EMB_MODEL,
-        embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
-        embedding_dimensions=OPENAI_EMB_DIMENSIONS,
-        sourcepage_field=KB_FIELDS_SOURCEPAGE,
-        content_field=KB_FIELDS_CONTENT,
-        query_language=AZURE_SEARCH_QUERY_LANGUAGE,
-        query_speller=AZURE_SEARCH_QUERY_SPELLER,
-    )
+        # The seconds each request has before the approaches skip or simplify their remaining stages, 0 for no limit
+        current_app.config[CONFIG_REQUEST_DEADLINE] = float(os.getenv("REQUEST_DEADLINE", 30))
 
-    if USE_GPT4V:
-        current_app.logger.info("USE_GPT4V is true, setting up GPT4V approach")
-        if not AZURE_OPENAI_GPT4V_MODEL:
-            raise ValueError("AZURE_OPENAI_GPT4V_MODEL must be set when USE_GPT4V is true")
-        token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
+        current_app.config[CONFIG_ADMISSION_CONTROLLER] = AdmissionController(
+            max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT", 16)),
+            max_waiting=int(os.getenv("ADMISSION_MAX_WAITING", 64)),
+            max_wait=float(os.getenv("ADMISSION_MAX_WAIT", 10)),
+        )
 
-        current_app.config[CONFIG_ASK_VISION_APPROACH] = RetrieveThenReadVisionApproach(
+        # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
+        # or some derivative, here we include several for exploration purposes
+        current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
             search_client=search_client,
             openai_client=openai_client,
-            blob_container_client=blob_container_client,
             auth_helper=auth_helper,
-            vision_endpoint=AZURE_VISION_ENDPOINT,
-            vision_token_provider=token_provider,
-            gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
-            gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
+            chatgpt_model=OPENAI_CHATGPT_MODEL,
+            chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
             embedding_model=OPENAI_EMB_MODEL,
             embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
             embedding_dimensions=OPENAI_EMB_DIMENSIONS,
@@ -673,19 +1121,26 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            stream_usage=stream_usage,
         )
 
-        current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
+        history_compactor = None
+        if USE_CHAT_HISTORY_SUMMARY:
+            current_app.logger.info("USE_CHAT_HISTORY_SUMMARY is true, summarising long chat histories")
+            history_compactor = HistoryCompactor(
+                openai_client=openai_client,
+                chatgpt_model=OPENAI_CHATGPT_MODEL,
+                summary_model=OPENAI_SUMMARY_MODEL,
+                summary_deployment=AZURE_OPENAI_SUMMARY_DEPLOYMENT,
+                token_threshold=int(os.getenv("CHAT_HISTORY_SUMMARY_THRESHOLD", 2000)),
+            )
+
+        current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
             search_client=search_client,
             openai_client=openai_client,
-            blob_container_client=blob_container_client,
             auth_helper=auth_helper,
-            vision_endpoint=AZURE_VISION_ENDPOINT,
-            vision_token_provider=token_provider,
             chatgpt_model=OPENAI_CHATGPT_MODEL,
             chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-            gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
-            gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
             embedding_model=OPENAI_EMB_MODEL,
             embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
             embedding_dimensions=OPENAI_EMB_DIMENSIONS,
@@ -693,15 +1148,76 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            history_compactor=history_compactor,
+            stream_usage=stream_usage,
         )
 
+        if USE_GPT4V:
+            current_app.logger.info("USE_GPT4V is true, setting up GPT4V approach")
+            if not AZURE_OPENAI_GPT4V_MODEL:
+                raise ValueError("AZURE_OPENAI_GPT4V_MODEL must be set when USE_GPT4V is true")
+            token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
+
+            current_app.config[CONFIG_ASK_VISION_APPROACH] = RetrieveThenReadVisionApproach(
+                search_client=search_client,
+                openai_client=openai_client,
+                blob_container_client=blob_container_client,
+                auth_helper=auth_helper,
+                vision_endpoint=AZURE_VISION_ENDPOINT,
+                vision_token_provider=token_provider,
+                gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
+                gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
+                embedding_model=OPENAI_EMB_MODEL,
+                embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+                embedding_dimensions=OPENAI_EMB_DIMENSIONS,
+                sourcepage_field=KB_FIELDS_SOURCEPAGE,
+                content_field=KB_FIELDS_CONTENT,
+                query_language=AZURE_SEARCH_QUERY_LANGUAGE,
+                query_speller=AZURE_SEARCH_QUERY_SPELLER,
+                stream_usage=stream_usage,
+            )
+
+            current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
+                search_client=search_client,
+                openai_client=openai_client,
+                blob_container_client=blob_container_client,
+                auth_helper=auth_helper,
+                vision_endpoint=AZURE_VISION_ENDPOINT,
+                vision_token_provider=token_provider,
+                chatgpt_model=OPENAI_CHATGPT_MODEL,
+                chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+                gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
+                gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
+                embedding_model=OPENAI_EMB_MODEL,
+                embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
+                embedding_dimensions=OPENAI_EMB_DIMENSIONS,
+                sourcepage_field=KB_FIELDS_SOURCEPAGE,
+                content_field=KB_FIELDS_CONTENT,
+                query_language=AZURE_SEARCH_QUERY_LANGUAGE,
+                query_speller=AZURE_SEARCH_QUERY_SPELLER,
+                history_compactor=history_compactor,
+                stream_usage=stream_usage,
+            )
+
+    setup_time = time.perf_counter() - setup_start
+    current_app.config[CONFIG_STARTUP_TIMINGS]["total"] = setup_time
+    current_app.logger.info("Setting up clients took %.3fs", setup_time)
+
 
 @bp.after_app_serving
 async def close_clients():
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
+    if current_app.config.get(CONFIG_UPLOAD_QUEUE):
+        await current_app.config[CONFIG_UPLOAD_QUEUE].stop()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
+    ingester = current_app.config.get(CONFIG_INGESTER)
+    if ingester and ingester.embeddings:
+        await ingester.embeddings.close()
+    conversation_store = current_app.config.get(CONFIG_CONVERSATION_STORE)
+    if conversation_store and isinstance(conversation_store.persistence, BlobConversationPersistence):
+        await conversation_store.persistence.container_client.close()
 
 
 def create_app():
@@ -710,7 +1226,18 @@ def create_app():
 
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
         app.logger.info("APPLICATIONINSIGHTS_CONNECTION_STRING is set, enabling Azure Monitor")
+        # The OpenTelemetry packages are slow to import, so only load them when monitoring is enabled
+        from azure.monitor.opentelemetry import configure_azure_monitor
+        from opentelemetry.instrumentation.aiohttp_client import (
+            AioHttpClientInstrumentor,
+        )
+        from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
+        from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+        from opentelemetry.instrumentation.openai import OpenAIInstrumentor
+
         configure_azure_monitor()
+        # Sends the app's own metrics, such as cancelled streams, along with the instrumented ones
+        metrics.enable_opentelemetry()
         # This tracks HTTP requests made by aiohttp:
         AioHttpClientInstrumentor().instrument()
         # This tracks HTTP requests made by httpx:
@@ -727,6 +1254,7 @@ def create_app():
     default_level = "INFO"
     app.logger.setLevel(os.getenv("APP_LOG_LEVEL", default_level))
 
+    app.config[CONFIG_ALLOWED_ORIGIN] = os.getenv("ALLOWED_ORIGIN")
     if allowed_origin := os.getenv("ALLOWED_ORIGIN"):
         app.logger.info("ALLOWED_ORIGIN is set, enabling CORS for %s", allowed_origin)
         cors(app, allow_origin=allowed_origin, allow_methods=["GET", "POST"])
@@ -2,10 +2,12 @@ import os
 from abc import ABC
 from dataclasses import dataclass
 from typing import (
+    TYPE_CHECKING,
     Any,
     AsyncGenerator,
     Awaitable,
     Callable,
+    Coroutine,
     List,
     Optional,
     TypedDict,
@@ -21,27 +23,85 @@ from azure.search.documents.models import (
     VectorizedQuery,
     VectorQuery,
 )
-from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageParam
+from openai import AsyncOpenAI, AsyncStream
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletionChunk, ChatCompletionMessageParam
 
+from approaches.deadline import DROPPED_SEMANTIC_RANKER, SEARCH_SHARE, Deadline
 from core.authentication import AuthenticationHelper
+from core.metrics import metrics
 from text import nonewlines
 
+if TYPE_CHECKING:
+    from approaches.reranker import LocalReranker
+
 
-@dataclass
 class Document:
-    id: Optional[str]
-    content: Optional[str]
-    embedding: Optional[List[float]]
-    image_embedding: Optional[List[float]]
-    category: Optional[str]
-    sourcepage: Optional[str]
-    sourcefile: Optional[str]
-    oids: Optional[List[str]]
-    groups: Optional[List[str]]
-    captions: List[QueryCaptionResult]
-    score: Optional[float] = None
-    reranker_score: Optional[float] = None
+    """
+    A search result. Uses __slots__ instead of a per-instance __dict__, since every request creates one per result,
+    and captions are only turned into a list when they're read, since they're usually not requested.
+    """
+
+    __slots__ = (
+        "id",
+        "content",
+        "embedding",
+        "image_embedding",
+        "category",
+        "sourcepage",
+        "sourcefile",
+        "oids",
+        "groups",
+        "_captions",
+        "score",
+        "reranker_score",
+    )
+
+    def __init__(
+        self,
+        id: Optional[str],
+        content: Optional[str],
+        embedding: Optional[List[float]],
+        image_embedding: Optional[List[float]],
+        category: Optional[str],
+        sourcepage: Optional[str],
+        sourcefile: Optional[str],
+        oids: Optional[List[str]],
+        groups: Optional[List[str]],
+        captions: Optional[List[QueryCaptionResult]],
+        score: Optional[float] = None,
+        reranker_score: Optional[float] = None,
+    ):
+        self.id = id
+        self.content = content
+        self.embedding = embedding
+        self.image_embedding = image_embedding
+        self.category = category
+        self.sourcepage = sourcepage
+        self.sourcefile = sourcefile
+        self.oids = oids
+        self.groups = groups
+        self._captions = captions
+        self.score = score
+        self.reranker_score = reranker_score
+
+    @property
+    def captions(self) -> List[QueryCaptionResult]:
+        if self._captions is None:
+            self._captions = []
+        return self._captions
+
+    @captions.setter
+    def captions(self, captions: Optional[List[QueryCaptionResult]]):
+        self._captions = captions
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Document):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"Document(id={self.id!r}, sourcepage={self.sourcepage!r}, score={self.score!r})"
 
     def serialize_for_results(self) -> dict[str, Any]:
         return {
@@ -90,6 +150,17 @@ class ThoughtStep:
     props: Optional[dict[str, Any]] = None
 
 
+# InvalidOverrideError is raised when a request sets an override to a value that can't be used,
+# which the routes report as a bad request
+class InvalidOverrideError(ValueError):
+    def __init__(self, name: str, value: Any):
+        self.name = name
+        self.value = value
+
+    def __str__(self) -> str:
+        return f"Invalid value for the {self.name} override: {self.value!r}"
+
+
 class Approach(ABC):
     def __init__(
         self,
@@ -105,6 +176,7 @@ class Approach(ABC):
         openai_host: str,
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
+        stream_usage: bool = False,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -117,6 +189,11 @@ class Approach(ABC):
         self.openai_host = openai_host
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.stream_usage = stream_usage
+
+    def validate_overrides(self, overrides: dict[str, Any]):
+        """Raises InvalidOverrideError before the approach starts, if an override can't be used"""
+        pass
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         include_category = overrides.get("include_category")
@@ -131,6 +208,19 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    def get_search_fields(self, include_embeddings: bool) -> List[str]:
+        """
+        Returns the index fields to retrieve. The vectors make up most of each result's size,
+        so they're only retrieved when something needs them, rather than to show a trimmed version in the thoughts.
+        """
+        fields = ["id", "content", "category", "sourcepage", "sourcefile"]
+        # These fields only exist in indexes that have been set up for access control
+        if self.auth_helper and self.auth_helper.has_auth_fields:
+            fields += ["oids", "groups"]
+        if include_embeddings:
+            fields.append("embedding")
+        return fields
+
     async def search(
         self,
         top: int,
@@ -143,14 +233,44 @@ class Approach(ABC):
         use_semantic_captions: bool,
         minimum_search_score: Optional[float],
         minimum_reranker_score: Optional[float],
+        reranker: Optional["LocalReranker"] = None,
+        deadline: Optional[Deadline] = None,
     ) -> List[Document]:
+        if deadline and use_semantic_ranker:
+            # The semantic ranker is the slowest part of a search, so it's dropped if the search takes too long
+            ranked = await deadline.run(
+                self.search(
+                    top,
+                    query_text,
+                    filter,
+                    vectors,
+                    use_text_search,
+                    use_vector_search,
+                    use_semantic_ranker,
+                    use_semantic_captions,
+                    minimum_search_score,
+                    minimum_reranker_score,
+                    reranker,
+                ),
+                SEARCH_SHARE,
+                DROPPED_SEMANTIC_RANKER,
+            )
+            if ranked is not None:
+                return ranked
+            # Reranker scores only come from the semantic ranker
+            use_semantic_ranker, use_semantic_captions, minimum_reranker_score = False, False, None
         search_text = query_text if use_text_search else ""
         search_vectors = vectors if use_vector_search else []
+        # The local reranker picks the best results out of a larger set of candidates
+        if reranker:
+            top = reranker.candidates
+        select = self.get_search_fields(reranker is not None and reranker.needs_embeddings)
         if use_semantic_ranker:
             results = await self.search_client.search(
                 search_text=search_text,
                 filter=filter,
                 top=top,
+                select=select,
                 query_caption="extractive|highlight-false" if use_semantic_captions else None,
                 vector_queries=search_vectors,
                 query_type=QueryType.SEMANTIC,
@@ -164,6 +284,7 @@ class Approach(ABC):
                 search_text=search_text,
                 filter=filter,
                 top=top,
+                select=select,
                 vector_queries=search_vectors,
             )
 
@@ -196,23 +317,33 @@ class Approach(ABC):
                 )
             ]
 
+        if reranker:
+            query_vector = next(
+                (
+                    vector.vector
+                    for vector in search_vectors
+                    if isinstance(vector, VectorizedQuery) and vector.fields == "embedding"
+                ),
+                None,
+            )
+            qualified_documents = reranker.rerank(qualified_documents, query_text, query_vector)
+
         return qualified_documents
 
     def get_sources_content(
         self, results: List[Document], use_semantic_captions: bool, use_image_citation: bool
     ) -> list[str]:
+        return [
+            (self.get_citation((doc.sourcepage or ""), use_image_citation))
+            + ": "
+            + nonewlines(self.get_source_text(doc, use_semantic_captions))
+            for doc in results
+        ]
+
+    def get_source_text(self, doc: Document, use_semantic_captions: bool) -> str:
         if use_semantic_captions:
-            return [
-                (self.get_citation((doc.sourcepage or ""), use_image_citation))
-                + ": "
-                + nonewlines(" . ".join([cast(str, c.text) for c in (doc.captions or [])]))
-                for doc in results
-            ]
-        else:
-            return [
-                (self.get_citation((doc.sourcepage or ""), use_image_citation)) + ": " + nonewlines(doc.content or "")
-                for doc in results
-            ]
+            return " . ".join([cast(str, c.text) for c in (doc.captions or [])])
+        return doc.content or ""
 
     def get_citation(self, sourcepage: str, use_image_citation: bool) -> str:
         if use_image_citation:
@@ -226,7 +357,7 @@ class Approach(ABC):
 
             return sourcepage
 
-    async def compute_text_embedding(self, q: str):
+    def get_embedding_args(self) -> dict[str, Any]:
         SUPPORTED_DIMENSIONS_MODEL = {
             "text-embedding-ada-002": False,
             "text-embedding-3-small": True,
@@ -239,15 +370,25 @@ class Approach(ABC):
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
-        embedding = await self.openai_client.embeddings.create(
+        return {
             # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
+            "model": self.embedding_deployment if self.embedding_deployment else self.embedding_model,
             **dimensions_args,
-        )
+        }
+
+    async def compute_text_embedding(self, q: str):
+        embedding = await self.openai_client.embeddings.create(input=q, **self.get_embedding_args())
         query_vector = embedding.data[0].embedding
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields="embedding")
 
+    async def compute_text_embeddings(self, queries: list[str]) -> list[VectorizedQuery]:
+        """Embeds several queries with a single request"""
+        embeddings = await self.openai_client.embeddings.create(input=queries, **self.get_embedding_args())
+        return [
+            VectorizedQuery(vector=embedding.embedding, k_nearest_neighbors=50, fields="embedding")
+            for embedding in sorted(embeddings.data, key=lambda embedding: embedding.index)
+        ]
+
     async def compute_image_embedding(self, q: str):
         endpoint = urljoin(self.vision_endpoint, "computervision/retrieval:vectorizeText")
         headers = {"Content-Type": "application/json"}
@@ -264,6 +405,56 @@ class Approach(ABC):
                 image_query_vector = json["vector"]
         return VectorizedQuery(vector=image_query_vector, k_nearest_neighbors=50, fields="imageEmbedding")
 
+    def get_stream_options(self, should_stream: bool) -> dict[str, Any]:
+        """Asks for the usage at the end of a streamed completion, which Azure OpenAI sends from API version 2024-09-01"""
+        return {"stream_options": {"include_usage": True}} if should_stream and self.stream_usage else {}
+
+    @staticmethod
+    def record_usage(stage: str, usage: Optional[CompletionUsage]):
+        """
+        Records the prompt tokens of a completion, and how many of them the provider read from its prompt cache.
+        Only prompts of at least 1024 tokens that start with the same tokens as a recent one are read from the cache.
+        """
+        if usage is None:
+            return
+        details = usage.prompt_tokens_details
+        cached_tokens = (details.cached_tokens if details else None) or 0
+        metrics.record("openai.prompt_tokens", usage.prompt_tokens, attributes={"stage": stage})
+        metrics.record("openai.cached_tokens", cached_tokens, attributes={"stage": stage})
+
+    async def stream_answer(
+        self,
+        final_call: Awaitable[tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Yields the context as soon as the prompt is ready, so the client can show the sources, and then the answer
+        as it is generated. final_call prepares the prompt and returns the context and the chat completion call.
+        """
+        extra_info, chat_coroutine = await final_call
+        chat_stream = None
+        try:
+            yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
+            chat_stream = await chat_coroutine
+            async for event_chunk in chat_stream:
+                # The usage comes in a last chunk without choices, if it was asked for
+                self.record_usage("answer", event_chunk.usage)
+                event = event_chunk.model_dump()
+                # "2023-07-01-preview" API version has a bug where first response has empty choices
+                if event["choices"]:
+                    yield {
+                        "delta": {
+                            "content": event["choices"][0]["delta"].get("content"),
+                            "role": event["choices"][0]["delta"]["role"],
+                        }
+                    }
+        finally:
+            # Closing the response also stops the upstream generation when the client disconnects
+            if chat_stream is not None:
+                await chat_stream.close()
+            else:
+                chat_coroutine.close()
+
     async def run(
         self,
         messages: list[ChatCompletionMessageParam],
@@ -1,11 +1,26 @@
+import asyncio
 import json
+import logging
 import re
+import time
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Optional
+from typing import Any, AsyncGenerator, List, Optional
 
-from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
+from azure.search.documents.models import VectorQuery
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionMessageParam,
+    ChatCompletionToolParam,
+)
 
-from approaches.approach import Approach
+from approaches.approach import Approach, Document
+from approaches.deadline import Deadline
+from approaches.historycompactor import HistoryCompactor
+from approaches.reranker import LocalReranker, reciprocal_rank_fusion
+from core.conversationstore import Conversation
+from core.metrics import metrics
+
+logger = logging.getLogger("chatapproach")
 
 
 class ChatApproach(Approach, ABC):
@@ -27,6 +42,27 @@ class ChatApproach(Approach, ABC):
         },
     ]
     NO_RESPONSE = "0"
+    history_compactor: Optional[HistoryCompactor] = None
+    # Bounds for the multi-query retrieval mode: how many query variants are searched, and how many at once
+    max_search_queries = 5
+    max_concurrent_searches = 3
+    # The overrides that change which search results are returned for a search query
+    retrieval_overrides = (
+        "top",
+        "retrieval_mode",
+        "semantic_ranker",
+        "semantic_captions",
+        "minimum_search_score",
+        "minimum_reranker_score",
+        "vector_fields",
+        "use_gpt4v",
+        "use_bm25",
+        "use_mmr",
+        "rerank_candidates",
+        "mmr_lambda",
+        "use_multi_query",
+        "search_query_count",
+    )
 
     follow_up_questions_prompt_content = """- If your response was informative, generate up to 3 concise and relevant follow-up questions that the user could ask you.
 - Do not generate follow-up questions if you declined to answer.
@@ -37,6 +73,50 @@ class ChatApproach(Approach, ABC):
 - Ensure the last question ends with ">>".
 """
 
+    # Tool definitions are sent ahead of the system message, so they are fixed to keep the start of the prompt the same
+    # for every request, which lets the provider reuse its cached prefix. The number of variants goes in the user message.
+    search_sources_tool: ChatCompletionToolParam = {
+        "type": "function",
+        "function": {
+            "name": "search_sources",
+            "description": "Retrieve sources from the Azure AI Search index",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "search_query": {
+                        "type": "string",
+                        "description": "Query string to retrieve documents from azure search eg: 'Small business grants'",
+                    }
+                },
+                "required": ["search_query"],
+            },
+        },
+    }
+    search_sources_multi_query_tool: ChatCompletionToolParam = {
+        "type": "function",
+        "function": {
+            "name": "search_sources",
+            "description": "Retrieve sources from the Azure AI Search index",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "search_query": {
+                        "type": "string",
+                        "description": "Query string to retrieve documents from azure search eg: 'Small business grants'",
+                    },
+                    # The variants are returned in the same tool call, so the fan-out doesn't need another completion
+                    "search_queries": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "More short search queries for the same question, "
+                        "using different wording or synonyms",
+                    },
+                },
+                "required": ["search_query"],
+            },
+        },
+    }
+
     query_prompt_template = """Use the conversation and the new user question to generate a search query for the Azure AI Search index containing thousands of documents.
 Guidelines:
 - **Exclusions**: Do not include filenames, document names, or text within "[ ]" or "<< >>" in the search terms.
@@ -60,10 +140,13 @@ Guidelines:
         pass
 
     @abstractmethod
-    async def run_until_final_call(self, messages, overrides, auth_claims, should_stream) -> tuple:
+    async def run_until_final_call(
+        self, messages, overrides, auth_claims, should_stream, conversation=None, deadline=None
+    ) -> tuple:
         pass
 
     def get_system_prompt(self, override_prompt: Optional[str], follow_up_questions_prompt: str) -> str:
+        # The placeholders are at the end of the system message, so the rest of it is a stable prefix for prompt caching
         if override_prompt is None:
             return self.system_message_chat_conversation.format(
                 injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
@@ -93,6 +176,79 @@ Guidelines:
                 return query_text
         return user_query
 
+    def get_search_queries(self, chat_completion: ChatCompletion, query_text: str, count: int) -> list[str]:
+        """Returns the search query followed by the variants from the search_sources tool call, without duplicates"""
+        queries = [query_text]
+        for tool in chat_completion.choices[0].message.tool_calls or []:
+            if tool.type != "function" or tool.function.name != "search_sources":
+                continue
+            variants = json.loads(tool.function.arguments).get("search_queries", [])
+            if isinstance(variants, list):
+                queries.extend(variant for variant in variants if isinstance(variant, str) and variant.strip())
+        unique_queries: list[str] = []
+        for query in queries:
+            if query.strip().lower() not in (unique_query.strip().lower() for unique_query in unique_queries):
+                unique_queries.append(query)
+        return unique_queries[:count]
+
+    async def search_queries(
+        self,
+        top: int,
+        query_texts: list[str],
+        filter: Optional[str],
+        vectors: list[List[VectorQuery]],
+        use_text_search: bool,
+        use_vector_search: bool,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        minimum_search_score: Optional[float],
+        minimum_reranker_score: Optional[float],
+        reranker: Optional[LocalReranker] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> tuple[List[Document], list[dict[str, Any]]]:
+        """
+        Searches for each query concurrently, at most max_concurrent_searches at a time,
+        and merges the results with reciprocal rank fusion. Also returns the results and latency of each search.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent_searches)
+
+        async def search_branch(query_text: str, query_vectors: List[VectorQuery]) -> tuple[List[Document], float]:
+            async with semaphore:
+                start = time.perf_counter()
+                results = await self.search(
+                    top,
+                    query_text,
+                    filter,
+                    query_vectors,
+                    use_text_search,
+                    use_vector_search,
+                    use_semantic_ranker,
+                    use_semantic_captions,
+                    minimum_search_score,
+                    minimum_reranker_score,
+                    reranker,
+                    deadline=deadline,
+                )
+                latency = time.perf_counter() - start
+            logger.info("Search for %r returned %d results in %.3f s", query_text, len(results), latency)
+            return results, latency
+
+        branches = await asyncio.gather(
+            *(search_branch(query_text, query_vectors) for query_text, query_vectors in zip(query_texts, vectors))
+        )
+        branch_stats = [
+            {"query": query_text, "results": len(results), "latency": round(latency, 3)}
+            for query_text, (results, latency) in zip(query_texts, branches)
+        ]
+        return reciprocal_rank_fusion([results for results, _ in branches], top), branch_stats
+
+    def get_retrieval_key(self, query_text: str, filter: Optional[str], overrides: dict[str, Any]) -> str:
+        """Identifies a search, so that its results can be reused by later turns of a conversation"""
+        return json.dumps(
+            {"query": query_text, "filter": filter, **{key: overrides.get(key) for key in self.retrieval_overrides}},
+            sort_keys=True,
+        )
+
     def extract_followup_questions(self, content: Optional[str]):
         if content is None:
             return content, []
@@ -104,11 +260,30 @@ Guidelines:
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        conversation: Optional[Conversation] = None,
+        deadline: Optional[Deadline] = None,
     ) -> dict[str, Any]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            messages, overrides, auth_claims, should_stream=False
-        )
-        chat_completion_response: ChatCompletion = await chat_coroutine
+        # Older turns are summarised in the background, and the summary replaces them from the next turn on
+        summary_task = None
+        if self.history_compactor:
+            session_state = self.history_compactor.resolve(session_state)
+            prompt_messages = self.history_compactor.apply(messages, session_state)
+            session_state, summary_task = self.history_compactor.start(messages, session_state)
+            messages = prompt_messages
+        try:
+            extra_info, chat_coroutine = await self.run_until_final_call(
+                messages, overrides, auth_claims, should_stream=False, conversation=conversation, deadline=deadline
+            )
+            chat_completion_response: ChatCompletion = await chat_coroutine
+        except BaseException:
+            # The client doesn't get the session state, so would never pick up the summary
+            if summary_task:
+                summary_task.cancel()
+            raise
+        self.record_usage("answer", chat_completion_response.usage)
+        if self.history_compactor:
+            # The summary may have been written while the answer was, so the client can keep it straight away
+            session_state = self.history_compactor.resolve(session_state)
         content = chat_completion_response.choices[0].message.content
         role = chat_completion_response.choices[0].message.role
         if overrides.get("suggest_followup_questions"):
@@ -127,24 +302,26 @@ Guidelines:
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         session_state: Any = None,
+        conversation: Optional[Conversation] = None,
+        deadline: Optional[Deadline] = None,
     ) -> AsyncGenerator[dict, None]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            messages, overrides, auth_claims, should_stream=True
-        )
-        yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
-
+        # Older turns are summarised in the background, and the summary replaces them from the next turn on
+        summary_task = None
+        if self.history_compactor:
+            session_state = self.history_compactor.resolve(session_state)
+            prompt_messages = self.history_compactor.apply(messages, session_state)
+            session_state, summary_task = self.history_compactor.start(messages, session_state)
+            messages = prompt_messages
         followup_questions_started = False
         followup_content = ""
-        async for event_chunk in await chat_coroutine:
-            # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
-                completion = {
-                    "delta": {
-                        "content": event["choices"][0]["delta"].get("content"),
-                        "role": event["choices"][0]["delta"]["role"],
-                    }
-                }
+        answer = self.stream_answer(
+            self.run_until_final_call(
+                messages, overrides, auth_claims, should_stream=True, conversation=conversation, deadline=deadline
+            ),
+            session_state,
+        )
+        try:
+            async for completion in answer:
                 # if event contains << and not >>, it is start of follow-up question, truncate
                 content = completion["delta"].get("content")
                 content = content or ""  # content may either not exist in delta, or explicitly be None
@@ -159,9 +336,26 @@ Guidelines:
                     followup_content += content
                 else:
                     yield completion
+        except BaseException as error:
+            if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+                # The client disconnected, so stop the model from generating the rest of the answer
+                logger.info("Client disconnected, cancelling the chat completion stream")
+                metrics.increment("chat.stream.cancelled")
+            # The client may not have the session state, so would never pick up the summary
+            if summary_task:
+                summary_task.cancel()
+            raise
+        finally:
+            # Closing this generator doesn't close the answer it was reading, which closes the chat completion stream
+            await answer.aclose()
         if followup_content:
             _, followup_questions = self.extract_followup_questions(followup_content)
             yield {"delta": {"role": "assistant"}, "context": {"followup_questions": followup_questions}}
+        if self.history_compactor:
+            # The summary may have been written while the answer was streamed, so the client can keep it straight away
+            resolved_session_state = self.history_compactor.resolve(session_state)
+            if resolved_session_state is not session_state:
+                yield {"delta": {"role": "assistant"}, "session_state": resolved_session_state}
 
     async def run(
         self,
@@ -171,7 +365,10 @@ Guidelines:
     ) -> dict[str, Any]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
-        return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+        self.validate_overrides(overrides)
+        return await self.run_without_streaming(
+            messages, overrides, auth_claims, session_state, context.get("conversation"), context.get("deadline")
+        )
 
     async def run_stream(
         self,
@@ -181,4 +378,8 @@ Guidelines:
     ) -> AsyncGenerator[dict[str, Any], None]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
-        return self.run_with_streaming(messages, overrides, auth_claims, session_state)
+        # Checked before the stream starts, so that the client gets an error status instead of an error event
+        self.validate_overrides(overrides)
+        return self.run_with_streaming(
+            messages, overrides, auth_claims, session_state, context.get("conversation"), context.get("deadline")
+        )
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any, Awaitable, Callable, Coroutine, Optional, Union
 
 from azure.search.documents.aio import SearchClient
@@ -14,7 +15,19 @@ from openai_messages_token_helper import build_messages, get_token_limit
 
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
+from approaches.deadline import (
+    EMBEDDING_SHARE,
+    IMAGES_SHARE,
+    OMITTED_IMAGES,
+    QUERY_REWRITE_SHARE,
+    SKIPPED_QUERY_REWRITE,
+    TEXT_ONLY_SEARCH,
+    Deadline,
+)
+from approaches.historycompactor import HistoryCompactor
+from approaches.reranker import LocalReranker
 from core.authentication import AuthenticationHelper
+from core.conversationstore import Conversation
 from core.imageshelper import fetch_image
 
 
@@ -44,11 +57,14 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
-        vision_token_provider: Callable[[], Awaitable[str]]
+        vision_token_provider: Callable[[], Awaitable[str]],
+        history_compactor: Optional[HistoryCompactor] = None,
+        stream_usage: bool = False,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
         self.openai_client = openai_client
+        self.stream_usage = stream_usage
         self.auth_helper = auth_helper
         self.chatgpt_model = chatgpt_model
         self.chatgpt_deployment = chatgpt_deployment
@@ -61,6 +77,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.history_compactor = history_compactor
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
         self.chatgpt_token_limit = get_token_limit(gpt4v_model)
@@ -87,6 +104,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        conversation: Optional[Conversation] = None,
+        deadline: Optional[Deadline] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         seed = overrides.get("seed", None)
         use_text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
@@ -97,6 +116,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
         filter = self.build_filter(overrides, auth_claims)
+        deadline = deadline or Deadline()
 
         vector_fields = overrides.get("vector_fields", ["embedding"])
         send_text_to_gptvision = overrides.get("gpt4v_input") in ["textAndImages", "texts", None]
@@ -122,42 +142,72 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             max_tokens=self.chatgpt_token_limit - query_response_token_limit,
         )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            model=query_deployment if query_deployment else query_model,
-            messages=query_messages,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=query_response_token_limit,
-            n=1,
-            seed=seed,
+        chat_completion: Optional[ChatCompletion] = await deadline.run(
+            self.openai_client.chat.completions.create(
+                model=query_deployment if query_deployment else query_model,
+                messages=query_messages,
+                temperature=0.0,  # Minimize creativity for search query generation
+                max_tokens=query_response_token_limit,
+                n=1,
+                seed=seed,
+            ),
+            QUERY_REWRITE_SHARE,
+            SKIPPED_QUERY_REWRITE,
         )
 
-        query_text = self.get_search_query(chat_completion, original_user_query)
+        if chat_completion:
+            self.record_usage("query_rewrite", chat_completion.usage)
+
+        # If generating the query took too long, search for the question as it was asked
+        query_text = (
+            self.get_search_query(chat_completion, original_user_query) if chat_completion else original_user_query
+        )
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
-        if use_vector_search:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(query_text)
+        # Reuse the results if an earlier turn of the conversation ran the same search
+        retrieval_key = self.get_retrieval_key(query_text, filter, overrides)
+        results = conversation.get_results(retrieval_key) if conversation else None
+        if results is None:
+            # If retrieval mode includes vectors, compute an embedding for the query
+            vectors = []
+            if use_vector_search:
+                computed_vectors = await deadline.run(
+                    asyncio.gather(
+                        *(
+                            (
+                                self.compute_text_embedding(query_text)
+                                if field == "embedding"
+                                else self.compute_image_embedding(query_text)
+                            )
+                            for field in vector_fields
+                        )
+                    ),
+                    EMBEDDING_SHARE,
+                    TEXT_ONLY_SEARCH,
                 )
-                vectors.append(vector)
-
-        results = await self.search(
-            top,
-            query_text,
-            filter,
-            vectors,
-            use_text_search,
-            use_vector_search,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
-        )
+                if computed_vectors is None:
+                    use_text_search, use_vector_search = True, False
+                else:
+                    vectors.extend(computed_vectors)
+
+            results = await self.search(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                LocalReranker.from_overrides(overrides, top),
+                deadline=deadline,
+            )
+            # Degraded results aren't reused, since a later turn may have the time to do better
+            if conversation and not deadline.degradations:
+                conversation.add_results(retrieval_key, results)
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
         content = "\n".join(sources_content)
 
@@ -175,8 +225,13 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         if send_text_to_gptvision:
             user_content.append({"text": "\n\nSources:\n" + content, "type": "text"})
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
+            # Without the images, the answer is based on the text of the sources
+            urls = await deadline.run(
+                asyncio.gather(*(fetch_image(self.blob_container_client, result) for result in results)),
+                IMAGES_SHARE,
+                OMITTED_IMAGES,
+            )
+            for url in urls or []:
                 if url:
                     image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
@@ -195,7 +250,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             "images": [d["image_url"] for d in image_list],
         }
 
-        extra_info = {
+        extra_info: dict[str, Any] = {
             "data_points": data_points,
             "thoughts": [
                 ThoughtStep(
@@ -235,6 +290,13 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             ],
         }
 
+        if deadline.degradations:
+            extra_info["thoughts"].append(
+                ThoughtStep(
+                    "Degraded to meet the request deadline", deadline.degradations, {"deadline": deadline.seconds}
+                )
+            )
+
         chat_coroutine = self.openai_client.chat.completions.create(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
             messages=messages,
@@ -242,6 +304,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             max_tokens=response_token_limit,
             n=1,
             stream=should_stream,
+            **self.get_stream_options(should_stream),
             seed=seed,
         )
         return (extra_info, chat_coroutine)
@@ -0,0 +1,168 @@
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional
+
+import tiktoken
+
+from approaches.approach import Document
+from text import nonewlines
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# Sections are split at about 1000 characters (DEFAULT_SECTION_LENGTH in prepdocslib), roughly 250 tokens of English
+TYPICAL_SECTION_TOKENS = 250
+# The most results fetched to fill a token budget, so that a large budget doesn't make for a slow search
+MAX_CANDIDATES = 20
+
+
+@dataclass
+class PackedSources:
+    documents: List[Document] = field(default_factory=list)
+    sources_content: List[str] = field(default_factory=list)
+    token_budget: Optional[int] = None
+    tokens_before: int = 0
+    tokens_after: int = 0
+    duplicates_removed: int = 0
+    over_budget: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    def serialize_for_thoughts(self) -> dict[str, Any]:
+        return {
+            "token_budget": self.token_budget,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved": self.tokens_saved,
+            "duplicates_removed": self.duplicates_removed,
+            "over_budget": self.over_budget,
+        }
+
+
+class ContextPacker:
+    """
+    Packs search results into the sources of a prompt, spending as few tokens as possible on repeated text.
+    Chunks from the same source file overlap (see DEFAULT_OVERLAP_PERCENT in prepdocslib) and repeat the same
+    page boilerplate, so overlapping spans and repeated lines are removed, near-duplicate chunks are dropped,
+    and the remaining chunks are added in rank order until the token budget is used up.
+    Given a token budget, search fetches enough candidates to fill it (see candidates), so the budget decides
+    how many sources the prompt gets, rather than a fixed top.
+    """
+
+    def __init__(
+        self,
+        encoding: tiktoken.Encoding,
+        min_overlap_length: int = 20,
+        min_line_length: int = 20,
+        near_duplicate_threshold: float = 0.9,
+        shingle_size: int = 5,
+    ):
+        self.encoding = encoding
+        self.min_overlap_length = min_overlap_length
+        self.min_line_length = min_line_length
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.shingle_size = shingle_size
+
+    def candidates(self, top: int, token_budget: Optional[int]) -> int:
+        """Returns how many search results to fetch, so that there are enough to fill the token budget"""
+        if token_budget is None:
+            return top
+        return max(top, min(token_budget // TYPICAL_SECTION_TOKENS, MAX_CANDIDATES))
+
+    def pack(
+        self,
+        documents: List[Document],
+        get_text: Callable[[Document], str],
+        get_citation: Callable[[Document], str],
+        token_budget: Optional[int] = None,
+    ) -> PackedSources:
+        packed = PackedSources(token_budget=token_budget)
+        # Texts and lines already in the prompt, per source file
+        seen_texts: dict[Optional[str], List[str]] = {}
+        seen_lines: dict[Optional[str], set[str]] = {}
+        seen_shingles: List[set[str]] = []
+
+        # The documents are already ranked, by the search service or by the local reranker
+        for document in documents:
+            citation = get_citation(document)
+            text = get_text(document)
+            packed.tokens_before += self.count_tokens(citation, text)
+
+            for seen_text in seen_texts.get(document.sourcefile, []):
+                text = self.trim_overlap(seen_text, text)
+            text = self.remove_seen_lines(text, seen_lines.setdefault(document.sourcefile, set())).strip()
+            if not text:
+                packed.duplicates_removed += 1
+                continue
+
+            shingles = self.get_shingles(text)
+            if any(self.similarity(shingles, other) >= self.near_duplicate_threshold for other in seen_shingles):
+                packed.duplicates_removed += 1
+                continue
+
+            tokens = self.count_tokens(citation, text)
+            if token_budget is not None and packed.tokens_after + tokens > token_budget:
+                # A smaller, lower scoring source may still fit, so keep going
+                packed.over_budget += 1
+                continue
+
+            seen_texts.setdefault(document.sourcefile, []).append(text)
+            seen_lines[document.sourcefile].update(self.get_lines(text))
+            seen_shingles.append(shingles)
+            packed.documents.append(document)
+            packed.sources_content.append(citation + ": " + nonewlines(text))
+            packed.tokens_after += tokens
+        return packed
+
+    def count_tokens(self, citation: str, text: str) -> int:
+        # The sources are joined with newlines, so count one token for the separator
+        return len(self.encoding.encode(citation + ": " + nonewlines(text))) + 1
+
+    def trim_overlap(self, seen_text: str, text: str) -> str:
+        """Removes the start or end of text that repeats the end or start of a chunk already in the prompt"""
+        if text in seen_text:
+            return ""
+        overlap = self.overlap_length(seen_text, text)
+        if overlap:
+            text = text[overlap:]
+        overlap = self.overlap_length(text, seen_text)
+        if overlap:
+            text = text[:-overlap]
+        return text
+
+    def overlap_length(self, first: str, second: str) -> int:
+        """Returns the length of the longest suffix of first that is also a prefix of second"""
+        probe = second[: self.min_overlap_length]
+        if len(probe) < self.min_overlap_length:
+            return 0
+        # The earliest match is the longest overlap
+        start = first.find(probe)
+        while start != -1:
+            if second.startswith(first[start:]):
+                return len(first) - start
+            start = first.find(probe, start + 1)
+        return 0
+
+    def remove_seen_lines(self, text: str, seen_lines: set[str]) -> str:
+        return "\n".join(
+            line
+            for line in text.split("\n")
+            if len(line.strip()) < self.min_line_length or line.strip() not in seen_lines
+        )
+
+    def get_lines(self, text: str) -> List[str]:
+        return [line.strip() for line in text.split("\n") if len(line.strip()) >= self.min_line_length]
+
+    def get_shingles(self, text: str) -> set[str]:
+        words = WORD_PATTERN.findall(text.lower())
+        if len(words) <= self.shingle_size:
+            return {" ".join(words)}
+        return {" ".join(words[i : i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    @classmethod
+    def similarity(cls, first: set[str], second: set[str]) -> float:
+        """Jaccard similarity of two sets of shingles"""
+        if not first or not second:
+            return 0.0
+        return len(first & second) / len(first | second)
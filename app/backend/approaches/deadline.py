@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Optional, TypeVar
+
+from core.metrics import metrics
+
+logger = logging.getLogger("deadline")
+
+T = TypeVar("T")
+
+# The share of the remaining time that each stage can take, before the approach falls back to a cheaper option.
+# Generating the answer gets whatever is left, since it streams to the user.
+QUERY_REWRITE_SHARE = 0.3
+EMBEDDING_SHARE = 0.2
+SEARCH_SHARE = 0.4
+IMAGES_SHARE = 0.3
+
+# The ways an approach degrades when a stage runs out of time
+SKIPPED_QUERY_REWRITE = "skipped_query_rewrite"
+TEXT_ONLY_SEARCH = "text_only_search"
+DROPPED_SEMANTIC_RANKER = "dropped_semantic_ranker"
+OMITTED_IMAGES = "omitted_images"
+
+
+class Deadline:
+    """
+    The time budget of a request, which starts when the request arrives. Each stage of an approach gets a share
+    of the time that is left, and a stage that runs out of it is skipped or replaced with a cheaper one.
+    The degradations are reported in the thoughts. Without seconds, the stages have no time limit.
+    """
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.degradations: list[str] = []
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    async def run(self, stage: Awaitable[T], share: float, degradation: str) -> Optional[T]:
+        """Awaits the stage within its share of the remaining time, or returns None and records the degradation"""
+        remaining = self.remaining()
+        if remaining is None:
+            return await stage
+        try:
+            return await asyncio.wait_for(stage, timeout=remaining * share)
+        except asyncio.TimeoutError:
+            self.degrade(degradation)
+            return None
+
+    def degrade(self, degradation: str):
+        logger.warning("Request deadline degradation: %s", degradation)
+        metrics.increment("deadline.degradations", attributes={"degradation": degradation})
+        if degradation not in self.degradations:
+            self.degradations.append(degradation)
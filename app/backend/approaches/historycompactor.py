@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Optional
+
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletionMessageParam
+from openai_messages_token_helper import count_tokens_for_message
+
+logger = logging.getLogger("historycompactor")
+
+
+class HistoryCompactor:
+    """
+    Replaces the older turns of a long conversation with a summary, so that the prompts stay about the same size.
+    The summary is written by a (cheaper) model in the background, without holding up the answer. The response's
+    session_state says which summary is being written and, if the summary is finished by the time the answer is,
+    the response returns it in session_state, which the client sends back with every question.
+    Summaries that take longer are kept in the memory of the worker process that wrote them until the next request
+    picks them up. Gunicorn runs several workers, so a request that reaches another one goes without,
+    and the history is summarised again.
+    """
+
+    summary_prompt = """Summarise the conversation below between a user and an assistant, so that the assistant can continue it without the original messages.
+Keep the user's goals, the facts they shared about themselves and their business, and the facts the assistant gave with their [citations].
+If a previous summary is given, merge it into the new summary. Reply with the summary only, in at most 200 words."""
+
+    def __init__(
+        self,
+        *,
+        openai_client: AsyncOpenAI,
+        chatgpt_model: str,
+        summary_model: str,
+        summary_deployment: Optional[str],  # Not needed for non-Azure OpenAI
+        token_threshold: int = 2000,
+        keep_recent_messages: int = 4,
+        summary_token_limit: int = 400,
+        timeout: float = 10,
+        max_summaries: int = 1000,
+    ):
+        self.openai_client = openai_client
+        self.chatgpt_model = chatgpt_model
+        self.summary_model = summary_model
+        self.summary_deployment = summary_deployment
+        self.token_threshold = token_threshold
+        self.keep_recent_messages = keep_recent_messages
+        self.summary_token_limit = summary_token_limit
+        self.timeout = timeout
+        self.max_summaries = max_summaries
+        # The summaries that haven't been picked up yet, and those being written, by the hash of the messages summarised
+        self.summaries: OrderedDict[str, str] = OrderedDict()
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    @classmethod
+    def hash_messages(cls, messages: list[ChatCompletionMessageParam]) -> str:
+        return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def get_summary(self, messages: list[ChatCompletionMessageParam], session_state: Any) -> Optional[dict[str, Any]]:
+        """Returns the summary in session_state, if it still summarises the start of these messages"""
+        if not isinstance(session_state, dict):
+            return None
+        summary = session_state.get("history_summary")
+        if not isinstance(summary, dict):
+            return None
+        message_count = summary.get("message_count", 0)
+        # The client may have started a new conversation or edited the history since the summary was written
+        if not 0 < message_count < len(messages) or summary.get("messages_hash") != self.hash_messages(
+            messages[:message_count]
+        ):
+            return None
+        return summary
+
+    def apply(self, messages: list[ChatCompletionMessageParam], session_state: Any) -> list[ChatCompletionMessageParam]:
+        """Replaces the summarised messages with the summary"""
+        summary = self.get_summary(messages, session_state)
+        if summary is None:
+            return messages
+        summary_message: ChatCompletionMessageParam = {
+            "role": "assistant",
+            "content": "Summary of the earlier conversation: " + summary["content"],
+        }
+        return [summary_message] + messages[summary["message_count"] :]
+
+    def needs_compaction(self, messages: list[ChatCompletionMessageParam], session_state: Any) -> bool:
+        if session_state is not None and not isinstance(session_state, dict):
+            # There's nowhere to keep the summary
+            return False
+        summary = self.get_summary(messages, session_state)
+        start = summary["message_count"] if summary else 0
+        if len(messages) - self.keep_recent_messages <= start:
+            return False
+        tokens = sum(count_tokens_for_message(self.chatgpt_model, message) for message in messages[start:])
+        return tokens > self.token_threshold
+
+    async def compact(self, messages: list[ChatCompletionMessageParam], session_state: Any) -> str:
+        """Summarises all but the most recent messages, merging in the summary in session_state"""
+        summary = self.get_summary(messages, session_state)
+        start = summary["message_count"] if summary else 0
+        end = len(messages) - self.keep_recent_messages
+        transcript = "\n".join(f"{message['role']}: {message.get('content')}" for message in messages[start:end])
+        if summary:
+            transcript = f"Previous summary: {summary['content']}\n\n{transcript}"
+
+        chat_completion = await self.openai_client.chat.completions.create(
+            # Azure OpenAI takes the deployment name as the model name
+            model=self.summary_deployment if self.summary_deployment else self.summary_model,
+            messages=[
+                {"role": "system", "content": self.summary_prompt},
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0,
+            max_tokens=self.summary_token_limit,
+            n=1,
+        )
+        return chat_completion.choices[0].message.content or ""
+
+    def resolve(self, session_state: Any) -> Any:
+        """Returns the session state with the summary that was written in the background, if it is finished"""
+        if not isinstance(session_state, dict) or not isinstance(session_state.get("pending_history_summary"), dict):
+            return session_state
+        pending = session_state["pending_history_summary"]
+        task = self.tasks.get(pending.get("messages_hash"))
+        if task is not None and not task.done():
+            # Still being written, so the previous summary is used for now
+            return session_state
+        session_state = {key: value for key, value in session_state.items() if key != "pending_history_summary"}
+        content = self.summaries.pop(pending.get("messages_hash"), None)
+        if content is None:
+            # Summarising failed, or the summary was written by another worker process
+            return session_state
+        return {
+            **session_state,
+            "history_summary": {
+                "content": content,
+                "message_count": pending["message_count"],
+                "messages_hash": pending["messages_hash"],
+            },
+        }
+
+    def start(
+        self, messages: list[ChatCompletionMessageParam], session_state: Any
+    ) -> tuple[Any, Optional[asyncio.Task]]:
+        """
+        Starts summarising in the background, if the conversation has grown past the threshold and no summary
+        is being written already. Returns the session state that says which summary is being written, and the task.
+        """
+        if isinstance(session_state, dict) and "pending_history_summary" in session_state:
+            return session_state, None
+        if not self.needs_compaction(messages, session_state):
+            return session_state, None
+        end = len(messages) - self.keep_recent_messages
+        messages_hash = self.hash_messages(messages[:end])
+        task = asyncio.create_task(self.summarise(messages_hash, messages, session_state))
+        self.tasks[messages_hash] = task
+        task.add_done_callback(lambda _: self.tasks.pop(messages_hash, None))
+        pending = {"message_count": end, "messages_hash": messages_hash}
+        return {**(session_state or {}), "pending_history_summary": pending}, task
+
+    async def summarise(self, messages_hash: str, messages: list[ChatCompletionMessageParam], session_state: Any):
+        try:
+            content = await asyncio.wait_for(self.compact(messages, session_state), timeout=self.timeout)
+        except Exception as error:
+            logger.warning("Unable to summarise the conversation history: %s", error)
+            return
+        self.summaries[messages_hash] = content
+        # Summaries that are never picked up, because the client went away, are dropped oldest first
+        while len(self.summaries) > self.max_summaries:
+            self.summaries.popitem(last=False)
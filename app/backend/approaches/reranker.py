@@ -0,0 +1,142 @@
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+import numpy as np
+
+from approaches.approach import Document
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+@dataclass
+class LocalReranker:
+    """
+    Reranks search results in-process, for deployments that can't use the semantic ranker.
+    Search over-fetches `candidates` results, which are rescored with BM25 and/or reordered
+    with maximal marginal relevance (MMR) over their embeddings, and the best `top` are kept.
+    """
+
+    top: int
+    candidates: int
+    use_mmr: bool = False
+    use_bm25: bool = False
+    # 1 only considers relevance, 0 only considers diversity
+    mmr_lambda: float = 0.5
+    # How much the BM25 score counts, compared to the search score
+    bm25_weight: float = 0.5
+    bm25_k1: float = 1.2
+    bm25_b: float = 0.75
+
+    @classmethod
+    def from_overrides(cls, overrides: dict[str, Any], top: int) -> Optional["LocalReranker"]:
+        use_mmr = bool(overrides.get("use_mmr"))
+        use_bm25 = bool(overrides.get("use_bm25"))
+        if not use_mmr and not use_bm25:
+            return None
+        return cls(
+            top=top,
+            candidates=max(int(overrides.get("rerank_candidates") or top * 3), top),
+            use_mmr=use_mmr,
+            use_bm25=use_bm25,
+            mmr_lambda=overrides.get("mmr_lambda", 0.5),
+        )
+
+    @property
+    def needs_embeddings(self) -> bool:
+        return self.use_mmr
+
+    def rerank(
+        self, documents: List[Document], query_text: Optional[str], query_vector: Optional[List[float]]
+    ) -> List[Document]:
+        if not documents:
+            return documents
+        embeddings = self.get_embeddings(documents) if self.use_mmr else None
+
+        if query_vector is not None and embeddings is not None:
+            relevance = normalize(embeddings @ unit_vector(np.asarray(query_vector, dtype=np.float32)))
+        else:
+            relevance = normalize(np.asarray([document.score or 0.0 for document in documents], dtype=np.float32))
+        if self.use_bm25 and query_text:
+            bm25 = normalize(self.bm25_scores(query_text, [document.content or "" for document in documents]))
+            relevance = (1 - self.bm25_weight) * relevance + self.bm25_weight * bm25
+
+        if embeddings is not None:
+            order = self.mmr(relevance, embeddings)
+        else:
+            order = np.argsort(-relevance, kind="stable")[: self.top].tolist()
+        return [documents[i] for i in order]
+
+    def mmr(self, relevance: np.ndarray, embeddings: np.ndarray) -> List[int]:
+        """Greedily picks the document that is most relevant and least similar to the ones already picked"""
+        similarity = embeddings @ embeddings.T
+        max_similarity = np.full(len(relevance), -np.inf, dtype=np.float32)
+        available = np.ones(len(relevance), dtype=bool)
+        selected: List[int] = []
+        for _ in range(min(self.top, len(relevance))):
+            # Nothing has been picked yet on the first pass, so only relevance counts
+            redundancy = np.where(np.isinf(max_similarity), 0.0, max_similarity)
+            scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            scores[~available] = -np.inf
+            chosen = int(np.argmax(scores))
+            selected.append(chosen)
+            available[chosen] = False
+            max_similarity = np.maximum(max_similarity, similarity[:, chosen])
+        return selected
+
+    def bm25_scores(self, query_text: str, texts: List[str]) -> np.ndarray:
+        """Scores the texts against the query with Okapi BM25, using the candidates as the corpus"""
+        query_terms = list(dict.fromkeys(WORD_PATTERN.findall(query_text.lower())))
+        if not query_terms:
+            return np.zeros(len(texts), dtype=np.float32)
+        term_counts = [Counter(WORD_PATTERN.findall(text.lower())) for text in texts]
+        # Rows are documents, columns are query terms
+        frequencies = np.asarray(
+            [[counts[term] for term in query_terms] for counts in term_counts], dtype=np.float32
+        ).reshape(len(texts), len(query_terms))
+        lengths = np.asarray([sum(counts.values()) for counts in term_counts], dtype=np.float32)
+        average_length = max(float(lengths.mean()), 1.0)
+
+        document_frequencies = (frequencies > 0).sum(axis=0)
+        idf = np.log(1 + (len(texts) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        length_norm = self.bm25_k1 * (1 - self.bm25_b + self.bm25_b * lengths / average_length)
+        return ((frequencies * (self.bm25_k1 + 1)) / (frequencies + length_norm[:, None]) * idf).sum(axis=1)
+
+    @classmethod
+    def get_embeddings(cls, documents: List[Document]) -> Optional[np.ndarray]:
+        """Returns the unit-length embeddings of the documents, or None if any of them wasn't retrieved"""
+        if any(not document.embedding for document in documents):
+            return None
+        embeddings = np.asarray([document.embedding for document in documents], dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms == 0, 1, norms)
+
+
+def unit_vector(vector: np.ndarray) -> np.ndarray:
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+def normalize(scores: np.ndarray) -> np.ndarray:
+    """Scales scores to [0, 1], so that scores from different sources can be combined"""
+    low, high = float(scores.min()), float(scores.max())
+    if high - low == 0:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Document]], top: int, k: int = 60) -> List[Document]:
+    """
+    Merges the results of several searches, scoring each document by the sum of 1 / (k + rank) over the lists it's in.
+    Documents found by several of the searches rank above those that only one search ranked highly.
+    """
+    scores: dict[Any, float] = {}
+    documents: dict[Any, Document] = {}
+    for results in result_lists:
+        for rank, document in enumerate(results, start=1):
+            key = document.id or id(document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            documents.setdefault(key, document)
+    ranked = sorted(scores, key=lambda key: scores[key], reverse=True)
+    return [documents[key] for key in ranked[:top]]
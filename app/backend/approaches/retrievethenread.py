@@ -1,12 +1,20 @@
-from typing import Any, Optional
+from typing import Any, AsyncGenerator, Coroutine, Literal, Optional, Union, overload
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
-from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageParam
+from openai import AsyncOpenAI, AsyncStream
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
+    ChatCompletionMessageParam,
+)
 from openai_messages_token_helper import build_messages, get_token_limit
+from openai_messages_token_helper.model_helper import encoding_for_model
 
 from approaches.approach import Approach, ThoughtStep
+from approaches.contextpacker import TYPICAL_SECTION_TOKENS, ContextPacker
+from approaches.deadline import EMBEDDING_SHARE, TEXT_ONLY_SEARCH, Deadline
+from approaches.reranker import LocalReranker
 from core.authentication import AuthenticationHelper
 
 
@@ -52,10 +60,12 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        stream_usage: bool = False,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.openai_client = openai_client
+        self.stream_usage = stream_usage
         self.auth_helper = auth_helper
         self.chatgpt_model = chatgpt_model
         self.embedding_model = embedding_model
@@ -67,6 +77,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.query_language = query_language
         self.query_speller = query_speller
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.context_packer = ContextPacker(encoding_for_model(chatgpt_model, default_to_cl100k=True))
 
     async def run(
         self,
@@ -74,6 +85,48 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         session_state: Any = None,
         context: dict[str, Any] = {},
     ) -> dict[str, Any]:
+        extra_info, chat_coroutine = await self.run_until_final_call(messages, context, should_stream=False)
+        chat_completion = await chat_coroutine
+        self.record_usage("answer", chat_completion.usage)
+        return {
+            "message": {
+                "content": chat_completion.choices[0].message.content,
+                "role": chat_completion.choices[0].message.role,
+            },
+            "context": extra_info,
+            "session_state": session_state,
+        }
+
+    async def run_stream(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        session_state: Any = None,
+        context: dict[str, Any] = {},
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        return self.stream_answer(self.run_until_final_call(messages, context, should_stream=True), session_state)
+
+    @overload
+    async def run_until_final_call(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+        should_stream: Literal[False],
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
+
+    @overload
+    async def run_until_final_call(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+        should_stream: Literal[True],
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
+
+    async def run_until_final_call(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+        should_stream: bool = False,
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         q = messages[-1]["content"]
         if not isinstance(q, str):
             raise ValueError("The most recent message content must be a string.")
@@ -84,18 +137,30 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         use_vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = True if overrides.get("semantic_ranker") else False
         use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top", 3)
+        top = int(overrides.get("top") or 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
         filter = self.build_filter(overrides, auth_claims)
+        deadline: Deadline = context.get("deadline") or Deadline()
+
+        # Only an explicit budget fetches more results than top, enough to fill it. By default, the sources get
+        # about as many tokens as top typical sections, and the packer keeps the best ones that fit
+        sources_token_budget = overrides.get("sources_token_budget")
+        candidates = self.context_packer.candidates(top, sources_token_budget)
+        if sources_token_budget is None:
+            sources_token_budget = top * TYPICAL_SECTION_TOKENS
 
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
         if use_vector_search:
-            vectors.append(await self.compute_text_embedding(q))
+            vector = await deadline.run(self.compute_text_embedding(q), EMBEDDING_SHARE, TEXT_ONLY_SEARCH)
+            if vector is None:
+                use_text_search, use_vector_search = True, False
+            else:
+                vectors.append(vector)
 
         results = await self.search(
-            top,
+            candidates,
             q,
             filter,
             vectors,
@@ -105,10 +170,18 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            LocalReranker.from_overrides(overrides, candidates),
+            deadline=deadline,
         )
 
-        # Process results
-        sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
+        # Remove repeated text from the results and keep the best ones that fit in the token budget
+        packed_sources = self.context_packer.pack(
+            results,
+            get_text=lambda doc: self.get_source_text(doc, use_semantic_captions),
+            get_citation=lambda doc: self.get_citation(doc.sourcepage or "", use_image_citation=False),
+            token_budget=sources_token_budget,
+        )
+        sources_content = packed_sources.sources_content
 
         # Append user message
         content = "\n".join(sources_content)
@@ -123,7 +196,7 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             max_tokens=self.chatgpt_token_limit - response_token_limit,
         )
 
-        chat_completion = await self.openai_client.chat.completions.create(
+        chat_coroutine = self.openai_client.chat.completions.create(
             # Azure OpenAI takes the deployment name as the model name
             model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
             messages=updated_messages,
@@ -131,10 +204,12 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             max_tokens=response_token_limit,
             n=1,
             seed=seed,
+            stream=should_stream,
+            **self.get_stream_options(should_stream),
         )
 
         data_points = {"text": sources_content}
-        extra_info = {
+        extra_info: dict[str, Any] = {
             "data_points": data_points,
             "thoughts": [
                 ThoughtStep(
@@ -153,6 +228,11 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                     "Search results",
                     [result.serialize_for_results() for result in results],
                 ),
+                ThoughtStep(
+                    "Sources packed into token budget",
+                    [doc.sourcepage for doc in packed_sources.documents],
+                    packed_sources.serialize_for_thoughts(),
+                ),
                 ThoughtStep(
                     "Prompt to generate answer",
                     [str(message) for message in updated_messages],
@@ -165,11 +245,11 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             ],
         }
 
-        return {
-            "message": {
-                "content": chat_completion.choices[0].message.content,
-                "role": chat_completion.choices[0].message.role,
-            },
-            "context": extra_info,
-            "session_state": session_state,
-        }
+        if deadline.degradations:
+            extra_info["thoughts"].append(
+                ThoughtStep(
+                    "Degraded to meet the request deadline", deadline.degradations, {"deadline": deadline.seconds}
+                )
+            )
+
+        return extra_info, chat_coroutine
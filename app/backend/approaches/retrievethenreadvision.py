@@ -1,9 +1,22 @@
-from typing import Any, Awaitable, Callable, Optional
+import asyncio
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Literal,
+    Optional,
+    Union,
+    overload,
+)
 
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import ContainerClient
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
     ChatCompletionContentPartImageParam,
     ChatCompletionContentPartParam,
     ChatCompletionMessageParam,
@@ -11,6 +24,14 @@ from openai.types.chat import (
 from openai_messages_token_helper import build_messages, get_token_limit
 
 from approaches.approach import Approach, ThoughtStep
+from approaches.deadline import (
+    EMBEDDING_SHARE,
+    IMAGES_SHARE,
+    OMITTED_IMAGES,
+    TEXT_ONLY_SEARCH,
+    Deadline,
+)
+from approaches.reranker import LocalReranker
 from core.authentication import AuthenticationHelper
 from core.imageshelper import fetch_image
 
@@ -49,11 +70,13 @@ class RetrieveThenReadVisionApproach(Approach):
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
-        vision_token_provider: Callable[[], Awaitable[str]]
+        vision_token_provider: Callable[[], Awaitable[str]],
+        stream_usage: bool = False,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
         self.openai_client = openai_client
+        self.stream_usage = stream_usage
         self.auth_helper = auth_helper
         self.embedding_model = embedding_model
         self.embedding_deployment = embedding_deployment
@@ -74,6 +97,48 @@ class RetrieveThenReadVisionApproach(Approach):
         session_state: Any = None,
         context: dict[str, Any] = {},
     ) -> dict[str, Any]:
+        extra_info, chat_coroutine = await self.run_until_final_call(messages, context, should_stream=False)
+        chat_completion = await chat_coroutine
+        self.record_usage("answer", chat_completion.usage)
+        return {
+            "message": {
+                "content": chat_completion.choices[0].message.content,
+                "role": chat_completion.choices[0].message.role,
+            },
+            "context": extra_info,
+            "session_state": session_state,
+        }
+
+    async def run_stream(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        session_state: Any = None,
+        context: dict[str, Any] = {},
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        return self.stream_answer(self.run_until_final_call(messages, context, should_stream=True), session_state)
+
+    @overload
+    async def run_until_final_call(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+        should_stream: Literal[False],
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
+
+    @overload
+    async def run_until_final_call(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+        should_stream: Literal[True],
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]: ...
+
+    async def run_until_final_call(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+        should_stream: bool = False,
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         q = messages[-1]["content"]
         if not isinstance(q, str):
             raise ValueError("The most recent message content must be a string.")
@@ -89,6 +154,7 @@ class RetrieveThenReadVisionApproach(Approach):
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
         filter = self.build_filter(overrides, auth_claims)
+        deadline: Deadline = context.get("deadline") or Deadline()
 
         vector_fields = overrides.get("vector_fields", ["embedding"])
         send_text_to_gptvision = overrides.get("gpt4v_input") in ["textAndImages", "texts", None]
@@ -97,13 +163,20 @@ class RetrieveThenReadVisionApproach(Approach):
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors = []
         if use_vector_search:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(q)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(q)
-                )
-                vectors.append(vector)
+            computed_vectors = await deadline.run(
+                asyncio.gather(
+                    *(
+                        self.compute_text_embedding(q) if field == "embedding" else self.compute_image_embedding(q)
+                        for field in vector_fields
+                    )
+                ),
+                EMBEDDING_SHARE,
+                TEXT_ONLY_SEARCH,
+            )
+            if computed_vectors is None:
+                use_text_search, use_vector_search = True, False
+            else:
+                vectors.extend(computed_vectors)
 
         results = await self.search(
             top,
@@ -116,6 +189,8 @@ class RetrieveThenReadVisionApproach(Approach):
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            LocalReranker.from_overrides(overrides, top),
+            deadline=deadline,
         )
 
         image_list: list[ChatCompletionContentPartImageParam] = []
@@ -128,8 +203,13 @@ class RetrieveThenReadVisionApproach(Approach):
             content = "\n".join(sources_content)
             user_content.append({"text": content, "type": "text"})
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
+            # Without the images, the answer is based on the text of the sources
+            urls = await deadline.run(
+                asyncio.gather(*(fetch_image(self.blob_container_client, result) for result in results)),
+                IMAGES_SHARE,
+                OMITTED_IMAGES,
+            )
+            for url in urls or []:
                 if url:
                     image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
@@ -141,13 +221,15 @@ class RetrieveThenReadVisionApproach(Approach):
             new_user_content=user_content,
             max_tokens=self.gpt4v_token_limit - response_token_limit,
         )
-        chat_completion = await self.openai_client.chat.completions.create(
+        chat_coroutine = self.openai_client.chat.completions.create(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
             messages=updated_messages,
             temperature=overrides.get("temperature", 0.3),
             max_tokens=response_token_limit,
             n=1,
             seed=seed,
+            stream=should_stream,
+            **self.get_stream_options(should_stream),
         )
 
         data_points = {
@@ -155,7 +237,7 @@ class RetrieveThenReadVisionApproach(Approach):
             "images": [d["image_url"] for d in image_list],
         }
 
-        extra_info = {
+        extra_info: dict[str, Any] = {
             "data_points": data_points,
             "thoughts": [
                 ThoughtStep(
@@ -187,11 +269,11 @@ class RetrieveThenReadVisionApproach(Approach):
             ],
         }
 
-        return {
-            "message": {
-                "content": chat_completion.choices[0].message.content,
-                "role": chat_completion.choices[0].message.role,
-            },
-            "context": extra_info,
-            "session_state": session_state,
-        }
+        if deadline.degradations:
+            extra_info["thoughts"].append(
+                ThoughtStep(
+                    "Degraded to meet the request deadline", deadline.degradations, {"deadline": deadline.seconds}
+                )
+            )
+
+        return extra_info, chat_coroutine
@@ -21,3 +21,9 @@ CONFIG_SPEECH_SERVICE_ID = "speech_service_id"
 CONFIG_SPEECH_SERVICE_LOCATION = "speech_service_location"
 CONFIG_SPEECH_SERVICE_TOKEN = "speech_service_token"
 CONFIG_SPEECH_SERVICE_VOICE = "speech_service_voice"
+CONFIG_STARTUP_TIMINGS = "startup_timings"
+CONFIG_CONVERSATION_STORE = "conversation_store"
+CONFIG_UPLOAD_QUEUE = "upload_queue"
+CONFIG_ADMISSION_CONTROLLER = "admission_controller"
+CONFIG_ALLOWED_ORIGIN = "allowed_origin"
+CONFIG_REQUEST_DEADLINE = "request_deadline"
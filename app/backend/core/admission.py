@@ -0,0 +1,117 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import AsyncIterator
+
+from core.metrics import metrics
+
+
+class Priority(IntEnum):
+    # The first turn of a streamed chat, which a user is waiting to see start
+    INTERACTIVE = 0
+    # Later turns of a streamed chat
+    CHAT = 1
+    # Requests that don't stream, such as those from evaluation and other scripts
+    BATCH = 2
+
+
+# AdmissionRejectedError is raised when a request can't start within the deadline of the admission queue,
+# or the queue is already full. Clients should retry after retry_after seconds.
+class AdmissionRejectedError(Exception):
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+
+    def __str__(self) -> str:
+        return "The server is busy, please try again later"
+
+
+class AdmissionController:
+    """
+    Limits how many requests each worker runs through the approaches at once, since each of them fans out
+    to OpenAI and AI Search, and admitting every request during a spike slows all of them down.
+    Requests beyond max_concurrent wait in a bounded queue, in order of priority and then arrival,
+    and are rejected if they can't start within max_wait seconds.
+    """
+
+    def __init__(self, max_concurrent: int = 16, max_waiting: int = 64, max_wait: float = 10.0):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting: list[tuple[int, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+
+    def reject(self, reason: str) -> AdmissionRejectedError:
+        metrics.increment("admission.rejected", attributes={"reason": reason})
+        return AdmissionRejectedError(retry_after=max(1, math.ceil(self.max_wait)))
+
+    async def acquire(self, priority: Priority):
+        if self.active < self.max_concurrent and not self.waiting:
+            self.active += 1
+            metrics.record("admission.wait_time", 0, attributes={"priority": priority.name})
+            return
+        if len(self.waiting) >= self.max_waiting:
+            raise self.reject("queue_full")
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.counter), future))
+        metrics.record("admission.queue_depth", len(self.waiting))
+        try:
+            await asyncio.wait_for(future, timeout=self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the wait ended, so pass it on
+                self.release()
+            else:
+                self.waiting = [entry for entry in self.waiting if entry[2] is not future]
+                heapq.heapify(self.waiting)
+            if isinstance(error, asyncio.TimeoutError):
+                raise self.reject("timeout")
+            raise
+        metrics.record("admission.wait_time", time.monotonic() - start, attributes={"priority": priority.name})
+
+    def release(self):
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                # The slot goes straight to the waiter, so active stays the same
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    async def slot(self, priority: Priority) -> "AdmissionSlot":
+        """Admits a request whose response outlives the handler that admitted it, such as a streamed answer"""
+        await self.acquire(priority)
+        return AdmissionSlot(self)
+
+    @asynccontextmanager
+    async def admit(self, priority: Priority) -> AsyncIterator[None]:
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class AdmissionSlot:
+    """
+    The admission of a request with a streamed response, which is released once the response has finished.
+    A response that is abandoned before it starts never runs its cleanup, so the slot is also released
+    when it is garbage collected, instead of being held for the rest of the process.
+    """
+
+    def __init__(self, controller: AdmissionController):
+        self.controller = controller
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release()
+
+    def __del__(self):
+        self.release()
@@ -359,3 +359,11 @@ class AuthenticationHelper:
             ) from jwt_claims_exc
         except Exception as exc:
             raise AuthError("Unable to parse authorization token.", 401) from exc
+
+    @staticmethod
+    def get_token_expiry(token: str) -> Optional[float]:
+        """Returns when a token that has already been validated expires, as a Unix timestamp"""
+        try:
+            return jwt.decode(token, options={"verify_signature": False}).get("exp")
+        except jwt.PyJWTError:
+            return None
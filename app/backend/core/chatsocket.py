@@ -0,0 +1,97 @@
+import asyncio
+import json
+from typing import Any, AsyncGenerator, Awaitable, Callable, Optional, Union
+
+from core.metrics import metrics
+
+# Idle connections get a heartbeat this often, so proxies don't close them and clients notice dropped ones
+HEARTBEAT_INTERVAL = 15.0
+# Events waiting to be sent, beyond which turns wait for the client to read, rather than buffering whole answers
+MAX_PENDING_EVENTS = 32
+# Turns that can stream at once over one connection
+MAX_TURNS = 4
+
+
+class ChatSocket:
+    """
+    Runs the turns of a chat over one websocket connection, which is authenticated when it opens.
+    A client message {"id": ..., "messages": [...], "context": {...}, "session_state": ...} starts a turn,
+    and {"id": ..., "cancel": true} cancels it. Each turn sends the same events as /chat/stream with the id of the turn,
+    followed by {"id": ..., "done": true}. Turns run concurrently, and their events share a bounded queue.
+    """
+
+    def __init__(
+        self,
+        receive: Callable[[], Awaitable[Any]],
+        send: Callable[[dict[str, Any]], Awaitable[None]],
+        start_turn: Callable[[dict[str, Any]], Awaitable[AsyncGenerator[dict[str, Any], None]]],
+        error_event: Callable[[Exception], dict[str, Any]],
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        max_pending_events: int = MAX_PENDING_EVENTS,
+        max_turns: int = MAX_TURNS,
+    ):
+        self.receive = receive
+        self.send = send
+        self.start_turn = start_turn
+        self.error_event = error_event
+        self.heartbeat_interval = heartbeat_interval
+        self.max_turns = max_turns
+        self.events: asyncio.Queue[dict[str, Any]] = asyncio.Queue(maxsize=max_pending_events)
+        self.turns: dict[Any, asyncio.Task] = {}
+
+    async def serve(self):
+        """Reads client messages until the connection closes, and then cancels the turns that are still running"""
+        writer = asyncio.create_task(self.write())
+        try:
+            while True:
+                await self.handle(await self.receive())
+        finally:
+            tasks = [*self.turns.values(), writer]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle(self, data: Union[str, bytes]):
+        try:
+            message = json.loads(data)
+            turn_id = message["id"]
+        except (ValueError, TypeError, KeyError):
+            await self.events.put({"error": "Messages must be JSON objects with an id"})
+            return
+        if message.get("cancel"):
+            if turn := self.turns.get(turn_id):
+                turn.cancel()
+            return
+        if turn_id in self.turns:
+            await self.events.put({"id": turn_id, "error": "A turn with this id is already running"})
+        elif len(self.turns) >= self.max_turns:
+            metrics.increment("chat.socket.rejected")
+            await self.events.put({"id": turn_id, "error": "Too many turns are running on this connection"})
+        else:
+            self.turns[turn_id] = asyncio.create_task(self.run_turn(turn_id, message))
+
+    async def run_turn(self, turn_id: Any, message: dict[str, Any]):
+        stream: Optional[AsyncGenerator[dict[str, Any], None]] = None
+        try:
+            stream = await self.start_turn(message)
+            async for event in stream:
+                # Waits while the queue is full, which holds back the answer until the client catches up
+                await self.events.put({"id": turn_id, **event})
+            await self.events.put({"id": turn_id, "done": True})
+        except asyncio.CancelledError:
+            metrics.increment("chat.stream.cancelled")
+            raise
+        except Exception as error:
+            await self.events.put({"id": turn_id, **self.error_event(error)})
+        finally:
+            if stream is not None:
+                await stream.aclose()
+            self.turns.pop(turn_id, None)
+
+    async def write(self):
+        while True:
+            try:
+                event = await asyncio.wait_for(self.events.get(), timeout=self.heartbeat_interval)
+            except asyncio.TimeoutError:
+                event = {"heartbeat": True}
+            await self.send(event)
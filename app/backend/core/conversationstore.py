@@ -0,0 +1,301 @@
+import json
+import logging
+import re
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+    ResourceNotModifiedError,
+)
+from azure.storage.blob.aio import ContainerClient
+from openai.types.chat import ChatCompletionMessageParam
+from openai_messages_token_helper import count_tokens_for_message
+
+if TYPE_CHECKING:
+    from approaches.approach import Document
+
+logger = logging.getLogger("conversationstore")
+
+CONVERSATION_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+# ConversationNotFoundError is raised when the client sends only the new messages of a conversation that has expired,
+# or was never stored. The client can send the whole conversation again to start a new one.
+class ConversationNotFoundError(Exception):
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+
+    def __str__(self) -> str:
+        return f"Conversation {self.conversation_id} not found"
+
+
+# ConversationConflictError is raised when another turn of a conversation was saved after this copy of it was loaded,
+# by another worker process or instance of the app. The turn that was saved first is kept.
+class ConversationConflictError(Exception):
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+
+    def __str__(self) -> str:
+        return f"Conversation {self.conversation_id} was changed by another turn"
+
+
+@dataclass
+class Conversation:
+    """
+    The messages of a conversation kept on the server, so that clients only send the new user message on each turn.
+    The token count of each message is stored next to it, so the history is never re-tokenized.
+    """
+
+    id: str
+    user_id: str
+    messages: list[ChatCompletionMessageParam] = field(default_factory=list)
+    token_counts: list[int] = field(default_factory=list)
+    updated_at: float = field(default_factory=time.time)
+    # Search results of recent turns, keyed by the search query and the overrides that affect it.
+    # They are only kept in memory, as they can always be fetched again.
+    retrievals: "OrderedDict[str, list[Document]]" = field(default_factory=OrderedDict)
+    # The version last loaded from or saved to the persistent tier, so that a stale copy is never saved over a newer one
+    etag: Optional[str] = None
+
+    def get_results(self, key: str) -> Optional[list["Document"]]:
+        return self.retrievals.get(key)
+
+    def add_results(self, key: str, results: list["Document"], max_retrievals: int = 3):
+        self.retrievals[key] = results
+        self.retrievals.move_to_end(key)
+        while len(self.retrievals) > max_retrievals:
+            self.retrievals.popitem(last=False)
+
+    def serialize(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "messages": self.messages,
+            "token_counts": self.token_counts,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def deserialize(cls, data: dict[str, Any]) -> "Conversation":
+        return cls(
+            id=data["id"],
+            user_id=data["user_id"],
+            messages=data["messages"],
+            token_counts=data["token_counts"],
+            updated_at=data["updated_at"],
+        )
+
+
+class ConversationPersistence(ABC):
+    """
+    A slower tier that keeps conversations across restarts and is shared by all the worker processes and app instances.
+    Each saved version of a conversation has an etag.
+    """
+
+    @abstractmethod
+    async def load(
+        self, conversation_id: str, etag: Optional[str] = None
+    ) -> Optional[tuple[Optional[dict[str, Any]], str]]:
+        """
+        Returns the conversation and its etag, or None if it doesn't exist.
+        If the conversation still has the given etag, it isn't downloaded again and is returned as None.
+        """
+
+    @abstractmethod
+    async def save(self, conversation_id: str, data: dict[str, Any], etag: Optional[str] = None) -> str:
+        """
+        Saves the conversation if it still has the given etag, or doesn't exist yet without one, and returns the new
+        etag. Raises ConversationConflictError otherwise.
+        """
+
+    @abstractmethod
+    async def delete(self, conversation_id: str):
+        pass
+
+
+class BlobConversationPersistence(ConversationPersistence):
+    """Keeps each conversation as a JSON blob in an Azure Storage container"""
+
+    def __init__(self, container_client: ContainerClient):
+        self.container_client = container_client
+
+    async def load(
+        self, conversation_id: str, etag: Optional[str] = None
+    ) -> Optional[tuple[Optional[dict[str, Any]], str]]:
+        try:
+            if etag:
+                try:
+                    downloader = await self.container_client.download_blob(
+                        f"{conversation_id}.json", etag=etag, match_condition=MatchConditions.IfModified
+                    )
+                except ResourceNotModifiedError:
+                    return None, etag
+            else:
+                downloader = await self.container_client.download_blob(f"{conversation_id}.json")
+        except ResourceNotFoundError:
+            return None
+        return json.loads(await downloader.readall()), downloader.properties.etag
+
+    async def save(self, conversation_id: str, data: dict[str, Any], etag: Optional[str] = None) -> str:
+        blob_client = self.container_client.get_blob_client(f"{conversation_id}.json")
+        try:
+            if etag:
+                result = await blob_client.upload_blob(
+                    json.dumps(data, ensure_ascii=False),
+                    overwrite=True,
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            else:
+                result = await blob_client.upload_blob(
+                    json.dumps(data, ensure_ascii=False), overwrite=True, match_condition=MatchConditions.IfMissing
+                )
+        except (ResourceModifiedError, ResourceExistsError) as error:
+            raise ConversationConflictError(conversation_id) from error
+        return result["etag"]
+
+    async def delete(self, conversation_id: str):
+        try:
+            await self.container_client.delete_blob(f"{conversation_id}.json")
+        except ResourceNotFoundError:
+            pass
+
+
+class ConversationStore:
+    """
+    Keeps recent conversations in memory, in least recently used order, and optionally writes them through
+    to a persistent tier. Conversations expire after ttl seconds without a new turn.
+    """
+
+    def __init__(
+        self,
+        *,
+        chatgpt_model: str,
+        persistence: Optional[ConversationPersistence] = None,
+        ttl: float = 3600,
+        max_conversations: int = 10000,
+        max_conversations_per_user: int = 20,
+        max_history_tokens: int = 8000,
+    ):
+        self.chatgpt_model = chatgpt_model
+        self.persistence = persistence
+        self.ttl = ttl
+        self.max_conversations = max_conversations
+        self.max_conversations_per_user = max_conversations_per_user
+        self.max_history_tokens = max_history_tokens
+        self.conversations: OrderedDict[str, Conversation] = OrderedDict()
+        self.user_conversations: dict[str, OrderedDict[str, None]] = {}
+
+    def is_expired(self, conversation: Conversation) -> bool:
+        return time.time() - conversation.updated_at > self.ttl
+
+    def remember(self, conversation: Conversation):
+        """Adds the conversation to the in-memory tier, evicting expired and least recently used ones"""
+        self.conversations[conversation.id] = conversation
+        self.conversations.move_to_end(conversation.id)
+        user_conversations = self.user_conversations.setdefault(conversation.user_id, OrderedDict())
+        user_conversations[conversation.id] = None
+        user_conversations.move_to_end(conversation.id)
+
+        # Conversations are ordered by their last turn, so the expired ones are at the start
+        while self.conversations:
+            oldest = next(iter(self.conversations.values()))
+            if not self.is_expired(oldest) and len(self.conversations) <= self.max_conversations:
+                break
+            self.forget(oldest.id)
+        # Without authentication, all users share the empty user id and only the global limit applies
+        if conversation.user_id:
+            while len(user_conversations) > self.max_conversations_per_user:
+                self.forget(next(iter(user_conversations)))
+
+    def forget(self, conversation_id: str):
+        conversation = self.conversations.pop(conversation_id, None)
+        if conversation is None:
+            return
+        user_conversations = self.user_conversations.get(conversation.user_id)
+        if user_conversations is not None:
+            user_conversations.pop(conversation_id, None)
+            if not user_conversations:
+                del self.user_conversations[conversation.user_id]
+
+    def create(self, user_id: str) -> Conversation:
+        # The conversation is only stored once its first turn is saved
+        return Conversation(id=uuid.uuid4().hex, user_id=user_id)
+
+    async def get(self, conversation_id: str, user_id: str) -> Optional[Conversation]:
+        """Returns the conversation if it exists, hasn't expired and belongs to this user"""
+        if not isinstance(conversation_id, str) or not CONVERSATION_ID_PATTERN.match(conversation_id):
+            return None
+        conversation = self.conversations.get(conversation_id)
+        loaded = False
+        if self.persistence:
+            # Another worker process or instance may have saved a newer turn, so the copy in memory is revalidated
+            try:
+                stored = await self.persistence.load(conversation_id, conversation.etag if conversation else None)
+            except Exception as error:
+                logger.warning("Unable to load conversation %s: %s", conversation_id, error)
+                stored = None
+            data, etag = stored or (None, None)
+            if data is not None:
+                stale = conversation
+                conversation = Conversation.deserialize(data)
+                conversation.etag = etag
+                if stale is not None:
+                    # The search results are still valid for the newer turns
+                    conversation.retrievals = stale.retrievals
+                loaded = True
+        if conversation is None or conversation.user_id != user_id:
+            return None
+        if self.is_expired(conversation):
+            self.forget(conversation_id)
+            if self.persistence:
+                try:
+                    await self.persistence.delete(conversation_id)
+                except Exception as error:
+                    logger.warning("Unable to delete conversation %s: %s", conversation_id, error)
+            return None
+        if loaded:
+            # Another worker process or instance saved it, or this one evicted it from memory
+            self.remember(conversation)
+        return conversation
+
+    def add_messages(self, conversation: Conversation, messages: list[ChatCompletionMessageParam]):
+        """Appends the messages with their token counts, dropping the oldest turns past max_history_tokens"""
+        for message in messages:
+            conversation.messages.append(message)
+            conversation.token_counts.append(count_tokens_for_message(self.chatgpt_model, message))
+        total_tokens = sum(conversation.token_counts)
+        drop = 0
+        # Always keep the most recent turn, and start the history with a user message
+        while drop < len(conversation.messages) - 2 and (
+            total_tokens > self.max_history_tokens or (drop and conversation.messages[drop]["role"] != "user")
+        ):
+            total_tokens -= conversation.token_counts[drop]
+            drop += 1
+        if drop:
+            del conversation.messages[:drop]
+            del conversation.token_counts[:drop]
+        conversation.updated_at = time.time()
+
+    async def save(self, conversation: Conversation):
+        self.remember(conversation)
+        if self.persistence:
+            try:
+                conversation.etag = await self.persistence.save(
+                    conversation.id, conversation.serialize(), conversation.etag
+                )
+            except ConversationConflictError as error:
+                # This copy is stale, so the next turn loads the one that was saved
+                logger.warning("Unable to save this turn: %s", error)
+                self.forget(conversation.id)
+            except Exception as error:
+                # The conversation is still available from memory on this instance
+                logger.warning("Unable to save conversation %s: %s", conversation.id, error)
@@ -0,0 +1,50 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+
+@dataclass
+class Measurements:
+    count: int = 0
+    total: float = 0
+    max: float = 0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    """
+    Counters and measurements of how requests are handled. They are kept in memory for each worker, and are also
+    sent to Azure Monitor when it is enabled. The OpenTelemetry packages are only imported then, see create_app.
+    """
+
+    def __init__(self):
+        self.counters: dict[str, float] = defaultdict(float)
+        self.measurements: dict[str, Measurements] = defaultdict(Measurements)
+        self.meter: Optional[Any] = None
+        self.instruments: dict[str, Any] = {}
+
+    def enable_opentelemetry(self):
+        from opentelemetry import metrics
+
+        self.meter = metrics.get_meter("app")
+
+    def increment(self, name: str, value: float = 1, attributes: Optional[dict[str, str]] = None):
+        self.counters[name] += value
+        if self.meter:
+            if name not in self.instruments:
+                self.instruments[name] = self.meter.create_counter(name)
+            self.instruments[name].add(value, attributes)
+
+    def record(self, name: str, value: float, attributes: Optional[dict[str, str]] = None):
+        self.measurements[name].add(value)
+        if self.meter:
+            if name not in self.instruments:
+                self.instruments[name] = self.meter.create_histogram(name)
+            self.instruments[name].record(value, attributes)
+
+
+metrics = Metrics()
@@ -0,0 +1,66 @@
+import mimetypes
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Optional
+
+from quart import Response, jsonify, request, send_file
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+# Vite puts a content hash in the names of the files under /assets, so a changed file always has a new URL
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Logos and icons keep their names, so browsers only reuse them for a day
+STATIC_MAX_AGE = 24 * 60 * 60
+
+# The Content-Encoding and file suffix of the precompressed copies written by the frontend build, best first
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+@lru_cache(maxsize=1024)
+def find_precompressed(path: Path) -> tuple[tuple[str, Path], ...]:
+    """Returns the precompressed copies of a static file. The static folder only changes on deployment."""
+    variants = []
+    for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+        variant = path.with_name(path.name + suffix)
+        if variant.is_file():
+            variants.append((encoding, variant))
+    return tuple(variants)
+
+
+async def send_static(
+    directory: Path, filename: str, max_age: Optional[int] = None, immutable: bool = False
+) -> Response:
+    """
+    Sends a static file, or its brotli or gzip copy if the client accepts it, so the app never compresses at request time.
+    Without a max_age, the browser has to revalidate the file with its ETag before using it again.
+    """
+    raw_path = safe_join(str(directory), filename)
+    if raw_path is None:
+        raise NotFound()
+    path = Path(raw_path)
+    if not path.is_file():
+        raise NotFound()
+    mimetype = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    variants = find_precompressed(path)
+    encoding, file_path = next(
+        ((encoding, variant) for encoding, variant in variants if request.accept_encodings[encoding]), (None, path)
+    )
+    # Each copy has its own ETag, as it is based on the file's name, size and modification time
+    response = await send_file(file_path, mimetype=mimetype, cache_timeout=max_age or 0, conditional=True)
+    if encoding:
+        response.content_encoding = encoding
+    if variants:
+        response.vary.add("Accept-Encoding")
+    if max_age is None:
+        response.cache_control.no_cache = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
+async def jsonify_with_etag(data: Any) -> Response:
+    """Returns the data as JSON with an ETag of its content, or a 304 if the client already has it"""
+    response = jsonify(data)
+    await response.add_etag()
+    response.cache_control.no_cache = True
+    return await response.make_conditional(request)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Awaitable, Callable, Optional
+
+from prepdocslib.filestrategy import UploadUserFileStrategy
+from prepdocslib.listfilestrategy import File
+
+logger = logging.getLogger("ingester")
+
+
+class UploadStatus(str, Enum):
+    QUEUED = "queued"
+    PROCESSING = "processing"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+@dataclass
+class UploadJob:
+    """A user's file that has been saved to the data lake, and is waiting to be ingested into the search index"""
+
+    user_oid: str
+    filename: str
+    # Opens the file for each attempt, so that a retry doesn't depend on the state left by a failed one
+    open_file: Callable[[], Awaitable[File]]
+    status: UploadStatus = UploadStatus.QUEUED
+    attempts: int = 0
+    error: Optional[str] = None
+    updated_at: float = field(default_factory=time.time)
+    # Releases whatever open_file reads from, once the job is finished or superseded
+    close: Optional[Callable[[], None]] = None
+
+    def set_status(self, status: UploadStatus, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        self.updated_at = time.time()
+
+    def serialize(self) -> dict[str, Any]:
+        return {
+            "filename": self.filename,
+            "status": self.status.value,
+            "attempts": self.attempts,
+            "error": self.error,
+        }
+
+
+class UploadQueue:
+    """
+    Ingests uploaded files in the background, so that the upload request returns as soon as the file is saved.
+    Each process runs a fixed number of workers, and at most max_size files can wait for them.
+    A file that fails to ingest is retried with exponential backoff, up to max_attempts times.
+    The jobs and their status are only kept in the memory of this worker process, so they are lost when it stops,
+    and other worker processes don't see them.
+    """
+
+    def __init__(
+        self,
+        ingester: UploadUserFileStrategy,
+        workers: int = 2,
+        max_size: int = 100,
+        max_attempts: int = 3,
+        retry_delay: float = 2.0,
+        status_ttl: float = 3600,
+    ):
+        self.ingester = ingester
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.status_ttl = status_ttl
+        self.queue: asyncio.Queue[UploadJob] = asyncio.Queue(maxsize=max_size)
+        # The latest job for each of the user's files, including finished ones until status_ttl has passed
+        self.jobs: dict[tuple[str, str], UploadJob] = {}
+        self.tasks: list[asyncio.Task] = []
+        # The task ingesting each job that a worker has taken from the queue
+        self.running: dict[asyncio.Task, UploadJob] = {}
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, job: UploadJob):
+        """Queues the job, raising asyncio.QueueFull if too many files are already waiting"""
+        self.queue.put_nowait(job)
+        # A job for an earlier upload of the same file is superseded by this one
+        self.jobs[(job.user_oid, job.filename)] = job
+
+    async def cancel(self, user_oid: str, filename: str):
+        """
+        Stops the file from being ingested, for example when it is deleted.
+        A queued job is skipped, and an ingestion already in progress is cancelled and waited for.
+        """
+        if job := self.jobs.pop((user_oid, filename), None):
+            job.set_status(UploadStatus.CANCELLED)
+        # Includes the jobs for earlier uploads of the file, which might still be in progress
+        tasks = [
+            task
+            for task, running in self.running.items()
+            if (running.user_oid, running.filename) == (user_oid, filename)
+        ]
+        for task in tasks:
+            self.running[task].set_status(UploadStatus.CANCELLED)
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def is_current(self, job: UploadJob) -> bool:
+        return self.jobs.get((job.user_oid, job.filename)) is job
+
+    def get_jobs(self, user_oid: str) -> list[UploadJob]:
+        now = time.time()
+        for key, job in list(self.jobs.items()):
+            if job.status in (UploadStatus.SUCCEEDED, UploadStatus.FAILED) and now - job.updated_at > self.status_ttl:
+                del self.jobs[key]
+        return [job for (oid, _), job in self.jobs.items() if oid == user_oid]
+
+    async def join(self):
+        await self.queue.join()
+
+    async def process(self, job: UploadJob):
+        while self.is_current(job):
+            job.attempts += 1
+            job.set_status(UploadStatus.PROCESSING)
+            try:
+                file = await job.open_file()
+                try:
+                    await self.ingester.add_file(file)
+                finally:
+                    file.close()
+                job.set_status(UploadStatus.SUCCEEDED)
+                logger.info("Ingested '%s' after %d attempt(s)", job.filename, job.attempts)
+                return
+            except Exception as error:
+                if job.attempts >= self.max_attempts:
+                    logger.exception("Failed to ingest '%s' after %d attempts", job.filename, job.attempts)
+                    job.set_status(UploadStatus.FAILED, str(error))
+                    return
+                logger.warning("Failed to ingest '%s', retrying: %s", job.filename, error)
+                job.set_status(UploadStatus.QUEUED, str(error))
+                await asyncio.sleep(self.retry_delay * 2 ** (job.attempts - 1))
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            task = asyncio.create_task(self.process(job))
+            self.running[task] = job
+            try:
+                await task
+            except asyncio.CancelledError:
+                # cancel() stops the job without stopping the worker
+                if job.status != UploadStatus.CANCELLED:
+                    raise
+            finally:
+                del self.running[task]
+                if job.close:
+                    job.close()
+                self.queue.task_done()
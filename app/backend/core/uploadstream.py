@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+import uuid
+from dataclasses import dataclass
+from typing import IO, AsyncIterable, Awaitable, Callable, Optional
+
+from azure.storage.filedatalake.aio import DataLakeFileClient
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    MultipartDecoder,
+    NeedData,
+)
+from werkzeug.sansio.multipart import File as FilePart
+
+# Data Lake appends are sent in blocks of this size, which bounds the memory used per upload
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+
+logger = logging.getLogger("uploadstream")
+
+# The name of a file that is still being uploaded, next to its final path
+PARTIAL_FILE_NAME = re.compile(r".+\.[0-9a-f]{32}\.partial")
+
+
+@dataclass
+class ReceivedFile:
+    """A file from a multipart request, stored in the data lake and copied to a local temporary file for parsing"""
+
+    filename: str
+    # Named after the uploaded file, in a temporary directory of its own
+    path: str
+    url: str
+    size: int
+    content_hash: str
+
+    def remove(self):
+        shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+
+
+def partial_file_name(filename: str) -> str:
+    return f"{filename}.{uuid.uuid4().hex}.partial"
+
+
+def is_partial_file(filename: str) -> bool:
+    return PARTIAL_FILE_NAME.fullmatch(filename) is not None
+
+
+async def receive_file(
+    body: AsyncIterable[bytes],
+    boundary: bytes,
+    field_name: str,
+    get_file_client: Callable[[str], Awaitable[DataLakeFileClient]],
+    metadata: dict[str, str],
+    block_size: int = UPLOAD_BLOCK_SIZE,
+) -> Optional[ReceivedFile]:
+    """
+    Streams the first file in the field_name part of a multipart body to the data lake, as it arrives,
+    without holding the whole file in memory. Returns None if the body has no such file.
+    """
+    decoder = MultipartDecoder(boundary)
+    received: Optional[ReceivedFile] = None
+    file_client: Optional[DataLakeFileClient] = None
+    local_file = None
+    content_hash = hashlib.sha256()
+    block = bytearray()
+    offset = 0
+    writing = False
+
+    async def append_block():
+        nonlocal offset
+        if block and file_client:
+            await file_client.append_data(bytes(block), offset=offset, length=len(block))  # type: ignore[misc]
+            offset += len(block)
+            block.clear()
+
+    try:
+        async for chunk in body:
+            decoder.receive_data(chunk)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, FilePart):
+                    # Browsers on Windows can send the whole path of the file, with backslashes
+                    filename = os.path.basename(event.filename.replace("\\", "/"))
+                    writing = event.name == field_name and received is None and file_client is None and filename != ""
+                    if writing:
+                        # The file is written next to its final path, so that an earlier upload of the file stays
+                        # intact until this one is complete
+                        file_client = await get_file_client(partial_file_name(filename))
+                        await file_client.create_file(metadata=metadata)  # type: ignore[misc]
+                        local_file = open(os.path.join(tempfile.mkdtemp(), filename), "wb")
+                elif isinstance(event, Data) and writing and file_client and local_file:
+                    content_hash.update(event.data)
+                    local_file.write(event.data)
+                    block.extend(event.data)
+                    if len(block) >= block_size:
+                        await append_block()
+                    if not event.more_data:
+                        await append_block()
+                        await file_client.flush_data(offset)  # type: ignore[misc]
+                        await file_client.set_metadata(  # type: ignore[misc]
+                            {**metadata, "ContentHash": content_hash.hexdigest()}
+                        )
+                        local_file.close()
+                        final_path = posixpath.join(posixpath.dirname(file_client.path_name), filename)
+                        renamed_client = await file_client.rename_file(f"{file_client.file_system_name}/{final_path}")
+                        received = ReceivedFile(
+                            filename=os.path.basename(local_file.name),
+                            path=local_file.name,
+                            url=renamed_client.url,
+                            size=offset,
+                            content_hash=content_hash.hexdigest(),
+                        )
+                        writing = False
+                event = decoder.next_event()
+    except BaseException:
+        await discard_partial_file(file_client, local_file, received)
+        raise
+    if received is None:
+        # The body ended before the file did
+        await discard_partial_file(file_client, local_file, received)
+    return received
+
+
+async def discard_partial_file(
+    file_client: Optional[DataLakeFileClient], local_file: Optional[IO], received: Optional[ReceivedFile]
+):
+    """
+    Removes the local copy and the partial data lake file of an upload that didn't finish.
+    Only the partial file that the upload created is deleted, never a file at its final path.
+    """
+    if local_file:
+        local_file.close()
+        shutil.rmtree(os.path.dirname(local_file.name), ignore_errors=True)
+    if file_client and received is None:
+        try:
+            await file_client.delete_file()  # type: ignore[misc]
+        except Exception:
+            logger.warning("Failed to delete the partially uploaded file %s", file_client.url, exc_info=True)
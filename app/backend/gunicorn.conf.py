@@ -1,3 +1,4 @@
+import gc
 import multiprocessing
 import os
 
@@ -16,3 +17,18 @@ if os.getenv("WEBSITE_SKU") == "LinuxFree":
 else:
     workers = (num_cpus * 2) + 1
 worker_class = "custom_uvicorn_worker.CustomUvicornWorker"
+
+# With preload_app, the app is imported once in the master process and the workers are forked from it,
+# so that modules and tokenizers are shared copy-on-write instead of being loaded by every worker.
+# Clients are still created per worker, as setup_clients only runs once a worker starts serving.
+preload_app = os.getenv("GUNICORN_PRELOAD_APP", "").lower() == "true"
+
+
+def when_ready(server):
+    if preload_app:
+        from app import preload_shared_state
+
+        preload_shared_state()
+        # Move everything loaded so far out of the GC's tracking, so that collections in the workers
+        # don't write to (and therefore copy) the shared pages
+        gc.freeze()
@@ -1,6 +1,7 @@
 import argparse
 import asyncio
 import logging
+import os
 from typing import Optional, Union
 
 from azure.core.credentials import AzureKeyCredential
@@ -8,11 +9,14 @@ from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential, get_bearer_token_provider
 
 from prepdocslib.blobmanager import BlobManager
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     ImageEmbeddings,
+    OpenAIEmbeddings,
     OpenAIEmbeddingService,
 )
+from prepdocslib.filemanifest import FileManifest
 from prepdocslib.fileprocessor import FileProcessor
 from prepdocslib.filestrategy import FileStrategy
 from prepdocslib.htmlparser import LocalHTMLParser
@@ -27,6 +31,7 @@ from prepdocslib.listfilestrategy import (
 )
 from prepdocslib.parser import Parser
 from prepdocslib.pdfparser import DocumentAnalysisParser, LocalPdfParser
+from prepdocslib.ratelimiter import RateLimiter
 from prepdocslib.strategy import DocumentAction, SearchInfo, Strategy
 from prepdocslib.textparser import TextParser
 from prepdocslib.textsplitter import SentenceTextSplitter, SimpleTextSplitter
@@ -83,6 +88,8 @@ def setup_list_file_strategy(
     datalake_filesystem: Union[str, None],
     datalake_path: Union[str, None],
     datalake_key: Union[str, None],
+    manifest_path: Optional[str] = None,
+    datalake_prefetch: int = 4,
 ):
     list_file_strategy: ListFileStrategy
     if datalake_storage_account:
@@ -95,10 +102,13 @@ def setup_list_file_strategy(
             data_lake_filesystem=datalake_filesystem,
             data_lake_path=datalake_path,
             credential=adls_gen2_creds,
+            prefetch=datalake_prefetch,
         )
     elif local_files:
         logger.info("Using local files: %s", local_files)
-        list_file_strategy = LocalListFileStrategy(path_pattern=local_files)
+        list_file_strategy = LocalListFileStrategy(
+            path_pattern=local_files, manifest=FileManifest(manifest_path) if manifest_path else None
+        )
     else:
         raise ValueError("Either local_files or datalake_storage_account must be provided.")
     return list_file_strategy
@@ -116,11 +126,27 @@ def setup_embeddings_service(
     openai_org: Union[str, None],
     disable_vectors: bool = False,
     disable_batch_vectors: bool = False,
+    batch_size: Optional[int] = None,
+    batch_token_limit: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+    requests_per_minute: Optional[int] = None,
+    max_concurrency: int = 4,
+    cache_directory: Optional[str] = None,
 ):
     if disable_vectors:
         logger.info("Not setting up embeddings service")
         return None
 
+    if requests_per_minute is None and tokens_per_minute and openai_host != "openai":
+        # Azure OpenAI grants 6 requests per minute for every 1000 tokens per minute of an embedding deployment
+        requests_per_minute = tokens_per_minute * 6 // 1000
+    rate_limiter = RateLimiter(
+        tokens_per_minute=tokens_per_minute,
+        requests_per_minute=requests_per_minute,
+        max_concurrency=max_concurrency,
+    )
+    cache = EmbeddingCache(cache_directory) if cache_directory else None
+
     if openai_host != "openai":
         azure_open_ai_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
             azure_credential if openai_key is None else AzureKeyCredential(openai_key)
@@ -133,6 +159,10 @@ def setup_embeddings_service(
             open_ai_dimensions=openai_dimensions,
             credential=azure_open_ai_credential,
             disable_batch=disable_batch_vectors,
+            max_batch_size=batch_size,
+            batch_token_limit=batch_token_limit,
+            rate_limiter=rate_limiter,
+            cache=cache,
         )
     else:
         if openai_key is None:
@@ -143,6 +173,10 @@ def setup_embeddings_service(
             credential=openai_key,
             organization=openai_org,
             disable_batch=disable_batch_vectors,
+            max_batch_size=batch_size,
+            batch_token_limit=batch_token_limit,
+            rate_limiter=rate_limiter,
+            cache=cache,
         )
 
 
@@ -208,11 +242,15 @@ def setup_image_embeddings_service(
     return image_embeddings_service
 
 
-async def main(strategy: Strategy, setup_index: bool = True):
-    if setup_index:
-        await strategy.setup()
+async def main(strategy: Strategy, setup_index: bool = True, embeddings: Optional[OpenAIEmbeddings] = None):
+    try:
+        if setup_index:
+            await strategy.setup()
 
-    await strategy.run()
+        await strategy.run()
+    finally:
+        if embeddings:
+            await embeddings.close()
 
 
 if __name__ == "__main__":
@@ -238,6 +276,13 @@ if __name__ == "__main__":
     parser.add_argument(
         "--datalakekey", required=False, help="Optional. Use this key when authenticating to Azure Data Lake Gen2"
     )
+    parser.add_argument(
+        "--datalakeprefetch",
+        required=False,
+        type=int,
+        default=4,
+        help="Optional. Number of files to download from Azure Data Lake Gen2 ahead of the one being processed",
+    )
     parser.add_argument(
         "--useacls", action="store_true", help="Store ACLs from Azure Data Lake Gen2 Filesystem in the search index"
     )
@@ -311,6 +356,43 @@ if __name__ == "__main__":
     parser.add_argument(
         "--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections"
     )
+    parser.add_argument(
+        "--openaibatchsize",
+        required=False,
+        type=int,
+        help="Optional. Number of sections to embed in each request, for deployments that accept more than the model's default of 16",
+    )
+    parser.add_argument(
+        "--openaibatchtokenlimit",
+        required=False,
+        type=int,
+        help="Optional. Number of tokens to embed in each request, instead of the model's default of 8100",
+    )
+    parser.add_argument(
+        "--openaitpm",
+        required=False,
+        type=int,
+        help="Optional. Tokens per minute quota of the embedding deployment, which the embedding requests are paced to stay within",
+    )
+    parser.add_argument(
+        "--openairpm",
+        required=False,
+        type=int,
+        help="Optional. Requests per minute quota of the embedding deployment (defaults to 6 per 1000 tokens per minute on Azure OpenAI)",
+    )
+    parser.add_argument(
+        "--openaiconcurrency",
+        required=False,
+        default=4,
+        type=int,
+        help="Optional. Number of embedding requests to send at once",
+    )
+
+    parser.add_argument(
+        "--embeddingcache",
+        required=False,
+        help="Optional. Directory of a cache of the computed embeddings, so that unchanged sections aren't embedded again on later runs",
+    )
 
     parser.add_argument(
         "--openaicustomurl",
@@ -369,6 +451,26 @@ if __name__ == "__main__":
         required=False,
         help="Required if --useintvectorization is specified. Enable Integrated vectorizer indexer support which is in preview)",
     )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        default=1,
+        type=int,
+        help="Optional. Number of files that each stage of ingestion (parse, upload, embed, index) works on at once",
+    )
+    for stage in ("parse", "upload", "embed", "index"):
+        parser.add_argument(
+            f"--{stage}workers",
+            required=False,
+            type=int,
+            help=f"Optional. Number of files that the {stage} stage works on at once, instead of --workers",
+        )
+    parser.add_argument(
+        "--manifest",
+        required=False,
+        default=os.path.join(".prepdocs", "manifest.sqlite"),
+        help="Optional. Database that records the local files that were ingested, so unchanged files are skipped on later runs",
+    )
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     args = parser.parse_args()
 
@@ -421,6 +523,8 @@ if __name__ == "__main__":
         datalake_filesystem=args.datalakefilesystem,
         datalake_path=args.datalakepath,
         datalake_key=clean_key_if_exists(args.datalakekey),
+        manifest_path=args.manifest,
+        datalake_prefetch=args.datalakeprefetch,
     )
     openai_embeddings_service = setup_embeddings_service(
         azure_credential=azd_credential,
@@ -434,6 +538,12 @@ if __name__ == "__main__":
         openai_org=args.openaiorg,
         disable_vectors=args.novectors,
         disable_batch_vectors=args.disablebatchvectors,
+        batch_size=args.openaibatchsize,
+        batch_token_limit=args.openaibatchtokenlimit,
+        tokens_per_minute=args.openaitpm,
+        requests_per_minute=args.openairpm,
+        max_concurrency=args.openaiconcurrency,
+        cache_directory=args.embeddingcache,
     )
 
     ingestion_strategy: Strategy
@@ -474,7 +584,17 @@ if __name__ == "__main__":
             search_analyzer_name=args.searchanalyzername,
             use_acls=args.useacls,
             category=args.category,
+            parse_workers=args.parseworkers or args.workers,
+            upload_workers=args.uploadworkers or args.workers,
+            embed_workers=args.embedworkers or args.workers,
+            index_workers=args.indexworkers or args.workers,
         )
 
-    loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
+    loop.run_until_complete(
+        main(
+            ingestion_strategy,
+            setup_index=not args.remove and not args.removeall,
+            embeddings=openai_embeddings_service,
+        )
+    )
     loop.close()
@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from collections.abc import Iterable, Sequence
+from itertools import groupby
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger("ingester")
+
+# SQLite limits the number of parameters in a query, so keys are looked up in chunks
+LOOKUP_CHUNK_SIZE = 500
+
+
+class EmbeddingCache:
+    """
+    Stores the embeddings computed during ingestion on disk, so that sections whose text hasn't changed
+    aren't embedded again the next time prepdocs runs. Each embedding is found by a hash of the model,
+    the dimensions and the text. The index lives in SQLite, and the vectors are appended as float32 rows
+    to a file per vector length, which is memory mapped for reading.
+    Replaced and unused vectors stay in the files until the cache is compacted, which writes new files.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (length INTEGER PRIMARY KEY, file TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0);
+            """)
+        self.mapped: dict[str, np.memmap] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, dimensions: Optional[int], text: str) -> str:
+        return hashlib.sha256(f"{model}\0{dimensions or ''}\0{text}".encode()).hexdigest()
+
+    def vectors(self, file: str, length: int, rows: int) -> np.memmap:
+        """Maps the vectors file, mapping it again if it has grown past the rows that were mapped before"""
+        mapped = self.mapped.get(file)
+        if mapped is None or len(mapped) < rows:
+            path = os.path.join(self.directory, file)
+            mapped = np.memmap(path, dtype=np.float32, mode="r", shape=(os.path.getsize(path) // (4 * length), length))
+            self.mapped[file] = mapped
+        return mapped
+
+    def vectors_file(self, length: int) -> str:
+        """Returns the file that new vectors of the length are appended to"""
+        if row := self.db.execute("SELECT file FROM files WHERE length = ?", (length,)).fetchone():
+            return row[0]
+        file = f"vectors-{length}-{uuid.uuid4().hex[:8]}.f32"
+        self.db.execute("INSERT INTO files VALUES (?, ?)", (length, file))
+        return file
+
+    def get(self, model: str, dimensions: Optional[int], texts: Sequence[str]) -> list[Optional[list[float]]]:
+        """Returns the cached embedding of each text, or None for the texts that haven't been embedded yet"""
+        keys = [self.key(model, dimensions, text) for text in texts]
+        found: dict[str, tuple[str, int, int]] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), LOOKUP_CHUNK_SIZE):
+            chunk = unique_keys[start : start + LOOKUP_CHUNK_SIZE]
+            rows = self.db.execute(
+                f"SELECT key, file, length, row FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            )
+            found.update((key, (file, length, row)) for key, file, length, row in rows)
+
+        embeddings: list[Optional[list[float]]] = []
+        for key in keys:
+            if location := found.get(key):
+                file, length, row = location
+                embeddings.append(self.vectors(file, length, row + 1)[row].tolist())
+            else:
+                embeddings.append(None)
+
+        hits = sum(embedding is not None for embedding in embeddings)
+        self.record(hits, len(texts) - hits)
+        with self.db:
+            self.db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?", ((time.time(), key) for key in found)
+            )
+        return embeddings
+
+    def put(self, model: str, dimensions: Optional[int], embeddings: Iterable[tuple[str, list[float]]]):
+        by_length: dict[int, list[tuple[str, list[float]]]] = {}
+        for text, embedding in embeddings:
+            by_length.setdefault(len(embedding), []).append((self.key(model, dimensions, text), embedding))
+
+        now = time.time()
+        with self.db:
+            for length, entries in by_length.items():
+                file = self.vectors_file(length)
+                # The vectors are written before the index refers to them, so an interrupted write can only leave
+                # vectors that nothing refers to, and part of a row at the end, which is cut off so that the new
+                # rows start at a row boundary
+                with open(os.path.join(self.directory, file), "ab") as vectors:
+                    first_row = vectors.tell() // (4 * length)
+                    vectors.truncate(first_row * 4 * length)
+                    vectors.write(np.asarray([embedding for _, embedding in entries], dtype=np.float32).tobytes())
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+                    ((key, file, length, first_row + offset, now) for offset, (key, _) in enumerate(entries)),
+                )
+
+    def record(self, hits: int, misses: int):
+        self.hits += hits
+        self.misses += misses
+        with self.db:
+            self.db.executemany(
+                "UPDATE stats SET value = value + ? WHERE name = ?", ((hits, "hits"), (misses, "misses"))
+            )
+
+    def vectors_bytes(self) -> int:
+        return sum(
+            os.path.getsize(os.path.join(self.directory, name))
+            for name in os.listdir(self.directory)
+            if name.startswith("vectors-")
+        )
+
+    def stats(self) -> dict[str, float]:
+        entries, live_bytes = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(4 * length), 0) FROM embeddings"
+        ).fetchone()
+        totals = dict(self.db.execute("SELECT name, value FROM stats").fetchall())
+        lookups = totals["hits"] + totals["misses"]
+        vectors_bytes = self.vectors_bytes()
+        return {
+            "entries": entries,
+            "vectors_bytes": vectors_bytes,
+            "reclaimable_bytes": vectors_bytes - live_bytes,
+            "index_bytes": os.path.getsize(os.path.join(self.directory, "index.sqlite")),
+            "hits": totals["hits"],
+            "misses": totals["misses"],
+            "hit_rate": totals["hits"] / lookups if lookups else 0.0,
+        }
+
+    def compact(self, max_age_days: Optional[float] = None) -> int:
+        """
+        Copies the vectors that the index refers to into new files, after dropping the entries that haven't
+        been used for max_age_days, and then deletes the old files. Returns the number of bytes freed.
+        """
+        before = self.vectors_bytes()
+        # The old files are deleted, so they can't stay mapped
+        self.mapped.clear()
+        with self.db:
+            if max_age_days is not None:
+                self.db.execute(
+                    "DELETE FROM embeddings WHERE last_used < ?", (time.time() - max_age_days * 24 * 60 * 60,)
+                )
+            self.db.execute("DELETE FROM files")
+            lengths = [length for (length,) in self.db.execute("SELECT DISTINCT length FROM embeddings").fetchall()]
+            for length in lengths:
+                new_file = self.vectors_file(length)
+                entries = self.db.execute(
+                    "SELECT key, file, row FROM embeddings WHERE length = ? ORDER BY file, row", (length,)
+                ).fetchall()
+                with open(os.path.join(self.directory, new_file), "wb") as vectors:
+                    for file, file_entries in groupby(entries, key=lambda entry: entry[1]):
+                        rows = [row for _, _, row in file_entries]
+                        vectors.write(self.vectors(file, length, rows[-1] + 1)[rows].tobytes())
+                self.mapped.clear()
+                self.db.executemany(
+                    "UPDATE embeddings SET file = ?, row = ? WHERE key = ?",
+                    ((new_file, new_row, key) for new_row, (key, _, _) in enumerate(entries)),
+                )
+        # The index only refers to the new files once they are complete, so an interrupted compaction just leaves
+        # files that nothing refers to, which are deleted by the next one
+        live_files = {file for (file,) in self.db.execute("SELECT file FROM files").fetchall()}
+        for name in os.listdir(self.directory):
+            if name.startswith("vectors-") and name not in live_files:
+                os.remove(os.path.join(self.directory, name))
+        self.db.execute("VACUUM")
+        freed = before - self.vectors_bytes()
+        logger.info("Compacted the embedding cache, freeing %d bytes", freed)
+        return freed
+
+    def close(self):
+        if self.hits or self.misses:
+            logger.info(
+                "Embedding cache: %d hits, %d misses (%.0f%% hit rate)",
+                self.hits,
+                self.misses,
+                100 * self.hits / (self.hits + self.misses),
+            )
+        self.mapped.clear()
+        self.db.close()
@@ -1,5 +1,7 @@
+import asyncio
 import logging
 from abc import ABC
+from functools import lru_cache
 from typing import Awaitable, Callable, List, Optional, Union
 from urllib.parse import urljoin
 
@@ -17,9 +19,21 @@ from tenacity import (
 )
 from typing_extensions import TypedDict
 
+from .embeddingcache import EmbeddingCache
+from .ratelimiter import RateLimiter, retry_after
+
 logger = logging.getLogger("ingester")
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Loads the tokenizer of the model once per process, falling back to the one shared by the embedding models"""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 class EmbeddingBatch:
     """
     Represents a batch of text that is going to be embedded
@@ -51,20 +65,60 @@ class OpenAIEmbeddings(ABC):
         "text-embedding-3-large": True,
     }
 
-    def __init__(self, open_ai_model_name: str, open_ai_dimensions: int, disable_batch: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        open_ai_dimensions: int,
+        disable_batch: bool = False,
+        max_batch_size: Optional[int] = None,
+        batch_token_limit: Optional[int] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[EmbeddingCache] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
         self.open_ai_dimensions = open_ai_dimensions
         self.disable_batch = disable_batch
+        # Override the defaults of the model, for deployments that accept more inputs or tokens per request
+        self.max_batch_size = max_batch_size
+        self.batch_token_limit = batch_token_limit
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.client: Optional[AsyncOpenAI] = None
+        self.cache = cache
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
 
+    async def get_client(self) -> AsyncOpenAI:
+        """Returns the client shared by every call, so they reuse its connections and credentials"""
+        if self.client is None:
+            self.client = await self.create_client()
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def wait_before_retry(self, retry_state) -> float:
+        hint = retry_after(retry_state.outcome.exception())
+        if hint is not None:
+            return hint
+        return wait_random_exponential(min=15, max=60)(retry_state)
+
     def before_retry_sleep(self, retry_state):
         logger.info("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
+        if retry_after(retry_state.outcome.exception()) is not None:
+            # The whole deployment is over its quota, so hold back the other batches too
+            self.rate_limiter.pause(retry_state.next_action.sleep)
+
+    def calculate_token_length(self, text: str) -> int:
+        return len(get_encoding(self.open_ai_model_name).encode_ordinary(text))
 
-    def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+    def calculate_token_lengths(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in get_encoding(self.open_ai_model_name).encode_ordinary_batch(texts)]
 
     def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
@@ -73,13 +127,12 @@ class OpenAIEmbeddings(ABC):
                 f"Model {self.open_ai_model_name} is not supported with batch embedding operations"
             )
 
-        batch_token_limit = batch_info["token_limit"]
-        batch_max_size = batch_info["max_batch_size"]
+        batch_token_limit = self.batch_token_limit or batch_info["token_limit"]
+        batch_max_size = self.max_batch_size or batch_info["max_batch_size"]
         batches: List[EmbeddingBatch] = []
         batch: List[str] = []
         batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
+        for text, text_token_length in zip(texts, self.calculate_token_lengths(texts)):
             if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
                 batches.append(EmbeddingBatch(batch, batch_token_length))
                 batch = []
@@ -99,40 +152,52 @@ class OpenAIEmbeddings(ABC):
 
     async def create_embedding_batch(self, texts: List[str], dimensions_args: ExtraArgs) -> List[List[float]]:
         batches = self.split_text_into_batches(texts)
-        embeddings = []
-        client = await self.create_client()
-        for batch in batches:
+        client = await self.get_client()
+
+        async def embed_batch(batch: EmbeddingBatch) -> List[List[float]]:
             async for attempt in AsyncRetrying(
                 retry=retry_if_exception_type(RateLimitError),
-                wait=wait_random_exponential(min=15, max=60),
+                wait=self.wait_before_retry,
                 stop=stop_after_attempt(15),
                 before_sleep=self.before_retry_sleep,
             ):
                 with attempt:
-                    emb_response = await client.embeddings.create(
-                        model=self.open_ai_model_name, input=batch.texts, **dimensions_args
-                    )
-                    embeddings.extend([data.embedding for data in emb_response.data])
-                    logger.info(
-                        "Computed embeddings in batch. Batch size: %d, Token count: %d",
-                        len(batch.texts),
-                        batch.token_length,
-                    )
-
-        return embeddings
+                    async with self.rate_limiter.limit(batch.token_length):
+                        emb_response = await client.embeddings.create(
+                            model=self.open_ai_model_name, input=batch.texts, **dimensions_args
+                        )
+            logger.info(
+                "Computed embeddings in batch. Batch size: %d, Token count: %d",
+                len(batch.texts),
+                batch.token_length,
+            )
+            return [data.embedding for data in emb_response.data]
+
+        # The batches run concurrently within the quota of the deployment, and gather keeps them in order
+        tasks = [asyncio.create_task(embed_batch(batch)) for batch in batches]
+        try:
+            batch_embeddings = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return [embedding for embeddings in batch_embeddings for embedding in embeddings]
 
     async def create_embedding_single(self, text: str, dimensions_args: ExtraArgs) -> List[float]:
-        client = await self.create_client()
+        client = await self.get_client()
+        token_length = self.calculate_token_length(text)
         async for attempt in AsyncRetrying(
             retry=retry_if_exception_type(RateLimitError),
-            wait=wait_random_exponential(min=15, max=60),
+            wait=self.wait_before_retry,
             stop=stop_after_attempt(15),
             before_sleep=self.before_retry_sleep,
         ):
             with attempt:
-                emb_response = await client.embeddings.create(
-                    model=self.open_ai_model_name, input=text, **dimensions_args
-                )
+                async with self.rate_limiter.limit(token_length):
+                    emb_response = await client.embeddings.create(
+                        model=self.open_ai_model_name, input=text, **dimensions_args
+                    )
                 logger.info("Computed embedding for text section. Character count: %d", len(text))
 
         return emb_response.data[0].embedding
@@ -145,6 +210,20 @@ class OpenAIEmbeddings(ABC):
             else {}
         )
 
+        if self.cache is None:
+            return await self.compute_embeddings(texts, dimensions_args)
+
+        dimensions = dimensions_args.get("dimensions")
+        cached = self.cache.get(self.open_ai_model_name, dimensions, texts)
+        # Only the texts that aren't cached are embedded, once each
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, cached) if embedding is None))
+        computed: dict[str, List[float]] = {}
+        if missing:
+            computed = dict(zip(missing, await self.compute_embeddings(missing, dimensions_args)))
+            self.cache.put(self.open_ai_model_name, dimensions, computed.items())
+        return [computed[text] if embedding is None else embedding for text, embedding in zip(texts, cached)]
+
+    async def compute_embeddings(self, texts: List[str], dimensions_args: ExtraArgs) -> List[List[float]]:
         if not self.disable_batch and self.open_ai_model_name in OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL:
             return await self.create_embedding_batch(texts, dimensions_args)
 
@@ -166,8 +245,20 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         open_ai_custom_url: Union[str, None] = None,
         disable_batch: bool = False,
+        max_batch_size: Optional[int] = None,
+        batch_token_limit: Optional[int] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[EmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(
+            open_ai_model_name,
+            open_ai_dimensions,
+            disable_batch,
+            max_batch_size,
+            batch_token_limit,
+            rate_limiter,
+            cache,
+        )
         self.open_ai_service = open_ai_service
         if open_ai_service:
             self.open_ai_endpoint = f"https://{open_ai_service}.openai.azure.com"
@@ -214,8 +305,20 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         credential: str,
         organization: Optional[str] = None,
         disable_batch: bool = False,
+        max_batch_size: Optional[int] = None,
+        batch_token_limit: Optional[int] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[EmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(
+            open_ai_model_name,
+            open_ai_dimensions,
+            disable_batch,
+            max_batch_size,
+            batch_token_limit,
+            rate_limiter,
+            cache,
+        )
         self.credential = credential
         self.organization = organization
 
@@ -0,0 +1,46 @@
+import os
+import sqlite3
+from typing import NamedTuple, Optional
+
+
+class ManifestEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    # The MD5 of the content, which matches the hashes in the .md5 files that earlier versions wrote next to each file
+    md5: str
+
+
+class FileManifest:
+    """
+    Records the size, modification time and hash of each local file that has been ingested, in one SQLite database,
+    so that later runs can skip the files that haven't changed. The paths are stored as absolute paths.
+    """
+
+    def __init__(self, path: str):
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT)"
+        )
+
+    def get(self, path: str) -> Optional[ManifestEntry]:
+        row = self.db.execute(
+            "SELECT size, mtime_ns, md5 FROM files WHERE path = ?", (os.path.abspath(path),)
+        ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def put(self, path: str, entry: ManifestEntry):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (os.path.abspath(path), *entry))
+
+    def remove(self, path: Optional[str] = None):
+        """Forgets the file, or every file without a path"""
+        with self.db:
+            if path is None:
+                self.db.execute("DELETE FROM files")
+            else:
+                self.db.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(path),))
+
+    def close(self):
+        self.db.close()
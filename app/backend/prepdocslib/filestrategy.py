@@ -1,10 +1,13 @@
+import hashlib
 import logging
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import Any, List, Optional
 
 from .blobmanager import BlobManager
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
 from .fileprocessor import FileProcessor
 from .listfilestrategy import File, ListFileStrategy
+from .pipeline import PipelineStage, run_pipeline
 from .searchmanager import SearchManager, Section
 from .strategy import DocumentAction, SearchInfo, Strategy
 
@@ -33,6 +36,22 @@ async def parse_file(
     return sections
 
 
+@dataclass
+class FileIngestion:
+    """A file on its way through the stages of FileStrategy.run, with the results of the stages so far"""
+
+    file: File
+    sections: Optional[List[Section]] = None
+    image_embeddings: Optional[List[List[float]]] = None
+    # The ids of the sections, once the sections are narrowed down to the ones that aren't in the index yet
+    section_ids: Optional[List[str]] = None
+    # The sections of an earlier version of the file that are no longer in it
+    stale_section_ids: Optional[List[str]] = None
+    # The unchanged sections whose other fields changed, such as the access control, which are merged without embedding
+    updated_documents: Optional[List[dict[str, Any]]] = None
+    text_embeddings: Optional[List[List[float]]] = None
+
+
 class FileStrategy(Strategy):
     """
     Strategy for ingesting documents into a search service from files stored either locally or in a data lake storage account
@@ -50,6 +69,11 @@ class FileStrategy(Strategy):
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        parse_workers: int = 1,
+        upload_workers: int = 1,
+        embed_workers: int = 1,
+        index_workers: int = 1,
+        queue_size: int = 4,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -61,6 +85,12 @@ class FileStrategy(Strategy):
         self.search_info = search_info
         self.use_acls = use_acls
         self.category = category
+        self.parse_workers = parse_workers
+        self.upload_workers = upload_workers
+        self.embed_workers = embed_workers
+        self.index_workers = index_workers
+        # Files waiting between two stages, which bounds how many files are held in memory at once
+        self.queue_size = queue_size
 
     async def setup(self):
         search_manager = SearchManager(
@@ -78,27 +108,108 @@ class FileStrategy(Strategy):
             self.search_info, self.search_analyzer_name, self.use_acls, False, self.embeddings
         )
         if self.document_action == DocumentAction.Add:
-            files = self.list_file_strategy.list()
-            async for file in files:
-                try:
-                    sections = await parse_file(file, self.file_processors, self.category, self.image_embeddings)
-                    if sections:
-                        blob_sas_uris = await self.blob_manager.upload_blob(file)
-                        blob_image_embeddings: Optional[List[List[float]]] = None
-                        if self.image_embeddings and blob_sas_uris:
-                            blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
-                        await search_manager.update_content(sections, blob_image_embeddings, url=file.url)
-                finally:
-                    if file:
-                        file.close()
+
+            async def parse(ingestion: FileIngestion) -> Optional[FileIngestion]:
+                ingestion.sections = await parse_file(
+                    ingestion.file, self.file_processors, self.category, self.image_embeddings
+                )
+                if not ingestion.sections:
+                    self.list_file_strategy.mark_ingested(ingestion.file)
+                    return None
+                return ingestion
+
+            async def upload(ingestion: FileIngestion) -> FileIngestion:
+                blob_sas_uris = await self.blob_manager.upload_blob(ingestion.file)
+                if self.image_embeddings and blob_sas_uris:
+                    ingestion.image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
+                return ingestion
+
+            async def embed(ingestion: FileIngestion) -> FileIngestion:
+                # Sections are indexed under ids derived from their text, so only the ones whose text changed since
+                # the file was last indexed need to be embedded and uploaded
+                sections = ingestion.sections or []
+                documents = search_manager.create_documents(
+                    sections, ingestion.image_embeddings, url=ingestion.file.url
+                )
+                section_ids = search_manager.section_ids(ingestion.file, sections)
+                metadata = [search_manager.section_metadata(document) for document in documents]
+                indexed = await search_manager.get_indexed_sections(
+                    ingestion.file, fields=sorted({field for fields in metadata for field in fields})
+                )
+                changed = [i for i, section_id in enumerate(section_ids) if section_id not in indexed]
+                ingestion.sections = [sections[i] for i in changed]
+                ingestion.section_ids = [section_ids[i] for i in changed]
+                ingestion.stale_section_ids = sorted(set(indexed).difference(section_ids))
+                ingestion.updated_documents = []
+                for i, section_id in enumerate(section_ids):
+                    # A field that was never set, such as the access control of a file without any, reads back as null
+                    if section_id in indexed and any(
+                        (indexed[section_id].get(field) or None) != (value or None)
+                        for field, value in metadata[i].items()
+                    ):
+                        update = {"id": section_id, **metadata[i]}
+                        if ingestion.image_embeddings:
+                            # The section may have moved to another page
+                            update["imageEmbedding"] = ingestion.image_embeddings[sections[i].split_page.page_num]
+                        ingestion.updated_documents.append(update)
+                logger.info(
+                    "'%s' has %d new or changed sections, %d unchanged, of which %d with new metadata, and %d removed",
+                    ingestion.file.filename(),
+                    len(changed),
+                    len(sections) - len(changed),
+                    len(ingestion.updated_documents),
+                    len(ingestion.stale_section_ids),
+                )
+                if self.embeddings and ingestion.sections:
+                    ingestion.text_embeddings = await self.embeddings.create_embeddings(
+                        texts=[section.split_page.text for section in ingestion.sections]
+                    )
+                return ingestion
+
+            async def index(ingestion: FileIngestion) -> FileIngestion:
+                if ingestion.sections:
+                    await search_manager.update_content(
+                        ingestion.sections,
+                        ingestion.image_embeddings,
+                        url=ingestion.file.url,
+                        text_embeddings=ingestion.text_embeddings,
+                        ids=ingestion.section_ids,
+                    )
+                if ingestion.updated_documents:
+                    await search_manager.merge_sections(ingestion.updated_documents)
+                # The stale sections are removed after the new ones are added, so the file is always searchable
+                if ingestion.stale_section_ids:
+                    await search_manager.remove_sections(ingestion.stale_section_ids)
+                self.list_file_strategy.mark_ingested(ingestion.file)
+                return ingestion
+
+            async def list_files():
+                async for file in self.list_file_strategy.list():
+                    yield FileIngestion(file)
+
+            # Each file moves on to the next stage as soon as it's done, so parsing, uploading, embedding and indexing
+            # overlap across files, instead of the network and CPU waiting for each other
+            await run_pipeline(
+                list_files(),
+                [
+                    PipelineStage("parse", parse, self.parse_workers),
+                    PipelineStage("upload", upload, self.upload_workers),
+                    PipelineStage("embed", embed, self.embed_workers),
+                    PipelineStage("index", index, self.index_workers),
+                ],
+                discard=lambda ingestion: ingestion.file.close(),
+                queue_size=self.queue_size,
+            )
         elif self.document_action == DocumentAction.Remove:
             paths = self.list_file_strategy.list_paths()
             async for path in paths:
                 await self.blob_manager.remove_blob(path)
                 await search_manager.remove_content(path)
+                self.list_file_strategy.mark_removed(path)
         elif self.document_action == DocumentAction.RemoveAll:
             await self.blob_manager.remove_blob()
             await search_manager.remove_content()
+            self.list_file_strategy.mark_removed()
 
 
 class UploadUserFileStrategy:
@@ -112,19 +223,42 @@ class UploadUserFileStrategy:
         file_processors: dict[str, FileProcessor],
         embeddings: Optional[OpenAIEmbeddings] = None,
         image_embeddings: Optional[ImageEmbeddings] = None,
+        deduplicate: bool = False,
     ):
         self.file_processors = file_processors
         self.embeddings = embeddings
         self.image_embeddings = image_embeddings
         self.search_info = search_info
         self.search_manager = SearchManager(self.search_info, None, True, False, self.embeddings)
+        # Requires the contentHash field in the search index
+        self.deduplicate = deduplicate
 
     async def add_file(self, file: File):
         if self.image_embeddings:
             logging.warning("Image embeddings are not currently supported for the user upload feature")
-        sections = await parse_file(file, self.file_processors)
-        if sections:
-            await self.search_manager.update_content(sections, url=file.url)
+        # The user's earlier upload of the file, whose sections are replaced
+        indexed = await self.search_manager.get_indexed_sections(file)
+        content_hash = None
+        ids = None
+        if self.deduplicate:
+            content_hash = file.content_hash or self.hash_content(file)
+            # Many users upload the same documents, which don't need to be parsed and embedded again
+            ids = await self.search_manager.copy_content(file, content_hash)
+        if ids is None:
+            sections = await parse_file(file, self.file_processors)
+            ids = self.search_manager.section_ids(file, sections)
+            if sections:
+                await self.search_manager.update_content(sections, url=file.url, content_hash=content_hash, ids=ids)
+        if stale_ids := sorted(set(indexed).difference(ids)):
+            await self.search_manager.remove_sections(stale_ids)
+
+    @staticmethod
+    def hash_content(file: File) -> str:
+        content_hash = hashlib.sha256()
+        for block in iter(lambda: file.content.read(1024 * 1024), b""):
+            content_hash.update(block)
+        file.content.seek(0)
+        return content_hash.hexdigest()
 
     async def remove_file(self, filename: str, oid: str):
         if filename is None or filename == "":
@@ -1,18 +1,25 @@
+import asyncio
 import base64
 import hashlib
 import logging
 import os
 import re
+import shutil
 import tempfile
 from abc import ABC
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from typing import IO, AsyncGenerator, Dict, List, Optional, Union
+from typing import IO, AsyncGenerator, Dict, Iterator, List, Optional, Union
 
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.storage.filedatalake.aio import (
+    DataLakeFileClient,
     DataLakeServiceClient,
 )
 
+from .filemanifest import FileManifest, ManifestEntry
+
 logger = logging.getLogger("ingester")
 
 
@@ -22,10 +29,18 @@ class File:
     This file might contain access control information about which users or groups can access it
     """
 
-    def __init__(self, content: IO, acls: Optional[dict[str, list]] = None, url: Optional[str] = None):
+    def __init__(
+        self,
+        content: IO,
+        acls: Optional[dict[str, list]] = None,
+        url: Optional[str] = None,
+        content_hash: Optional[str] = None,
+    ):
         self.content = content
         self.acls = acls or {}
         self.url = url
+        # The SHA-256 of the content, if it was computed when the file was received
+        self.content_hash = content_hash
 
     def filename(self):
         return os.path.basename(self.content.name)
@@ -33,14 +48,19 @@ class File:
     def file_extension(self):
         return os.path.splitext(self.content.name)[1]
 
-    def filename_to_id(self):
+    def filename_to_id(self, include_acls: bool = True):
         filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", self.filename())
         filename_hash = base64.b16encode(self.filename().encode("utf-8")).decode("ascii")
         acls_hash = ""
-        if self.acls:
+        if self.acls and include_acls:
             acls_hash = base64.b16encode(str(self.acls).encode("utf-8")).decode("ascii")
         return f"file-{filename_ascii}-{filename_hash}{acls_hash}"
 
+    def location_to_id(self):
+        """Tells apart files with the same name in different folders, by their storage URL or local path"""
+        location = self.url or os.path.normpath(self.content.name)
+        return hashlib.sha256(location.encode("utf-8")).hexdigest()[:16]
+
     def close(self):
         if self.content:
             self.content.close()
@@ -59,56 +79,125 @@ class ListFileStrategy(ABC):
         if False:  # pragma: no cover - this is necessary for mypy to type check
             yield
 
+    def mark_ingested(self, file: File):
+        """Called once a listed file has been ingested, so that it can be skipped until it changes"""
+        pass
+
+    def mark_removed(self, path: Optional[str] = None):
+        """Called once a file, or every file without a path, has been removed, so that it is ingested again if added"""
+        pass
+
+
+def md5_file(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
 
 class LocalListFileStrategy(ListFileStrategy):
     """
     Concrete strategy for listing files that are located in a local filesystem
     """
 
-    def __init__(self, path_pattern: str):
+    def __init__(self, path_pattern: str, manifest: Optional[FileManifest] = None, hash_workers: int = 4):
         self.path_pattern = path_pattern
+        # Without a manifest, every file is listed
+        self.manifest = manifest
+        self.hash_workers = hash_workers
+        # The entries of the listed files, which go in the manifest once the files are ingested
+        self.listed: dict[str, ManifestEntry] = {}
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
-        async for p in self._list_paths(self.path_pattern):
-            yield p
+        for path, _ in self.walk():
+            yield path
 
-    async def _list_paths(self, path_pattern: str) -> AsyncGenerator[str, None]:
-        for path in glob(path_pattern):
+    def walk(self) -> Iterator[tuple[str, os.stat_result]]:
+        for path in glob(self.path_pattern):
             if os.path.isdir(path):
-                async for p in self._list_paths(f"{path}/*"):
-                    yield p
+                yield from self.walk_directory(path)
             else:
-                # Only list files, not directories
-                yield path
+                yield path, os.stat(path)
+
+    def walk_directory(self, directory: str) -> Iterator[tuple[str, os.stat_result]]:
+        # scandir reads the type of each entry along with its name, so files don't each need a call to tell them apart
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # Like glob, skip hidden files
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    yield from self.walk_directory(entry.path)
+                else:
+                    yield entry.path, entry.stat()
 
     async def list(self) -> AsyncGenerator[File, None]:
-        async for path in self.list_paths():
-            if not self.check_md5(path):
-                yield File(content=open(path, mode="rb"))
-
-    def check_md5(self, path: str) -> bool:
-        # if filename ends in .md5 skip
-        if path.endswith(".md5"):
-            return True
-
-        # if there is a file called .md5 in this directory, see if its updated
-        stored_hash = None
-        with open(path, "rb") as file:
-            existing_hash = hashlib.md5(file.read()).hexdigest()
-        hash_path = f"{path}.md5"
-        if os.path.exists(hash_path):
-            with open(hash_path, encoding="utf-8") as md5_f:
-                stored_hash = md5_f.read()
-
-        if stored_hash and stored_hash.strip() == existing_hash.strip():
+        loop = asyncio.get_running_loop()
+        hashing: deque[tuple[str, os.stat_result, asyncio.Future[str]]] = deque()
+        with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+            for path, stat in self.walk():
+                if path.endswith(".md5"):
+                    continue
+                if self.manifest is None:
+                    yield File(content=open(path, mode="rb"))
+                    continue
+                entry = self.manifest.get(path)
+                if entry and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+                    logger.info("Skipping %s, no changes detected.", path)
+                    continue
+                # The files that might have changed are hashed in threads, a few ahead of the one being listed
+                hashing.append((path, stat, loop.run_in_executor(executor, md5_file, path)))
+                if len(hashing) > self.hash_workers and (file := await self.check_hash(*hashing.popleft())):
+                    yield file
+            while hashing:
+                if file := await self.check_hash(*hashing.popleft()):
+                    yield file
+
+    async def check_hash(self, path: str, stat: os.stat_result, hashing: asyncio.Future[str]) -> Optional[File]:
+        """Returns the file if its content changed since it was ingested, and records it as unchanged otherwise"""
+        assert self.manifest is not None
+        entry = ManifestEntry(stat.st_size, stat.st_mtime_ns, await hashing)
+        stored = self.manifest.get(path)
+        stored_md5 = stored.md5 if stored else self.read_md5_file(path)
+        if stored_md5 == entry.md5:
+            # The file was touched without changing, or was last ingested before there was a manifest
+            self.manifest.put(path, entry)
             logger.info("Skipping %s, no changes detected.", path)
-            return True
+            return None
+        self.listed[path] = entry
+        return File(content=open(path, mode="rb"))
+
+    @staticmethod
+    def read_md5_file(path: str) -> Optional[str]:
+        """Reads the hash that earlier versions wrote to a .md5 file next to the file"""
+        try:
+            with open(f"{path}.md5", encoding="utf-8") as md5_file:
+                return md5_file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def mark_ingested(self, file: File):
+        if self.manifest and (entry := self.listed.pop(file.content.name, None)):
+            self.manifest.put(file.content.name, entry)
 
-        # Write the hash
-        with open(hash_path, "w", encoding="utf-8") as md5_f:
-            md5_f.write(existing_hash)
+    def mark_removed(self, path: Optional[str] = None):
+        if self.manifest:
+            self.manifest.remove(path)
 
-        return False
+
+class DownloadedFile(File):
+    """
+    A file that was downloaded to a temporary directory of its own, which is deleted when the file is closed
+    """
+
+    def __init__(self, temp_directory: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temp_directory = temp_directory
+
+    def close(self):
+        super().close()
+        shutil.rmtree(self.temp_directory, ignore_errors=True)
 
 
 class ADLSGen2ListFileStrategy(ListFileStrategy):
@@ -122,11 +211,17 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
         data_lake_filesystem: str,
         data_lake_path: str,
         credential: Union[AsyncTokenCredential, str],
+        prefetch: int = 4,
+        download_concurrency: int = 4,
     ):
         self.data_lake_storage_account = data_lake_storage_account
         self.data_lake_filesystem = data_lake_filesystem
         self.data_lake_path = data_lake_path
         self.credential = credential
+        # The number of files downloaded ahead of the one being listed
+        self.prefetch = prefetch
+        # The number of connections that download the chunks of each file
+        self.download_concurrency = download_concurrency
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
         async with DataLakeServiceClient(
@@ -142,36 +237,66 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
         async with DataLakeServiceClient(
             account_url=f"https://{self.data_lake_storage_account}.dfs.core.windows.net", credential=self.credential
         ) as service_client, service_client.get_file_system_client(self.data_lake_filesystem) as filesystem_client:
-            async for path in self.list_paths():
-                temp_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(path))
-                try:
-                    async with filesystem_client.get_file_client(path) as file_client:
-                        with open(temp_file_path, "wb") as temp_file:
-                            downloader = await file_client.download_file()
-                            await downloader.readinto(temp_file)
-                    # Parse out user ids and group ids
-                    acls: Dict[str, List[str]] = {"oids": [], "groups": []}
-                    # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
-                    # Request ACLs as GUIDs
-                    access_control = await file_client.get_access_control(upn=False)
-                    acl_list = access_control["acl"]
-                    # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
-                    # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
-                    acl_list = acl_list.split(",")
-                    for acl in acl_list:
-                        acl_parts: list = acl.split(":")
-                        if len(acl_parts) != 3:
-                            continue
-                        if len(acl_parts[1]) == 0:
-                            continue
-                        if acl_parts[0] == "user" and "r" in acl_parts[2]:
-                            acls["oids"].append(acl_parts[1])
-                        if acl_parts[0] == "group" and "r" in acl_parts[2]:
-                            acls["groups"].append(acl_parts[1])
-                    yield File(content=open(temp_file_path, "rb"), acls=acls, url=file_client.url)
-                except Exception as data_lake_exception:
-                    logger.error(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
-                    try:
-                        os.remove(temp_file_path)
-                    except Exception as file_delete_exception:
-                        logger.error(f"\tGot an error while deleting {temp_file_path} -> {file_delete_exception}")
+            # Files are downloaded in tasks, a few ahead of the one being listed, so that the latency of each
+            # download overlaps with the others, and are listed in order
+            downloads: deque[asyncio.Task[Optional[File]]] = deque()
+            try:
+                async for path in self.list_paths():
+                    downloads.append(asyncio.create_task(self.download(filesystem_client.get_file_client(path), path)))
+                    if len(downloads) > self.prefetch and (file := await downloads.popleft()):
+                        yield file
+                while downloads:
+                    if file := await downloads.popleft():
+                        yield file
+            finally:
+                # If the listing stopped early, the files that were downloaded ahead are never listed, so are deleted
+                for download in downloads:
+                    download.cancel()
+                for result in await asyncio.gather(*downloads, return_exceptions=True):
+                    if isinstance(result, File):
+                        result.close()
+
+    async def download(self, file_client: DataLakeFileClient, path: str) -> Optional[File]:
+        """Downloads the file to a temporary directory of its own, or returns None if it couldn't be read"""
+        # Files with the same name in different folders each get their own directory, keeping their name
+        temp_directory = tempfile.mkdtemp(prefix="prepdocs-")
+        temp_file_path = os.path.join(temp_directory, os.path.basename(path))
+        try:
+            async with file_client:
+
+                async def download_content():
+                    with open(temp_file_path, "wb") as temp_file:
+                        downloader = await file_client.download_file(max_concurrency=self.download_concurrency)
+                        await downloader.readinto(temp_file)
+
+                # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
+                # Request ACLs as GUIDs
+                _, access_control = await asyncio.gather(
+                    download_content(), file_client.get_access_control(upn=False)  # type: ignore[misc]
+                )
+                url = file_client.url
+        except Exception as data_lake_exception:
+            logger.error(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            return None
+        except BaseException:
+            # The download was cancelled because the listing stopped
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            raise
+        # Parse out user ids and group ids
+        acls: Dict[str, List[str]] = {"oids": [], "groups": []}
+        acl_list = access_control["acl"]
+        # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
+        # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
+        acl_list = acl_list.split(",")
+        for acl in acl_list:
+            acl_parts: list = acl.split(":")
+            if len(acl_parts) != 3:
+                continue
+            if len(acl_parts[1]) == 0:
+                continue
+            if acl_parts[0] == "user" and "r" in acl_parts[2]:
+                acls["oids"].append(acl_parts[1])
+            if acl_parts[0] == "group" and "r" in acl_parts[2]:
+                acls["groups"].append(acl_parts[1])
+        return DownloadedFile(temp_directory, content=open(temp_file_path, "rb"), acls=acls, url=url)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, Awaitable, Callable, Generic, Optional, TypeVar
+
+logger = logging.getLogger("ingester")
+
+T = TypeVar("T")
+
+# Tells the workers of a stage that the earlier stage has finished
+_DONE: Any = object()
+
+
+@dataclass
+class PipelineStage(Generic[T]):
+    name: str
+    # Returns the item for the next stage, or None if the item doesn't need the later stages
+    process: Callable[[T], Awaitable[Optional[T]]]
+    workers: int = 1
+
+
+async def run_pipeline(
+    source: AsyncIterable[T],
+    stages: list[PipelineStage[T]],
+    discard: Callable[[T], None],
+    queue_size: int = 1,
+):
+    """
+    Runs the items from source through the stages, with each stage working on up to its number of workers of items
+    at once. Items wait between stages in queues of queue_size, so a slow stage holds back the earlier ones instead of
+    items piling up in memory. discard is called with each item when it leaves the pipeline, whether it finished
+    the last stage, was dropped by a stage, or was abandoned because another item failed, which stops the pipeline.
+    """
+    queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+
+    async def put(index: int, item: T):
+        try:
+            await queues[index].put(item)
+        except BaseException:
+            discard(item)
+            raise
+
+    async def feed():
+        async for item in source:
+            await put(0, item)
+        for _ in range(stages[0].workers):
+            await queues[0].put(_DONE)
+
+    async def work(index: int):
+        stage = stages[index]
+        while (item := await queues[index].get()) is not _DONE:
+            try:
+                result = await stage.process(item)
+            except Exception:
+                logger.error("The %s stage failed, stopping the pipeline", stage.name)
+                discard(item)
+                raise
+            except BaseException:
+                discard(item)
+                raise
+            if result is None:
+                discard(item)
+            elif index + 1 < len(stages):
+                await put(index + 1, result)
+            else:
+                discard(result)
+
+    async def run_stage(index: int):
+        await asyncio.gather(*(work(index) for _ in range(stages[index].workers)))
+        if index + 1 < len(stages):
+            for _ in range(stages[index + 1].workers):
+                await queues[index + 1].put(_DONE)
+
+    tasks = [asyncio.create_task(feed()), *(asyncio.create_task(run_stage(index)) for index in range(len(stages)))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for queue in queues:
+            while not queue.empty():
+                if (item := queue.get_nowait()) is not _DONE:
+                    discard(item)
+        raise
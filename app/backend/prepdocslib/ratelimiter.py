@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Optional
+
+from openai import APIStatusError
+
+logger = logging.getLogger("ingester")
+
+# Azure OpenAI enforces its per-minute quotas over windows of 10 seconds, so a full minute's worth can't be sent at once
+QUOTA_WINDOW_SECONDS = 10
+
+
+class _QuotaBucket:
+    """A token bucket that refills at a per-minute rate, and holds what can be spent within one quota window"""
+
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * QUOTA_WINDOW_SECONDS
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: int) -> float:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request larger than the bucket goes once the bucket is full, and leaves it in debt
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: int):
+        self.level -= amount
+
+
+class RateLimiter:
+    """
+    Schedules requests to an OpenAI deployment within its tokens-per-minute and requests-per-minute quotas,
+    with at most max_concurrency of them in flight. Requests wait their turn in order of arrival.
+    When the service asks for a pause with a retry hint, every request waits until it ends, not just the one that
+    was rejected. Without quotas, only the concurrency is limited.
+    """
+
+    def __init__(
+        self,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        max_concurrency: int = 4,
+    ):
+        self.tokens = _QuotaBucket(tokens_per_minute) if tokens_per_minute else None
+        self.requests = _QuotaBucket(requests_per_minute) if requests_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.resume_at = 0.0
+        # Created on first use, so they belong to the event loop that runs the requests
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.lock: Optional[asyncio.Lock] = None
+
+    def pause(self, seconds: float):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    async def wait(self, token_length: int):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                delay = self.resume_at - time.monotonic()
+                if self.tokens:
+                    delay = max(delay, self.tokens.wait_time(token_length))
+                if self.requests:
+                    delay = max(delay, self.requests.wait_time(1))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            if self.tokens:
+                self.tokens.take(token_length)
+            if self.requests:
+                self.requests.take(1)
+
+    @asynccontextmanager
+    async def limit(self, token_length: int) -> AsyncIterator[None]:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            await self.wait(token_length)
+            yield
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Returns how many seconds the service asked the client to wait before retrying, if it said"""
+    if not isinstance(error, APIStatusError):
+        return None
+    headers = error.response.headers
+    try:
+        if retry_after_ms := headers.get("retry-after-ms"):
+            return float(retry_after_ms) / 1000
+        if retry_after := headers.get("retry-after"):
+            try:
+                return float(retry_after)
+            except ValueError:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        logger.warning("Ignoring a retry hint that couldn't be parsed")
+    return None
@@ -1,7 +1,8 @@
 import asyncio
+import hashlib
 import logging
 import os
-from typing import List, Optional
+from typing import Any, List, Optional
 
 from azure.search.documents.indexes.models import (
     HnswAlgorithmConfiguration,
@@ -133,6 +134,8 @@ class SearchManager:
                         filterable=True,
                     )
                 )
+                # Identifies the uploaded file that the sections were split from, so that copies can reuse them
+                fields.append(SimpleField(name="contentHash", type="Edm.String", filterable=True))
             if self.use_int_vectorization:
                 fields.append(SearchableField(name="parent_id", type="Edm.String", filterable=True))
             if self.search_images:
@@ -199,51 +202,210 @@ class SearchManager:
                         ),
                     )
                     await search_index_client.create_or_update_index(index_definition)
+                if self.use_acls and not any(field.name == "contentHash" for field in index_definition.fields):
+                    logger.info("Adding contentHash field to index %s", self.search_info.index_name)
+                    index_definition.fields.append(SimpleField(name="contentHash", type="Edm.String", filterable=True))
+                    await search_index_client.create_or_update_index(index_definition)
+
+    def create_documents(
+        self,
+        sections: List[Section],
+        image_embeddings: Optional[List[List[float]]] = None,
+        url: Optional[str] = None,
+        content_hash: Optional[str] = None,
+    ) -> List[dict[str, Any]]:
+        """Returns the search documents of the sections, without their ids and embeddings"""
+        documents = [
+            {
+                "content": section.split_page.text,
+                "category": section.category,
+                "sourcepage": (
+                    BlobManager.blob_image_name_from_file_page(
+                        filename=section.content.filename(),
+                        page=section.split_page.page_num,
+                    )
+                    if image_embeddings
+                    else BlobManager.sourcepage_from_file_page(
+                        filename=section.content.filename(),
+                        page=section.split_page.page_num,
+                    )
+                ),
+                "sourcefile": section.content.filename(),
+                **section.content.acls,
+            }
+            for section in sections
+        ]
+        if url:
+            for document in documents:
+                document["storageUrl"] = url
+        if content_hash:
+            for document in documents:
+                document["contentHash"] = content_hash
+        return documents
+
+    def section_id_prefix(self, file: File) -> str:
+        # Files with the same name in different folders, such as the uploads of different users, each have their own
+        return f"{file.filename_to_id(include_acls=False)}-{file.location_to_id()}"
+
+    def section_ids(self, file: File, sections: List[Section]) -> List[str]:
+        """
+        Returns ids derived from the text of the sections and the embedding model, so that a section keeps its id,
+        and so its embedding, for as long as its text is unchanged. Its other fields, such as the access control
+        and the source page, are updated in place. Repeats of the same text within a file are counted into their
+        ids, so that each of them is still indexed.
+        """
+        embedding_model = (
+            f"{self.embeddings.open_ai_model_name}:{self.embeddings.open_ai_dimensions}" if self.embeddings else ""
+        )
+        prefix = self.section_id_prefix(file)
+        occurrences: dict[str, int] = {}
+        ids = []
+        for section in sections:
+            key = f"{embedding_model}\0{section.split_page.text}"
+            occurrences[key] = occurrences.get(key, 0) + 1
+            digest = hashlib.sha256(f"{key}\0{occurrences[key]}".encode()).hexdigest()
+            ids.append(f"{prefix}-section-{digest[:40]}")
+        return ids
+
+    def section_metadata(self, document: dict[str, Any]) -> dict[str, Any]:
+        """Returns the fields of a section's document that can change without changing its id"""
+        metadata = {key: value for key, value in document.items() if key != "content"}
+        if self.use_acls:
+            # A file that no longer has access control clears it from its sections
+            metadata = {"oids": [], "groups": [], **metadata}
+        return metadata
+
+    async def get_indexed_sections(self, file: File, fields: Optional[List[str]] = None) -> dict[str, dict[str, Any]]:
+        """Returns the sections of the file that are in the index by id, with their fields, which tell what to update"""
+        # Replace ' with '' to escape the single quote for the filter
+        filename_for_filter = file.filename().replace("'", "''")
+        # Other files with the same name in other folders have their own sections
+        prefix = f"{self.section_id_prefix(file)}-section-"
+        # Sections indexed before the ids were derived from their text are numbered by page, after the name and
+        # access control of the file, so they are told apart from those of other files by their storage URL
+        legacy_prefix = file.filename_to_id(include_acls=False)
+
+        def is_section_of_file(result: dict[str, Any]) -> bool:
+            if result["id"].startswith(prefix):
+                return True
+            return (
+                result["id"].startswith(legacy_prefix)
+                and "-page-" in result["id"]
+                and (result.get("storageUrl") or None) == (file.url or None)
+            )
+
+        async with self.search_info.create_search_client() as search_client:
+            results = await search_client.search(
+                search_text="",
+                filter=f"sourcefile eq '{filename_for_filter}'",
+                select=["id", *sorted({"storageUrl", *(fields or [])})],
+            )
+            return {result["id"]: result async for result in results if is_section_of_file(result)}
+
+    async def remove_sections(self, ids: List[str]):
+        MAX_BATCH_SIZE = 1000
+        async with self.search_info.create_search_client() as search_client:
+            for i in range(0, len(ids), MAX_BATCH_SIZE):
+                await search_client.delete_documents([{"id": id} for id in ids[i : i + MAX_BATCH_SIZE]])
+
+    async def merge_sections(self, documents: List[dict[str, Any]]):
+        """Updates the given fields of sections that are already indexed, keeping their embeddings"""
+        MAX_BATCH_SIZE = 1000
+        async with self.search_info.create_search_client() as search_client:
+            for i in range(0, len(documents), MAX_BATCH_SIZE):
+                await search_client.merge_documents(documents[i : i + MAX_BATCH_SIZE])
 
     async def update_content(
-        self, sections: List[Section], image_embeddings: Optional[List[List[float]]] = None, url: Optional[str] = None
+        self,
+        sections: List[Section],
+        image_embeddings: Optional[List[List[float]]] = None,
+        url: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        text_embeddings: Optional[List[List[float]]] = None,
+        ids: Optional[List[str]] = None,
     ):
+        """
+        Indexes the sections, and embeds their text unless text_embeddings already has their embeddings.
+        Without ids, the sections are numbered by their position in the file.
+        """
         MAX_BATCH_SIZE = 1000
-        section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
+        all_documents = self.create_documents(sections, image_embeddings, url, content_hash)
+        for section_index, document in enumerate(all_documents):
+            document["id"] = (
+                ids[section_index]
+                if ids
+                else f"{sections[section_index].content.filename_to_id()}-page-{section_index}"
+            )
 
         async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section.split_page.text,
-                        "category": section.category,
-                        "sourcepage": (
-                            BlobManager.blob_image_name_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                            if image_embeddings
-                            else BlobManager.sourcepage_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
-                if url:
-                    for document in documents:
-                        document["storageUrl"] = url
-                if self.embeddings:
+            for batch_start in range(0, len(sections), MAX_BATCH_SIZE):
+                batch = sections[batch_start : batch_start + MAX_BATCH_SIZE]
+                documents = all_documents[batch_start : batch_start + MAX_BATCH_SIZE]
+                if text_embeddings:
+                    embeddings = text_embeddings[batch_start : batch_start + MAX_BATCH_SIZE]
+                    for i, document in enumerate(documents):
+                        document["embedding"] = embeddings[i]
+                elif self.embeddings:
                     embeddings = await self.embeddings.create_embeddings(
                         texts=[section.split_page.text for section in batch]
                     )
                     for i, document in enumerate(documents):
                         document["embedding"] = embeddings[i]
                 if image_embeddings:
-                    for i, (document, section) in enumerate(zip(documents, batch)):
+                    for document, section in zip(documents, batch):
                         document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
 
                 await search_client.upload_documents(documents)
 
+    async def copy_content(self, file: File, content_hash: str) -> Optional[List[str]]:
+        """
+        Indexes the file with the sections and embeddings of an identical file that was indexed before,
+        instead of parsing and embedding it again. Returns the ids of the sections, or None if there is no such file.
+        """
+        select = ["id", "content", "category", "sourcepage", "sourcefile"]
+        if self.embeddings:
+            select.append("embedding")
+        async with self.search_info.create_search_client() as search_client:
+            # The hash is hex, so it doesn't need escaping
+            results = await search_client.search(
+                search_text="", filter=f"contentHash eq '{content_hash}'", select=select
+            )
+            # Each upload of the file has its own copy of the sections, any one of them will do
+            copies: dict[str, list[dict[str, Any]]] = {}
+            async for result in results:
+                source_id, separator, _ = result["id"].rpartition("-section-")
+                if separator:
+                    copies.setdefault(source_id, []).append(result)
+        extension = file.file_extension().lower()
+        source = next(
+            (
+                copy
+                for copy in copies.values()
+                # The source page format depends on the extension, as does the parser that produced the sections
+                if os.path.splitext(copy[0]["sourcefile"])[1].lower() == extension
+            ),
+            None,
+        )
+        if not source:
+            return None
+        logger.info("Reusing %d sections of '%s' for '%s'", len(source), source[0]["sourcefile"], file.filename())
+
+        sections = []
+        for result in source:
+            # Only PDFs have pages, see BlobManager.sourcepage_from_file_page
+            _, _, page = result["sourcepage"].partition("#page=")
+            split_page = SplitPage(page_num=int(page) - 1 if page.isdigit() else 0, text=result["content"])
+            sections.append(Section(split_page, content=file, category=result["category"]))
+        ids = self.section_ids(file, sections)
+        text_embeddings = None
+        # Without the embeddings of the source, such as when embeddings were turned on since, the sections are embedded
+        if all(result.get("embedding") for result in source):
+            text_embeddings = [result["embedding"] for result in source]
+        await self.update_content(
+            sections, url=file.url, content_hash=content_hash, text_embeddings=text_embeddings, ids=ids
+        )
+        return ids
+
     async def remove_content(self, path: Optional[str] = None, only_oid: Optional[str] = None):
         logger.info(
             "Removing sections from '{%s or '<all>'}' from search index '%s'", path, self.search_info.index_name
@@ -1,5 +1,6 @@
 import logging
 from abc import ABC
+from functools import lru_cache
 from typing import Generator, List
 
 import tiktoken
@@ -75,8 +76,13 @@ STANDARD_SENTENCE_ENDINGS = [".", "!", "?"]
 # https://www.w3.org/TR/jlreq/#cl-04
 CJK_SENTENCE_ENDINGS = ["。", "！", "？", "‼", "⁇", "⁈", "⁉"]
 
-# NB: text-embedding-3-XX is the same BPE as text-embedding-ada-002
-bpe = tiktoken.encoding_for_model(ENCODING_MODEL)
+
+@lru_cache(maxsize=None)
+def get_bpe() -> tiktoken.Encoding:
+    """Loads the tokenizer on first use, as reading the BPE ranks is too slow to do at import time"""
+    # NB: text-embedding-3-XX is the same BPE as text-embedding-ada-002
+    return tiktoken.encoding_for_model(ENCODING_MODEL)
+
 
 DEFAULT_OVERLAP_PERCENT = 10  # See semantic search article for 10% overlap performance
 DEFAULT_SECTION_LENGTH = 1000  # Roughly 400-500 tokens for English
@@ -100,7 +106,7 @@ class SentenceTextSplitter(TextSplitter):
         """
         Recursively splits page by maximum number of tokens to better handle languages with higher token/word ratios.
         """
-        tokens = bpe.encode(text)
+        tokens = get_bpe().encode(text)
         if len(tokens) <= self.max_tokens_per_section:
             # Section is already within max tokens, return
             yield SplitPage(page_num=page_num, text=text)
@@ -23,10 +23,18 @@ export type ChatAppRequestOverrides = {
     include_category?: string;
     exclude_category?: string;
     seed?: number;
+    deadline?: number;
     top?: number;
     temperature?: number;
     minimum_search_score?: number;
     minimum_reranker_score?: number;
+    sources_token_budget?: number;
+    use_mmr?: boolean;
+    use_bm25?: boolean;
+    rerank_candidates?: number;
+    mmr_lambda?: number;
+    use_multi_query?: boolean;
+    search_query_count?: number;
     prompt_template?: string;
     prompt_template_prefix?: string;
     prompt_template_suffix?: string;
@@ -93,6 +101,7 @@ export type Config = {
 
 export type SimpleAPIResponse = {
     message?: string;
+    status?: string;
 };
 
 export interface SpeechConfig {
@@ -133,6 +133,9 @@ const Chat = () => {
                 } else if (event["delta"] && event["delta"]["content"]) {
                     setIsLoading(false);
                     await updateState(event["delta"]["content"]);
+                } else if (event["session_state"]) {
+                    // The server sends the summary of the history after the answer, if it was written in the meantime
+                    askResponse.session_state = event["session_state"];
                 } else if (event["context"]) {
                     // Update context with new keys from latest event
                     askResponse.context = { ...askResponse.context, ...event["context"] };
@@ -168,9 +171,13 @@ const Chat = () => {
                 { content: a[0], role: "user" },
                 { content: a[1].message.content, role: "assistant" }
             ]);
+            // AI Chat Protocol: Client must pass on any session state received from the server
+            const sessionState = answers.length ? answers[answers.length - 1][1].session_state : null;
+            // When the server keeps the conversation, only the new question is sent
+            const useStoredConversation = !!sessionState?.conversation_id;
 
             const request: ChatAppRequest = {
-                messages: [...messages, { content: question, role: "user" }],
+                messages: useStoredConversation ? [{ content: question, role: "user" }] : [...messages, { content: question, role: "user" }],
                 context: {
                     overrides: {
                         prompt_template: promptTemplate.length === 0 ? undefined : promptTemplate,
@@ -192,12 +199,20 @@ const Chat = () => {
                         ...(seed !== null ? { seed: seed } : {})
                     }
                 },
-                // AI Chat Protocol: Client must pass on any session state received from the server
-                session_state: answers.length ? answers[answers.length - 1][1].session_state : null,
+                session_state: sessionState,
                 recaptcha_token: recaptchaToken
             };
 
-            const response = await chatApi(request, shouldStream, token);
+            let response = await chatApi(request, shouldStream, token);
+            if (response.status == 409 && useStoredConversation) {
+                // The stored conversation has expired, so send the whole conversation to start a new one
+                const { conversation_id, ...restOfSessionState } = sessionState;
+                response = await chatApi(
+                    { ...request, messages: [...messages, { content: question, role: "user" }], session_state: restOfSessionState },
+                    shouldStream,
+                    token
+                );
+            }
             if (!response.body) {
                 throw Error("No response body");
             }
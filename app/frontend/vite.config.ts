@@ -1,9 +1,48 @@
-import { defineConfig } from "vite";
+import { defineConfig, Plugin } from "vite";
 import react from "@vitejs/plugin-react";
+import { readdirSync, readFileSync, statSync, writeFileSync } from "fs";
+import { extname, join, resolve } from "path";
+import { brotliCompressSync, constants, gzipSync } from "zlib";
+
+const COMPRESSIBLE_EXTENSIONS = [".html", ".js", ".css", ".json", ".svg", ".map", ".txt"];
+
+// Writes brotli and gzip copies of the text files next to them, which the backend sends to clients that accept them,
+// so that the app never compresses static files at request time
+function precompress(): Plugin {
+    let outDir = "";
+    const listFiles = (dir: string): string[] =>
+        readdirSync(dir).flatMap(name => (statSync(join(dir, name)).isDirectory() ? listFiles(join(dir, name)) : [join(dir, name)]));
+    return {
+        name: "precompress",
+        apply: "build",
+        configResolved(config) {
+            outDir = resolve(config.root, config.build.outDir);
+        },
+        closeBundle() {
+            for (const file of listFiles(outDir)) {
+                if (!COMPRESSIBLE_EXTENSIONS.includes(extname(file))) {
+                    continue;
+                }
+                const content = readFileSync(file);
+                if (content.length < 1024) {
+                    continue;
+                }
+                const brotli = brotliCompressSync(content, { params: { [constants.BROTLI_PARAM_QUALITY]: constants.BROTLI_MAX_QUALITY } });
+                if (brotli.length < content.length) {
+                    writeFileSync(`${file}.br`, brotli);
+                }
+                const gzip = gzipSync(content, { level: constants.Z_BEST_COMPRESSION });
+                if (gzip.length < content.length) {
+                    writeFileSync(`${file}.gz`, gzip);
+                }
+            }
+        }
+    };
+}
 
 // https://vitejs.dev/config/
 export default defineConfig({
-    plugins: [react()],
+    plugins: [react(), precompress()],
     build: {
         outDir: "../backend/static",
         emptyOutDir: true,
@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import base64
+import os
+import random
+import socket
+import sys
+import time
+
+import tiktoken
+from aiohttp import web
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+
+from prepdocslib.embeddings import OpenAIEmbeddingService  # noqa: E402
+from prepdocslib.ratelimiter import RateLimiter  # noqa: E402
+
+MODEL_NAME = "text-embedding-ada-002"
+WORDS = ["benefit", "plan", "deductible", "network", "employee", "coverage", "claim", "provider"]
+
+
+def create_stand_in_server(dimensions: int, latency: float) -> web.Application:
+    """Answers embedding requests like the OpenAI API does, with the same vector for every input"""
+    vectors = {"base64": base64.b64encode(bytes(4 * dimensions)).decode(), "float": [0.0] * dimensions}
+
+    async def embeddings(request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        vector = vectors[body.get("encoding_format", "float")]
+        await asyncio.sleep(latency)
+        return web.json_response(
+            {
+                "object": "list",
+                "data": [{"object": "embedding", "index": i, "embedding": vector} for i in range(len(inputs))],
+                "model": body["model"],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+        )
+
+    app = web.Application()
+    app.router.add_post("/v1/embeddings", embeddings)
+    return app
+
+
+class StandInEmbeddingService(OpenAIEmbeddingService):
+    def __init__(self, base_url: str, dimensions: int, concurrency: int):
+        super().__init__(
+            MODEL_NAME, dimensions, credential="key", rate_limiter=RateLimiter(max_concurrency=concurrency)
+        )
+        self.base_url = base_url
+
+    async def create_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(api_key=self.credential, base_url=self.base_url)
+
+
+async def embed_files(embeddings: StandInEmbeddingService, files: list[list[str]], reuse_client: bool) -> float:
+    start = time.perf_counter()
+    for sections in files:
+        await embeddings.create_embeddings(sections)
+        if not reuse_client:
+            # Each call built its own client before the client was shared
+            await embeddings.close()
+    await embeddings.close()
+    return time.perf_counter() - start
+
+
+async def main(args: argparse.Namespace):
+    random.seed(0)
+    files = [[" ".join(random.choices(WORDS, k=args.words)) for _ in range(args.sections)] for _ in range(args.files)]
+    texts = [text for sections in files for text in sections]
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    runner = web.AppRunner(create_stand_in_server(args.dimensions, args.latency / 1000))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    embeddings = StandInEmbeddingService(f"http://127.0.0.1:{port}/v1", args.dimensions, args.concurrency)
+
+    try:
+        print(f"{'step':<28}{'seconds':>10}{'sections/sec':>16}")
+        start = time.perf_counter()
+        [len(tiktoken.encoding_for_model(MODEL_NAME).encode(text)) for text in texts]
+        elapsed = time.perf_counter() - start
+        print(f"{'tokenize one at a time':<28}{elapsed:>10.3f}{len(texts) / elapsed:>16.0f}")
+        start = time.perf_counter()
+        embeddings.calculate_token_lengths(texts)
+        elapsed = time.perf_counter() - start
+        print(f"{'tokenize in a batch':<28}{elapsed:>10.3f}{len(texts) / elapsed:>16.0f}")
+
+        for name, reuse_client in (("embed, client per file", False), ("embed, shared client", True)):
+            elapsed = await embed_files(embeddings, files, reuse_client)
+            print(f"{name:<28}{elapsed:>10.3f}{len(texts) / elapsed:>16.0f}")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure how many sections per second the ingester embeds against a local stand-in for OpenAI."
+    )
+    parser.add_argument("--files", type=int, default=50, help="Number of files to embed")
+    parser.add_argument("--sections", type=int, default=40, help="Number of sections in each file")
+    parser.add_argument("--words", type=int, default=150, help="Number of words in each section")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Dimensions of the embeddings")
+    parser.add_argument("--latency", type=float, default=20, help="Milliseconds the server takes for each request")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of embedding requests to send at once")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+
+from approaches.approach import Document  # noqa: E402
+
+PROJECTED_FIELDS = ["id", "content", "category", "sourcepage", "sourcefile", "oids", "groups"]
+
+
+def make_hit(index: int, dimensions: int, image_dimensions: int) -> dict:
+    """Builds a search result shaped like the ones returned for this app's index"""
+    hit = {
+        "id": f"file-Benefit_Options_pdf-{index:040x}-page-{index}",
+        "content": " ".join(random.choices(["benefit", "plan", "deductible", "network", "employee"], k=170)),
+        "embedding": [random.uniform(-0.05, 0.05) for _ in range(dimensions)],
+        "category": None,
+        "sourcepage": f"Benefit_Options-{index}.pdf",
+        "sourcefile": "Benefit_Options.pdf",
+        "oids": [],
+        "groups": [],
+        "@search.score": random.random(),
+        "@search.reranker_score": random.uniform(0, 4),
+        "@search.captions": None,
+    }
+    if image_dimensions:
+        hit["imageEmbedding"] = [random.uniform(-3, 3) for _ in range(image_dimensions)]
+    return hit
+
+
+def measure(hits: list[dict], runs: int) -> tuple[int, float, float]:
+    """Returns the payload size, the median time to parse it, and the memory used by the parsed Documents"""
+    payload = json.dumps({"value": hits})
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        parsed = json.loads(payload)["value"]
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    tracemalloc.start()
+    parsed = json.loads(payload)["value"]
+    documents = [
+        Document(
+            id=hit.get("id"),
+            content=hit.get("content"),
+            embedding=hit.get("embedding"),
+            image_embedding=hit.get("imageEmbedding"),
+            category=hit.get("category"),
+            sourcepage=hit.get("sourcepage"),
+            sourcefile=hit.get("sourcefile"),
+            oids=hit.get("oids"),
+            groups=hit.get("groups"),
+            captions=hit.get("@search.captions"),
+            score=hit.get("@search.score"),
+            reranker_score=hit.get("@search.reranker_score"),
+        )
+        for hit in parsed
+    ]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del documents
+    return len(payload.encode()), timings[len(timings) // 2], memory
+
+
+def main(args: argparse.Namespace):
+    random.seed(0)
+    full_hits = [make_hit(i, args.dimensions, args.image_dimensions) for i in range(args.top)]
+    projected_hits = [
+        {key: value for key, value in hit.items() if key in PROJECTED_FIELDS or key.startswith("@search.")}
+        for hit in full_hits
+    ]
+
+    print(f"{'fields':<12}{'payload (KB)':>14}{'parse (ms)':>12}{'memory (KB)':>14}")
+    for name, hits in (("all", full_hits), ("projected", projected_hits)):
+        size, parse_time, memory = measure(hits, args.runs)
+        print(f"{name:<12}{size / 1024:>14.1f}{parse_time * 1000:>12.2f}{memory / 1024:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the size and parsing cost of search results with and without the vector fields."
+    )
+    parser.add_argument("--top", type=int, default=3, help="Number of search results per request")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Dimensions of the text embedding")
+    parser.add_argument(
+        "--image-dimensions", type=int, default=0, help="Dimensions of the image embedding (1024 with GPT-4 vision)"
+    )
+    parser.add_argument("--runs", type=int, default=50, help="Number of times to parse each payload")
+    args = parser.parse_args()
+
+    main(args)
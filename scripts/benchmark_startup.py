@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger("benchmark_startup")
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend")
+
+# Placeholder values so that the app can start without a deployed environment.
+# No network calls are made unless authentication is enabled.
+DEFAULT_ENV = {
+    "AZURE_STORAGE_ACCOUNT": "benchmark-storage-account",
+    "AZURE_STORAGE_CONTAINER": "benchmark-storage-container",
+    "AZURE_SEARCH_INDEX": "benchmark-search-index",
+    "AZURE_SEARCH_SERVICE": "benchmark-search-service",
+    "AZURE_OPENAI_SERVICE": "benchmark-openai-service",
+    "AZURE_OPENAI_CHATGPT_MODEL": "gpt-35-turbo",
+    "AZURE_USERSTORAGE_ACCOUNT": "benchmark-userstorage-account",
+    "AZURE_USERSTORAGE_CONTAINER": "benchmark-userstorage-container",
+    "AZURE_DOCUMENTINTELLIGENCE_SERVICE": "benchmark-documentintelligence-service",
+    "USE_LOCAL_PDF_PARSER": "true",
+    "USE_LOCAL_HTML_PARSER": "true",
+}
+
+
+async def measure_once() -> dict[str, float]:
+    """Imports the app and runs the serving hooks once, returning the time spent in each phase"""
+    sys.path.insert(0, BACKEND_DIR)
+    import_start = time.perf_counter()
+    import app
+
+    timings = {"import": time.perf_counter() - import_start}
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        timings.update(quart_app.config[app.CONFIG_STARTUP_TIMINGS])
+    return timings
+
+
+def run_child(env: dict[str, str]) -> dict[str, float]:
+    """Measures in a fresh interpreter, so that nothing is already imported"""
+    output = subprocess.run(
+        [sys.executable, __file__, "--child"], env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(args: argparse.Namespace):
+    env = {**DEFAULT_ENV, **os.environ}
+    env["USE_USER_UPLOAD"] = "true" if args.user_upload else env.get("USE_USER_UPLOAD", "false")
+
+    runs = []
+    for i in range(args.runs):
+        runs.append(run_child(env))
+        logger.info("Run %d: %.3fs", i + 1, runs[-1]["import"] + runs[-1]["total"])
+
+    print(f"{'phase':<16}{'median (s)':>12}{'min (s)':>12}{'max (s)':>12}")
+    for phase in runs[0]:
+        values = [run[phase] for run in runs if phase in run]
+        print(f"{phase:<16}{statistics.median(values):>12.3f}{min(values):>12.3f}{max(values):>12.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure how long a backend worker takes to import the app and set up its clients."
+    )
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to start")
+    parser.add_argument("--user-upload", action="store_true", help="Enable user upload, which loads the ingester")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(measure_once())))
+    else:
+        logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+        main(args)
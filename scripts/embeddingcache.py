@@ -0,0 +1,54 @@
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+
+from prepdocslib.embeddingcache import EmbeddingCache  # noqa: E402
+
+
+def print_stats(cache: EmbeddingCache):
+    stats = cache.stats()
+    print(f"Entries:           {stats['entries']}")
+    print(f"Vectors:           {stats['vectors_bytes'] / 1024 / 1024:.1f} MB")
+    print(f"Reclaimable:       {stats['reclaimable_bytes'] / 1024 / 1024:.1f} MB")
+    print(f"Index:             {stats['index_bytes'] / 1024 / 1024:.1f} MB")
+    print(f"Hits:              {stats['hits']}")
+    print(f"Misses:            {stats['misses']}")
+    print(f"Hit rate:          {stats['hit_rate']:.1%}")
+
+
+def main(args: argparse.Namespace):
+    if not os.path.isdir(args.directory):
+        raise ValueError(f"No embedding cache found at {args.directory}")
+    cache = EmbeddingCache(args.directory)
+    try:
+        if args.command == "compact":
+            freed = cache.compact(max_age_days=args.maxage)
+            print(f"Freed {freed / 1024 / 1024:.1f} MB")
+        print_stats(cache)
+    finally:
+        cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report on or compact the embedding cache that prepdocs.py uses with --embeddingcache.",
+        epilog="Example: embeddingcache.py compact ./.embeddings --maxage 30",
+    )
+    parser.add_argument("command", choices=["stats", "compact"], help="Report the size and hit rate, or compact")
+    parser.add_argument("directory", help="Directory of the embedding cache")
+    parser.add_argument(
+        "--maxage",
+        required=False,
+        type=float,
+        help="Optional. When compacting, also drop the embeddings that haven't been used for this many days",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(format="%(message)s")
+        logging.getLogger("ingester").setLevel(logging.INFO)
+
+    main(args)
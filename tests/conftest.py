@@ -179,6 +179,9 @@ def mock_openai_chatcompletion(monkeypatch):
             else:
                 raise StopAsyncIteration
 
+        async def close(self):
+            self.responses = []
+
     async def mock_acreate(*args, **kwargs):
         # The only two possible values for seed:
         assert kwargs.get("seed") is None or kwargs.get("seed") == 42
@@ -647,6 +650,9 @@ def mock_data_lake_service_client(monkeypatch):
 
     def mock_init_file(self, *args, **kwargs):
         self.path = kwargs.get("file_path")
+        # The attributes of the real client
+        self.path_name = self.path
+        self.file_system_name = kwargs.get("file_system_name")
         self.acl = ""
 
     def mock_url(self, *args, **kwargs):
@@ -728,8 +734,11 @@ def mock_data_lake_service_client(monkeypatch):
         stream.write(b"texttext")
         return 8
 
+    async def mock_readinto_aio(self, stream: IO[bytes]):
+        return mock_readinto(self, stream)
+
     monkeypatch.setattr(azure.storage.filedatalake.StorageStreamDownloader, "__init__", mock_init)
     monkeypatch.setattr(azure.storage.filedatalake.StorageStreamDownloader, "readinto", mock_readinto)
 
     monkeypatch.setattr(azure.storage.filedatalake.aio.StorageStreamDownloader, "__init__", mock_init)
-    monkeypatch.setattr(azure.storage.filedatalake.aio.StorageStreamDownloader, "readinto", mock_readinto)
+    monkeypatch.setattr(azure.storage.filedatalake.aio.StorageStreamDownloader, "readinto", mock_readinto_aio)
@@ -180,6 +180,9 @@ class MockClient:
     def __init__(self, embeddings_client):
         self.embeddings = embeddings_client
 
+    async def close(self):
+        pass
+
 
 def mock_computervision_response():
     return MockResponse(
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from core.admission import AdmissionController, AdmissionRejectedError, Priority
+from core.metrics import metrics
+
+
+@pytest.mark.asyncio
+async def test_admission_limits_concurrency():
+    controller = AdmissionController(max_concurrent=2, max_waiting=10, max_wait=1)
+    running = 0
+    max_running = 0
+
+    async def handle():
+        nonlocal running, max_running
+        async with controller.admit(Priority.BATCH):
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*[handle() for _ in range(6)])
+
+    assert max_running == 2
+    assert controller.active == 0
+    assert controller.waiting == []
+
+
+@pytest.mark.asyncio
+async def test_admission_prioritises_waiters():
+    controller = AdmissionController(max_concurrent=1, max_waiting=10, max_wait=1)
+    started = []
+
+    async def handle(name: str, priority: Priority):
+        async with controller.admit(priority):
+            started.append(name)
+
+    await controller.acquire(Priority.BATCH)
+    tasks = [
+        asyncio.create_task(handle("batch", Priority.BATCH)),
+        asyncio.create_task(handle("chat", Priority.CHAT)),
+        asyncio.create_task(handle("interactive", Priority.INTERACTIVE)),
+    ]
+    await asyncio.sleep(0)
+    controller.release()
+    await asyncio.gather(*tasks)
+
+    assert started == ["interactive", "chat", "batch"]
+
+
+@pytest.mark.asyncio
+async def test_admission_rejects_when_queue_full():
+    controller = AdmissionController(max_concurrent=1, max_waiting=1, max_wait=1)
+    await controller.acquire(Priority.BATCH)
+    waiter = asyncio.create_task(controller.acquire(Priority.BATCH))
+    await asyncio.sleep(0)
+    rejected = metrics.counters["admission.rejected"]
+
+    with pytest.raises(AdmissionRejectedError) as error:
+        await controller.acquire(Priority.INTERACTIVE)
+
+    assert error.value.retry_after == 1
+    assert metrics.counters["admission.rejected"] == rejected + 1
+    controller.release()
+    await waiter
+    assert controller.active == 1
+
+
+@pytest.mark.asyncio
+async def test_admission_rejects_after_deadline():
+    controller = AdmissionController(max_concurrent=1, max_waiting=10, max_wait=0.01)
+    await controller.acquire(Priority.BATCH)
+
+    with pytest.raises(AdmissionRejectedError):
+        await controller.acquire(Priority.CHAT)
+
+    # The request that timed out doesn't take the next free slot
+    assert controller.waiting == []
+    controller.release()
+    assert controller.active == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_slot_released_once():
+    controller = AdmissionController(max_concurrent=1, max_waiting=10, max_wait=1)
+    slot = await controller.slot(Priority.CHAT)
+    waiter = asyncio.create_task(controller.slot(Priority.CHAT))
+    await asyncio.sleep(0)
+
+    slot.release()
+    other_slot = await waiter
+    # Releasing again, or collecting the released slot, doesn't free the slot that was handed over
+    slot.release()
+    del slot
+    assert controller.active == 1
+
+    other_slot.release()
+    assert controller.active == 0
@@ -1,14 +1,20 @@
+import gc
 import json
 import logging
 import os
+import time
 from unittest import mock
 
 import pytest
+import pytest_asyncio
 import quart.testing.app
 from httpx import Request, Response
 from openai import BadRequestError
+from quart.testing import WebsocketResponseError
+from quart.testing.connections import WebsocketDisconnectError
 
 import app
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 
 
 def fake_response(http_code):
@@ -81,6 +87,95 @@ async def test_favicon(client):
     assert response.content_type.endswith("icon")
 
 
+@pytest.fixture
+def static_folder(monkeypatch, tmp_path):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "index.html").write_text("<html></html>")
+    (tmp_path / "assets" / "index-abc123.js").write_text("console.log('uncompressed');")
+    (tmp_path / "assets" / "index-abc123.js.br").write_bytes(b"brotli")
+    (tmp_path / "assets" / "index-abc123.js.gz").write_bytes(b"gzip")
+    monkeypatch.setattr(app, "STATIC_FOLDER", tmp_path)
+    return tmp_path
+
+
+@pytest.mark.asyncio
+async def test_assets_precompressed(client, static_folder):
+    response = await client.get("/assets/index-abc123.js", headers={"Accept-Encoding": "gzip, deflate, br"})
+    assert response.status_code == 200
+    assert (await response.get_data()) == b"brotli"
+    assert response.headers["Content-Encoding"] == "br"
+    assert "javascript" in response.content_type
+    assert "Accept-Encoding" in response.vary
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 365 * 24 * 60 * 60
+
+    response = await client.get("/assets/index-abc123.js", headers={"Accept-Encoding": "gzip"})
+    assert (await response.get_data()) == b"gzip"
+    assert response.headers["Content-Encoding"] == "gzip"
+
+    response = await client.get("/assets/index-abc123.js")
+    assert (await response.get_data()) == b"console.log('uncompressed');"
+    assert "Content-Encoding" not in response.headers
+    assert "Accept-Encoding" in response.vary
+
+    response = await client.get("/assets/../index.html")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_index_revalidates(client, static_folder):
+    response = await client.get("/")
+    assert response.status_code == 200
+    assert response.cache_control.no_cache
+    etag = response.headers["ETag"]
+
+    response = await client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_config_etag(client):
+    response = await client.get("/config")
+    assert response.status_code == 200
+    assert response.cache_control.no_cache
+    etag = response.headers["ETag"]
+
+    response = await client.get("/config", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert (await response.get_data()) == b""
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_closes_approach_stream():
+    closed = []
+
+    async def approach_stream():
+        try:
+            while True:
+                yield {"delta": {"content": "more "}}
+        finally:
+            closed.append(True)
+
+    lines = app.format_as_ndjson(approach_stream())
+    assert json.loads(await lines.__anext__()) == {"delta": {"content": "more "}}
+    await lines.aclose()
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_chat_admission_rejected(client):
+    admission_controller = client.app.config[app.CONFIG_ADMISSION_CONTROLLER]
+    admission_controller.max_concurrent = 0
+    admission_controller.max_waiting = 0
+
+    response = await client.post(
+        "/chat",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "10"
+
+
 @pytest.mark.asyncio
 async def test_cors_notallowed(client) -> None:
     response = await client.get("/", headers={"Origin": "https://quart.com"})
@@ -172,6 +267,39 @@ async def test_ask_rtr_text(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_stream_rtr_text(client, snapshot):
+    response = await client.post(
+        "/ask/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    assert client.app.config[app.CONFIG_ADMISSION_CONTROLLER].active == 0
+    result = await response.get_data()
+    snapshot.assert_match(result, "result.jsonlines")
+
+
+@pytest.mark.asyncio
+async def test_stream_abandoned_before_start_releases_admission(client):
+    admission_controller = client.app.config[app.CONFIG_ADMISSION_CONTROLLER]
+
+    async def answer():
+        yield {"delta": {"content": "Paris"}}
+
+    slot = await admission_controller.slot(app.Priority.INTERACTIVE)
+    response_body = app.format_as_ndjson(app.release_when_finished(answer(), slot))
+    assert admission_controller.active == 1
+    # The client disconnected before the response started, so none of the generators ran their cleanup
+    del slot, response_body
+    gc.collect()
+    assert admission_controller.active == 0
+
+
 @pytest.mark.asyncio
 async def test_ask_rtr_text_filter(auth_client, snapshot):
     response = await auth_client.post(
@@ -732,6 +860,97 @@ async def test_chat_stream_text(client, snapshot):
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest.mark.asyncio
+async def test_chat_socket(client, monkeypatch):
+    monkeypatch.setattr(app, "verify_recaptcha", lambda token: token == "valid")
+    verify_token = mock.AsyncMock(return_value={})
+    monkeypatch.setattr(client.app.config[app.CONFIG_AUTH_CLIENT], "get_auth_claims_if_enabled", verify_token)
+
+    # Websockets aren't subject to the same-origin policy, so the CORS setup checks their origin
+    async with client.websocket(
+        "/chat/ws", headers={"Origin": "https://frontend.com"}, query_string={"recaptcha_token": "valid"}
+    ) as socket:
+        for turn in ["first", "second"]:
+            await socket.send(
+                json.dumps(
+                    {
+                        "id": turn,
+                        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+                        "context": {"overrides": {"retrieval_mode": "text"}},
+                    }
+                )
+            )
+            events = []
+            while not events or not events[-1].get("done"):
+                events.append(json.loads(await socket.receive()))
+            assert all(event["id"] == turn for event in events)
+            assert events[0]["context"]["data_points"]["text"]
+            assert "".join(event["delta"]["content"] or "" for event in events[1:-1]).startswith("The capital")
+
+    # The connection was authenticated once, for both turns
+    verify_token.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_chat_socket_requires_recaptcha(client):
+    with pytest.raises(WebsocketResponseError) as error:
+        async with client.websocket("/chat/ws", headers={"Origin": "https://frontend.com"}) as socket:
+            await socket.receive()
+    assert error.value.response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_chat_socket_closes_when_token_expires(client, monkeypatch):
+    monkeypatch.setattr(app, "verify_recaptcha", lambda token: True)
+    verify_token = mock.AsyncMock(return_value={"oid": "OID_X", "groups": []})
+    monkeypatch.setattr(client.app.config[app.CONFIG_AUTH_CLIENT], "get_auth_claims_if_enabled", verify_token)
+    monkeypatch.setattr(app.AuthenticationHelper, "get_token_expiry", lambda token: time.time() + 0.1)
+
+    async with client.websocket(
+        "/chat/ws",
+        headers={"Origin": "https://frontend.com"},
+        query_string={"recaptcha_token": "valid"},
+        # The test client doesn't pass on its subprotocols argument
+        scope_base={"subprotocols": ["bearer", "MockToken"]},
+    ) as socket:
+        with pytest.raises(WebsocketDisconnectError) as error:
+            await socket.receive()
+    assert error.value.args[0] == 1008
+    assert verify_token.call_args.args[0]["Authorization"] == "Bearer MockToken"
+
+
+@pytest.mark.asyncio
+async def test_chat_socket_ignores_token_in_query_string(client, monkeypatch):
+    monkeypatch.setattr(app, "verify_recaptcha", lambda token: True)
+    verify_token = mock.AsyncMock(side_effect=app.AuthError("No token", 401))
+    monkeypatch.setattr(client.app.config[app.CONFIG_AUTH_CLIENT], "get_auth_claims_if_enabled", verify_token)
+
+    with pytest.raises(WebsocketResponseError):
+        async with client.websocket(
+            "/chat/ws",
+            headers={"Origin": "https://frontend.com"},
+            query_string={"recaptcha_token": "valid", "access_token": "MockToken"},
+        ) as socket:
+            await socket.receive()
+    assert "Authorization" not in verify_token.call_args.args[0]
+
+
+@pytest.mark.asyncio
+async def test_chat_socket_rejects_other_origins(client, monkeypatch):
+    # The origin is checked even when CORS isn't set up
+    client.app.config[app.CONFIG_ALLOWED_ORIGIN] = None
+    verify_token = mock.AsyncMock(return_value={})
+    monkeypatch.setattr(client.app.config[app.CONFIG_AUTH_CLIENT], "get_auth_claims_if_enabled", verify_token)
+
+    with pytest.raises(WebsocketResponseError) as error:
+        async with client.websocket(
+            "/chat/ws", headers={"Origin": "https://frontend.com"}, query_string={"recaptcha_token": "valid"}
+        ) as socket:
+            await socket.receive()
+    assert error.value.response.status_code == 403
+    verify_token.assert_not_awaited()
+
+
 @pytest.mark.asyncio
 async def test_chat_stream_text_filter(auth_client, snapshot):
     response = await auth_client.post(
@@ -879,6 +1098,101 @@ async def test_chat_stream_followup(client, snapshot):
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest_asyncio.fixture()
+async def conversation_store_client(
+    monkeypatch,
+    mock_env,
+    mock_openai_chatcompletion,
+    mock_openai_embedding,
+    mock_acs_search,
+    mock_blob_container_client,
+    mock_compute_embeddings_call,
+):
+    monkeypatch.setenv("USE_CONVERSATION_STORE", "true")
+    monkeypatch.setattr(app, "verify_recaptcha", lambda recaptcha_token: True)
+    quart_app = app.create_app()
+
+    async with quart_app.test_app() as test_app:
+        test_app.app.config.update({"TESTING": True})
+        mock_openai_chatcompletion(test_app.app.config[app.CONFIG_OPENAI_CLIENT])
+        mock_openai_embedding(test_app.app.config[app.CONFIG_OPENAI_CLIENT])
+        yield test_app.test_client()
+
+
+@pytest.mark.asyncio
+async def test_chat_conversation_store(conversation_store_client):
+    response = await conversation_store_client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    conversation_id = result["session_state"]["conversation_id"]
+
+    # The next turn only sends the new question
+    response = await conversation_store_client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What about Spain?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+            "session_state": result["session_state"],
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["session_state"]["conversation_id"] == conversation_id
+    # The stored history is part of the prompt
+    assert "What is the capital of France?" in json.dumps(result["context"]["thoughts"][-1]["description"])
+
+    conversation_store = conversation_store_client.app.config[app.CONFIG_CONVERSATION_STORE]
+    conversation = await conversation_store.get(conversation_id, "")
+    assert [message["content"] for message in conversation.messages[::2]] == [
+        "What is the capital of France?",
+        "What about Spain?",
+    ]
+    assert len(conversation.token_counts) == 4
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_conversation_store(conversation_store_client):
+    response = await conversation_store_client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+            "recaptcha_token": "token",
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    conversation_id = events[0]["session_state"]["conversation_id"]
+
+    conversation_store = conversation_store_client.app.config[app.CONFIG_CONVERSATION_STORE]
+    conversation = await conversation_store.get(conversation_id, "")
+    assert conversation.messages[1] == {
+        "role": "assistant",
+        "content": "".join(event["delta"].get("content") or "" for event in events),
+    }
+    # The admission slot is held until the answer has been streamed
+    assert conversation_store_client.app.config[app.CONFIG_ADMISSION_CONTROLLER].active == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_conversation_not_found(conversation_store_client):
+    response = await conversation_store_client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What about Spain?", "role": "user"}],
+            "session_state": {"conversation_id": "0" * 32},
+            "recaptcha_token": "token",
+        },
+    )
+    assert response.status_code == 409
+
+
 @pytest.mark.asyncio
 async def test_chat_vision(client, snapshot):
     response = await client.post(
@@ -960,6 +1274,26 @@ async def test_ask_vision(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_stream_vision(client, snapshot):
+    response = await client.post(
+        "/ask/stream",
+        json={
+            "messages": [{"content": "Are interest rates high?", "role": "user"}],
+            "context": {
+                "overrides": {
+                    "use_gpt4v": True,
+                    "gpt4v_input": "textAndImages",
+                    "vector_fields": ["embedding", "imageEmbedding"],
+                },
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_data()
+    snapshot.assert_match(result, "result.jsonlines")
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson():
     async def gen():
@@ -968,3 +1302,67 @@ async def test_format_as_ndjson():
 
     result = [line async for line in app.format_as_ndjson(gen())]
     assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "override, expected_seconds", [(None, 30), ("5", 5), (100, 30), (0, 30), (-1, 30), ("nan", 30)]
+)
+async def test_request_deadline(client, override, expected_seconds):
+    async with client.app.app_context():
+        client.app.config[app.CONFIG_REQUEST_DEADLINE] = 30.0
+        # The client can shorten the deadline, but not lengthen or remove it
+        assert app.request_deadline({"overrides": {"deadline": override}}).seconds == expected_seconds
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("route", ["/ask", "/ask/stream", "/chat", "/chat/stream"])
+async def test_invalid_deadline(client, route):
+    response = await client.post(
+        route,
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"deadline": "soon"}},
+        },
+    )
+    assert response.status_code == 400
+    assert (await response.get_json()) == {"error": "Invalid value for the deadline override: 'soon'"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("route", ["/chat", "/chat/stream"])
+async def test_chat_invalid_search_query_count(client, monkeypatch, route):
+    monkeypatch.setattr(app, "verify_recaptcha", lambda token: True)
+    response = await client.post(
+        route,
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"use_multi_query": True, "search_query_count": "many"}},
+            "recaptcha_token": "valid",
+        },
+    )
+    assert response.status_code == 400
+    assert (await response.get_json()) == {"error": "Invalid value for the search_query_count override: 'many'"}
+
+
+@pytest.mark.asyncio
+async def test_chat_multi_query_without_top(client, monkeypatch):
+    def mock_get_search_queries(self, chat_completion, query_text, count):
+        return [query_text, "capital city of France"]
+
+    monkeypatch.setattr(ChatReadRetrieveReadApproach, "get_search_queries", mock_get_search_queries)
+
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text", "use_multi_query": True}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    search_step = result["context"]["thoughts"][1]
+    assert len(search_step["description"]) == 2
+    # Without a top override, the fused results are cut to a whole number of results
+    assert isinstance(search_step["props"]["top"], int)
+    assert len(search_step["props"]["search_branches"]) == 2
@@ -129,3 +129,42 @@ async def test_app_config_for_client(client):
     assert result["showGPT4VOptions"] == (os.getenv("USE_GPT4V") == "true")
     assert result["showSemanticRankerOption"] is True
     assert result["showVectorOption"] is True
+
+
+@pytest.mark.asyncio
+async def test_app_startup_timings(monkeypatch, minimal_env):
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        timings = quart_app.config[app.CONFIG_STARTUP_TIMINGS]
+        assert timings["total"] >= 0
+        # The phases that always run account for the time spent setting up
+        phases = ("clients", "auth", "openai_client", "approaches")
+        assert all(timings[phase] >= 0 for phase in phases)
+        assert sum(timings[phase] for phase in phases) <= timings["total"]
+        # Neither authentication nor user upload is enabled, so those phases are skipped
+        assert "search_index" not in timings
+        assert "user_upload" not in timings
+
+
+@pytest.mark.asyncio
+async def test_app_user_upload_startup_timings(monkeypatch, minimal_env):
+    monkeypatch.setenv("USE_USER_UPLOAD", "true")
+    monkeypatch.setenv("AZURE_USERSTORAGE_ACCOUNT", "test-userstorage-account")
+    monkeypatch.setenv("AZURE_USERSTORAGE_CONTAINER", "test-userstorage-container")
+    monkeypatch.setenv("USE_LOCAL_PDF_PARSER", "true")
+    monkeypatch.setenv("USE_LOCAL_HTML_PARSER", "true")
+    monkeypatch.setenv("AZURE_DOCUMENTINTELLIGENCE_SERVICE", "test-documentintelligence-service")
+
+    quart_app = app.create_app()
+    async with quart_app.test_app():
+        assert quart_app.config[app.CONFIG_INGESTER] is not None
+        assert quart_app.config[app.CONFIG_STARTUP_TIMINGS]["user_upload"] >= 0
+
+
+def test_app_preload_shared_state(monkeypatch, minimal_env):
+    monkeypatch.setenv("USE_USER_UPLOAD", "true")
+    from prepdocslib.textsplitter import get_bpe
+
+    get_bpe.cache_clear()
+    app.preload_shared_state()
+    assert get_bpe.cache_info().currsize == 1
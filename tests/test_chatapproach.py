@@ -1,11 +1,19 @@
+import asyncio
 import json
+from unittest import mock
 
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
-from openai.types.chat import ChatCompletion
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from openai.types.completion_usage import PromptTokensDetails
 
+from approaches.approach import Document, InvalidOverrideError
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.deadline import DROPPED_SEMANTIC_RANKER, Deadline
+from approaches.reranker import LocalReranker
+from core.metrics import metrics
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
@@ -18,6 +26,21 @@ async def mock_search(*args, **kwargs):
     return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
 
 
+def make_document(id: str) -> Document:
+    return Document(
+        id=id,
+        content=id,
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        sourcepage=f"{id}.pdf",
+        sourcefile=f"{id}.pdf",
+        oids=None,
+        groups=None,
+        captions=[],
+    )
+
+
 @pytest.fixture
 def chat_approach():
     return ChatReadRetrieveReadApproach(
@@ -198,3 +221,473 @@ async def test_search_results_filtering_by_scores(
     assert (
         len(filtered_results) == expected_result_count
     ), f"Expected {expected_result_count} results with minimum_search_score={minimum_search_score} and minimum_reranker_score={minimum_reranker_score}"
+
+
+@pytest.mark.asyncio
+async def test_search_with_local_reranker_overfetches(monkeypatch):
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+    search_kwargs = {}
+
+    async def capture_search(*args, **kwargs):
+        search_kwargs.update(kwargs)
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", capture_search)
+
+    results = await chat_approach.search(
+        top=2,
+        query_text="test query",
+        filter=None,
+        vectors=[],
+        use_text_search=True,
+        use_vector_search=False,
+        use_semantic_ranker=False,
+        use_semantic_captions=False,
+        minimum_search_score=None,
+        minimum_reranker_score=None,
+        reranker=LocalReranker.from_overrides({"use_bm25": True, "rerank_candidates": 10}, top=2),
+    )
+
+    assert search_kwargs["top"] == 10
+    assert search_kwargs["select"] == ["id", "content", "category", "sourcepage", "sourcefile"]
+    assert len(results) == 1
+
+
+@pytest.mark.asyncio
+async def test_search_drops_semantic_ranker_after_deadline(monkeypatch):
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+    search_calls = []
+
+    async def slow_semantic_search(*args, **kwargs):
+        search_calls.append(kwargs)
+        if kwargs.get("query_type"):
+            await asyncio.sleep(1)
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", slow_semantic_search)
+    deadline = Deadline(0.1)
+
+    results = await chat_approach.search(
+        top=2,
+        query_text="test query",
+        filter=None,
+        vectors=[],
+        use_text_search=True,
+        use_vector_search=False,
+        use_semantic_ranker=True,
+        use_semantic_captions=True,
+        minimum_search_score=None,
+        minimum_reranker_score=2.0,
+        deadline=deadline,
+    )
+
+    assert len(results) == 1
+    assert [call.get("query_type") for call in search_calls] == ["semantic", None]
+    assert deadline.degradations == [DROPPED_SEMANTIC_RANKER]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "reranker, expected_select",
+    [
+        (None, ["id", "content", "category", "sourcepage", "sourcefile"]),
+        (
+            LocalReranker.from_overrides({"use_mmr": True}, top=2),
+            ["id", "content", "category", "sourcepage", "sourcefile", "embedding"],
+        ),
+    ],
+)
+async def test_search_selects_fields(monkeypatch, chat_approach, reranker, expected_select):
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    search_kwargs = {}
+
+    async def capture_search(*args, **kwargs):
+        search_kwargs.update(kwargs)
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", capture_search)
+
+    await chat_approach.search(
+        top=2,
+        query_text="test query",
+        filter=None,
+        vectors=[],
+        use_text_search=True,
+        use_vector_search=False,
+        use_semantic_ranker=True,
+        use_semantic_captions=False,
+        minimum_search_score=None,
+        minimum_reranker_score=None,
+        reranker=reranker,
+    )
+
+    assert search_kwargs["select"] == expected_select
+
+
+def make_search_sources_completion(arguments: dict) -> ChatCompletion:
+    return ChatCompletion.model_validate(
+        {
+            "id": "test",
+            "object": "chat.completion",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "tool_calls",
+                    "message": {
+                        "role": "assistant",
+                        "content": None,
+                        "tool_calls": [
+                            {
+                                "id": "call_1",
+                                "type": "function",
+                                "function": {"name": "search_sources", "arguments": json.dumps(arguments)},
+                            }
+                        ],
+                    },
+                }
+            ],
+        }
+    )
+
+
+def test_get_search_queries(chat_approach):
+    chat_completion = make_search_sources_completion(
+        {
+            "search_query": "business grants",
+            "search_queries": ["Business Grants", "funding for small businesses", "", "R&D loans", "export help"],
+        }
+    )
+    queries = chat_approach.get_search_queries(chat_completion, "business grants", 3)
+    assert queries == ["business grants", "funding for small businesses", "R&D loans"]
+
+
+def test_get_search_queries_without_variants(chat_approach):
+    chat_completion = make_search_sources_completion({"search_query": "business grants"})
+    assert chat_approach.get_search_queries(chat_completion, "business grants", 3) == ["business grants"]
+
+
+@pytest.mark.asyncio
+async def test_search_queries_fans_out_and_fuses(monkeypatch, chat_approach):
+    chat_approach.max_concurrent_searches = 2
+    running = 0
+    max_running = 0
+
+    async def mock_approach_search(top, query_text, *args, **kwargs):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return [make_document(f"{query_text}-only"), make_document("shared")]
+
+    monkeypatch.setattr(chat_approach, "search", mock_approach_search)
+
+    results, branch_stats = await chat_approach.search_queries(
+        2, ["one", "two", "three"], None, [[], [], []], True, False, False, False, None, None
+    )
+
+    assert max_running == 2
+    # Found by all three searches, so it's ranked first
+    assert [result.id for result in results] == ["shared", "one-only"]
+    assert [branch["query"] for branch in branch_stats] == ["one", "two", "three"]
+    assert all(branch["results"] == 2 and branch["latency"] >= 0 for branch in branch_stats)
+
+
+class EndlessChatCompletionStream:
+    def __init__(self):
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        return ChatCompletionChunk.model_validate(
+            {
+                "object": "chat.completion.chunk",
+                "choices": [{"delta": {"role": "assistant", "content": "more "}, "index": 0, "finish_reason": None}],
+                "id": "test-id",
+                "model": "gpt-35-turbo",
+                "created": 1,
+            }
+        )
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_closes_stream_on_disconnect(chat_approach, monkeypatch):
+    stream = EndlessChatCompletionStream()
+
+    async def create_stream():
+        return stream
+
+    async def mock_run_until_final_call(*args, **kwargs):
+        return {"data_points": []}, create_stream()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+    cancelled = metrics.counters["chat.stream.cancelled"]
+
+    events = chat_approach.run_with_streaming([{"role": "user", "content": "hi"}], {}, {})
+    assert (await events.__anext__())["context"] == {"data_points": []}
+    assert (await events.__anext__())["delta"]["content"] == "more "
+    # The client disconnects, and the server closes the response's generator
+    await events.aclose()
+
+    assert stream.closed
+    assert metrics.counters["chat.stream.cancelled"] == cancelled + 1
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_returns_summary_written_meanwhile(chat_approach, monkeypatch):
+    pending_state = {"pending_history_summary": {"message_count": 2, "messages_hash": "abc"}}
+    summary_state = {"history_summary": {"content": "summary", "message_count": 2, "messages_hash": "abc"}}
+    compactor = mock.Mock()
+    # Nothing to pick up when the request starts, and the summary is finished by the end of the answer
+    compactor.resolve.side_effect = [None, summary_state]
+    compactor.apply.side_effect = lambda messages, session_state: messages
+    compactor.start.return_value = (pending_state, None)
+    chat_approach.history_compactor = compactor
+
+    stream = EndlessChatCompletionStream()
+
+    async def create_stream():
+        return stream
+
+    async def mock_run_until_final_call(*args, **kwargs):
+        return {"data_points": []}, create_stream()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+
+    events = chat_approach.run_with_streaming([{"role": "user", "content": "hi"}], {}, {})
+    assert (await events.__anext__())["session_state"] == pending_state
+    assert (await events.__anext__())["delta"]["content"] == "more "
+    await stream.close()
+    assert [event async for event in events] == [{"delta": {"role": "assistant"}, "session_state": summary_state}]
+
+
+@pytest.mark.asyncio
+async def test_query_prompt_prefix_is_stable(chat_approach):
+    requests = []
+
+    class StopAfterRewrite(Exception):
+        pass
+
+    async def capture_create(**kwargs):
+        requests.append(kwargs)
+        raise StopAfterRewrite()
+
+    chat_approach.auth_helper = mock.Mock(**{"build_security_filters.return_value": None})
+    chat_approach.openai_client = mock.Mock()
+    chat_approach.openai_client.chat.completions.create = capture_create
+
+    for question, overrides in [
+        ("What grants are there?", {"use_multi_query": True, "search_query_count": 2}),
+        ("How do I register a company?", {"use_multi_query": True, "search_query_count": 4, "top": 5}),
+    ]:
+        with pytest.raises(StopAfterRewrite):
+            await chat_approach.run_until_final_call(
+                [{"role": "user", "content": question}], overrides, {}, should_stream=False
+            )
+
+    first, second = requests
+    assert first["tools"] == second["tools"] == [chat_approach.search_sources_multi_query_tool]
+    # Everything up to the user's question is the same, so the provider can reuse its cached prefix
+    assert first["messages"][:-1] == second["messages"][:-1]
+    assert "up to 3 variants" in second["messages"][-1]["content"]
+
+
+def test_get_search_query_count(chat_approach):
+    assert chat_approach.get_search_query_count({}) == 3
+    assert chat_approach.get_search_query_count({"search_query_count": "2"}) == 2
+    # At least the original query is searched, and at most max_search_queries
+    assert chat_approach.get_search_query_count({"search_query_count": 0}) == 1
+    assert chat_approach.get_search_query_count({"search_query_count": 100}) == chat_approach.max_search_queries
+    with pytest.raises(InvalidOverrideError):
+        chat_approach.get_search_query_count({"search_query_count": "many"})
+
+
+def test_record_usage(chat_approach):
+    cached = metrics.measurements["openai.cached_tokens"].total
+    usage = CompletionUsage(
+        prompt_tokens=1500,
+        completion_tokens=20,
+        total_tokens=1520,
+        prompt_tokens_details=PromptTokensDetails(cached_tokens=1024),
+    )
+
+    chat_approach.record_usage("answer", usage)
+    chat_approach.record_usage("answer", None)
+
+    assert metrics.measurements["openai.cached_tokens"].total == cached + 1024
+
+
+def make_rewrite_completion(arguments: dict) -> ChatCompletion:
+    return ChatCompletion.model_validate(
+        {
+            "id": "test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-35-turbo",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "tool_calls",
+                    "message": {
+                        "role": "assistant",
+                        "tool_calls": [
+                            {
+                                "id": "call",
+                                "type": "function",
+                                "function": {"name": "search_sources", "arguments": json.dumps(arguments)},
+                            }
+                        ],
+                    },
+                }
+            ],
+        }
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("overrides, expected_top", [({}, 3), ({"sources_token_budget": 2000}, 8)])
+async def test_only_explicit_token_budget_widens_search(monkeypatch, chat_approach, overrides, expected_top):
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    chat_approach.auth_helper = mock.Mock(**{"build_security_filters.return_value": None})
+    search_tops = []
+
+    async def capture_search(*args, **kwargs):
+        search_tops.append(kwargs["top"])
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", capture_search)
+
+    async def mock_create(**kwargs):
+        return make_rewrite_completion({"search_query": "capital of France"})
+
+    chat_approach.openai_client = mock.Mock()
+    chat_approach.openai_client.chat.completions.create = mock_create
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}],
+        {"retrieval_mode": "text", **overrides},
+        {},
+        should_stream=False,
+    )
+    chat_coroutine.close()
+
+    assert search_tops == [expected_top]
+    packed = next(thought for thought in extra_info["thoughts"] if thought.title == "Sources packed into token budget")
+    assert packed.props["token_budget"] == overrides.get("sources_token_budget", 3 * 250)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"retrieval_mode": "text", "use_bm25": True},
+        {"retrieval_mode": "text", "use_mmr": True, "rerank_candidates": 12.0},
+    ],
+)
+async def test_run_without_top_override(monkeypatch, chat_approach, overrides):
+    chat_approach.search_client = SearchClient(endpoint="", index_name="", credential=AzureKeyCredential(""))
+    chat_approach.auth_helper = mock.Mock(**{"build_security_filters.return_value": None})
+    search_tops = []
+
+    async def capture_search(*args, **kwargs):
+        search_tops.append(kwargs["top"])
+        return await mock_search(*args, **kwargs)
+
+    monkeypatch.setattr(SearchClient, "search", capture_search)
+
+    async def mock_create(**kwargs):
+        return make_rewrite_completion({"search_query": "capital of France"})
+
+    chat_approach.openai_client = mock.Mock()
+    chat_approach.openai_client.chat.completions.create = mock_create
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}], overrides, {}, should_stream=False
+    )
+    chat_coroutine.close()
+
+    # Without a top override, the default top is a whole number of results, which the reranker can slice by
+    assert all(isinstance(top, int) for top in search_tops)
+    assert isinstance(extra_info["thoughts"][1].props["top"], int)
+
+
+@pytest.mark.asyncio
+async def test_run_without_streaming_does_not_wait_for_summary(chat_approach, monkeypatch):
+    compactor = mock.Mock()
+    compactor.resolve.side_effect = lambda session_state: session_state
+    compactor.apply.side_effect = lambda messages, session_state: messages
+    summary_task = asyncio.create_task(asyncio.sleep(10))
+    compactor.start.return_value = ({"pending_history_summary": {"message_count": 2}}, summary_task)
+    chat_approach.history_compactor = compactor
+
+    async def answer():
+        return make_rewrite_completion({})
+
+    async def mock_run_until_final_call(*args, **kwargs):
+        return {"data_points": []}, answer()
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+
+    result = await asyncio.wait_for(
+        chat_approach.run_without_streaming([{"role": "user", "content": "hi"}], {}, {}), timeout=1
+    )
+
+    # The summary is picked up by the next request
+    assert result["session_state"] == {"pending_history_summary": {"message_count": 2}}
+    assert not summary_task.done()
+    summary_task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_run_without_streaming_cancels_summary_on_error(chat_approach, monkeypatch):
+    compactor = mock.Mock()
+    compactor.resolve.side_effect = lambda session_state: session_state
+    compactor.apply.side_effect = lambda messages, session_state: messages
+    summary_task = asyncio.create_task(asyncio.sleep(10))
+    compactor.start.return_value = ({}, summary_task)
+    chat_approach.history_compactor = compactor
+
+    async def mock_run_until_final_call(*args, **kwargs):
+        raise ValueError("The answer failed")
+
+    monkeypatch.setattr(chat_approach, "run_until_final_call", mock_run_until_final_call)
+
+    with pytest.raises(ValueError):
+        await chat_approach.run_without_streaming([{"role": "user", "content": "hi"}], {}, {})
+    await asyncio.sleep(0)
+    assert summary_task.cancelled()
@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import pytest
+
+from core.chatsocket import ChatSocket
+
+
+class FakeSocket:
+    def __init__(self):
+        self.received: asyncio.Queue = asyncio.Queue()
+        self.sent: asyncio.Queue = asyncio.Queue()
+
+    async def receive(self):
+        return await self.received.get()
+
+    async def send(self, event):
+        await self.sent.put(event)
+
+    async def next_events(self, count: int) -> list[dict]:
+        return [await asyncio.wait_for(self.sent.get(), timeout=1) for _ in range(count)]
+
+
+async def answer(request_json):
+    async def events():
+        for word in request_json["messages"][-1]["content"].split():
+            await asyncio.sleep(0)
+            yield {"delta": {"content": word}}
+
+    return events()
+
+
+def error_event(error):
+    return {"error": str(error)}
+
+
+@pytest.mark.asyncio
+async def test_chat_socket_multiplexes_turns():
+    socket = FakeSocket()
+    chat_socket = ChatSocket(socket.receive, socket.send, answer, error_event)
+    serving = asyncio.create_task(chat_socket.serve())
+
+    await socket.received.put(json.dumps({"id": 1, "messages": [{"content": "a b"}]}))
+    await socket.received.put(json.dumps({"id": 2, "messages": [{"content": "c"}]}))
+    events = await socket.next_events(5)
+
+    assert [event for event in events if event["id"] == 1] == [
+        {"id": 1, "delta": {"content": "a"}},
+        {"id": 1, "delta": {"content": "b"}},
+        {"id": 1, "done": True},
+    ]
+    assert [event for event in events if event["id"] == 2] == [
+        {"id": 2, "delta": {"content": "c"}},
+        {"id": 2, "done": True},
+    ]
+    assert chat_socket.turns == {}
+    serving.cancel()
+    await asyncio.gather(serving, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_chat_socket_cancels_turns():
+    socket = FakeSocket()
+    closed = asyncio.Event()
+
+    async def endless(request_json):
+        async def events():
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield {"delta": {"content": "more"}}
+            finally:
+                closed.set()
+
+        return events()
+
+    chat_socket = ChatSocket(socket.receive, socket.send, endless, error_event, max_pending_events=1)
+    serving = asyncio.create_task(chat_socket.serve())
+
+    await socket.received.put(json.dumps({"id": "turn", "messages": []}))
+    await socket.next_events(2)
+    await socket.received.put(json.dumps({"id": "turn", "cancel": True}))
+    await asyncio.wait_for(closed.wait(), timeout=1)
+
+    assert chat_socket.turns == {}
+    serving.cancel()
+    await asyncio.gather(serving, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_chat_socket_rejects_bad_messages():
+    socket = FakeSocket()
+
+    async def failing(request_json):
+        raise ValueError("no answer")
+
+    chat_socket = ChatSocket(socket.receive, socket.send, failing, error_event, heartbeat_interval=0.01, max_turns=0)
+    serving = asyncio.create_task(chat_socket.serve())
+
+    await socket.received.put("not json")
+    await socket.received.put(json.dumps({"id": 1, "messages": []}))
+    events = await socket.next_events(3)
+
+    assert events[0] == {"error": "Messages must be JSON objects with an id"}
+    assert events[1] == {"id": 1, "error": "Too many turns are running on this connection"}
+    assert events[2] == {"heartbeat": True}
+
+    chat_socket.max_turns = 1
+    await socket.received.put(json.dumps({"id": 2, "messages": []}))
+    event = {"heartbeat": True}
+    while event == {"heartbeat": True}:
+        [event] = await socket.next_events(1)
+    assert event == {"id": 2, "error": "no answer"}
+    serving.cancel()
+    await asyncio.gather(serving, return_exceptions=True)
@@ -0,0 +1,114 @@
+import tiktoken
+
+from approaches.approach import Document
+from approaches.contextpacker import MAX_CANDIDATES, ContextPacker
+
+
+def make_document(content: str, sourcepage: str, sourcefile: str, score: float) -> Document:
+    return Document(
+        id=sourcepage,
+        content=content,
+        embedding=None,
+        image_embedding=None,
+        category=None,
+        sourcepage=sourcepage,
+        sourcefile=sourcefile,
+        oids=None,
+        groups=None,
+        captions=[],
+        score=score,
+    )
+
+
+def pack(documents, token_budget=None):
+    packer = ContextPacker(tiktoken.get_encoding("cl100k_base"))
+    return packer.pack(
+        documents,
+        get_text=lambda doc: doc.content or "",
+        get_citation=lambda doc: doc.sourcepage or "",
+        token_budget=token_budget,
+    )
+
+
+def test_pack_removes_overlap_between_chunks():
+    overlap = "Applicants must register their business before applying."
+    first = make_document("Grants are available for small businesses. " + overlap, "grants.pdf#page=1", "grants.pdf", 2)
+    second = make_document(overlap + " Applications close in March.", "grants.pdf#page=2", "grants.pdf", 1)
+
+    packed = pack([first, second])
+
+    assert packed.sources_content == [
+        "grants.pdf#page=1: Grants are available for small businesses. " + overlap,
+        "grants.pdf#page=2: Applications close in March.",
+    ]
+    assert packed.tokens_saved > 0
+
+
+def test_pack_removes_overlap_at_end_of_chunk():
+    overlap = "Applicants must register their business before applying."
+    first = make_document("Grants are available for small businesses. " + overlap, "grants.pdf#page=1", "grants.pdf", 1)
+    second = make_document(overlap + " Applications close in March.", "grants.pdf#page=2", "grants.pdf", 2)
+
+    packed = pack([second, first])
+
+    assert packed.sources_content == [
+        "grants.pdf#page=2: " + overlap + " Applications close in March.",
+        "grants.pdf#page=1: Grants are available for small businesses.",
+    ]
+
+
+def test_pack_keeps_overlap_between_different_files():
+    overlap = "Applicants must register their business before applying."
+    first = make_document("Grants are available. " + overlap, "grants.pdf#page=1", "grants.pdf", 2)
+    second = make_document(overlap + " Loans are available.", "loans.pdf#page=1", "loans.pdf", 1)
+
+    packed = pack([first, second])
+
+    assert packed.sources_content[1] == "loans.pdf#page=1: " + overlap + " Loans are available."
+    assert packed.tokens_saved == 0
+
+
+def test_pack_removes_repeated_lines():
+    boilerplate = "Business.govt.nz - Small business support"
+    first = make_document(boilerplate + "\nGrants are available.", "grants.pdf#page=1", "grants.pdf", 2)
+    second = make_document(boilerplate + "\nLoans are available.", "grants.pdf#page=5", "grants.pdf", 1)
+
+    packed = pack([first, second])
+
+    assert packed.sources_content[1] == "grants.pdf#page=5: Loans are available."
+
+
+def test_pack_drops_near_duplicates():
+    content = " ".join(f"word{i}" for i in range(100))
+    first = make_document(content, "grants.pdf#page=1", "grants.pdf", 2)
+    second = make_document(content + " extra", "loans.pdf#page=1", "loans.pdf", 1)
+
+    packed = pack([first, second])
+
+    assert [doc.sourcepage for doc in packed.documents] == ["grants.pdf#page=1"]
+    assert packed.duplicates_removed == 1
+    assert packed.tokens_after < packed.tokens_before
+
+
+def test_pack_fills_token_budget_in_rank_order():
+    long = make_document("Long source. " * 50, "long.pdf", "long.pdf", 2)
+    short = make_document("Short source.", "short.pdf", "short.pdf", 1)
+    best = make_document("Best source.", "best.pdf", "best.pdf", 3)
+
+    packed = pack([best, long, short], token_budget=20)
+
+    # The long source doesn't fit, but the lower scoring short one still does
+    assert [doc.sourcepage for doc in packed.documents] == ["best.pdf", "short.pdf"]
+    assert packed.over_budget == 1
+    assert packed.tokens_after <= 20
+    assert packed.serialize_for_thoughts()["tokens_saved"] == packed.tokens_before - packed.tokens_after
+
+
+def test_candidates_fill_token_budget():
+    packer = ContextPacker(tiktoken.get_encoding("cl100k_base"))
+    # Without a budget, the top results are all that's used
+    assert packer.candidates(3, None) == 3
+    # A budget fetches enough results to fill it, but never fewer than top or more than the limit
+    assert packer.candidates(3, 2000) == 8
+    assert packer.candidates(10, 500) == 10
+    assert packer.candidates(3, 1_000_000) == MAX_CANDIDATES
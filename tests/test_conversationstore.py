@@ -0,0 +1,217 @@
+import copy
+import uuid
+from typing import Any, Optional
+
+import pytest
+
+from approaches.approach import Document
+from core.conversationstore import (
+    Conversation,
+    ConversationConflictError,
+    ConversationPersistence,
+    ConversationStore,
+)
+
+
+class MockConversationPersistence(ConversationPersistence):
+    def __init__(self):
+        self.blobs: dict[str, dict[str, Any]] = {}
+        self.etags: dict[str, str] = {}
+        self.downloads = 0
+
+    async def load(
+        self, conversation_id: str, etag: Optional[str] = None
+    ) -> Optional[tuple[Optional[dict[str, Any]], str]]:
+        if conversation_id not in self.blobs:
+            return None
+        if etag == self.etags[conversation_id]:
+            return None, etag
+        self.downloads += 1
+        return copy.deepcopy(self.blobs[conversation_id]), self.etags[conversation_id]
+
+    async def save(self, conversation_id: str, data: dict[str, Any], etag: Optional[str] = None) -> str:
+        if etag != self.etags.get(conversation_id):
+            raise ConversationConflictError(conversation_id)
+        self.blobs[conversation_id] = copy.deepcopy(data)
+        self.etags[conversation_id] = uuid.uuid4().hex
+        return self.etags[conversation_id]
+
+    async def delete(self, conversation_id: str):
+        self.blobs.pop(conversation_id, None)
+
+
+def make_turn(question: str) -> list:
+    return [{"role": "user", "content": question}, {"role": "assistant", "content": f"The answer to {question}"}]
+
+
+@pytest.mark.asyncio
+async def test_store_round_trip():
+    store = ConversationStore(chatgpt_model="gpt-35-turbo")
+    conversation = store.create("user1")
+    # Not stored until the first turn is saved
+    assert await store.get(conversation.id, "user1") is None
+
+    store.add_messages(conversation, make_turn("What is a grant?"))
+    await store.save(conversation)
+
+    assert await store.get(conversation.id, "user1") is conversation
+    assert len(conversation.token_counts) == 2
+    assert all(count > 0 for count in conversation.token_counts)
+
+
+@pytest.mark.asyncio
+async def test_store_checks_user_and_id():
+    store = ConversationStore(chatgpt_model="gpt-35-turbo")
+    conversation = store.create("user1")
+    await store.save(conversation)
+
+    assert await store.get(conversation.id, "user2") is None
+    assert await store.get("../" + conversation.id, "user1") is None
+    assert await store.get(None, "user1") is None  # type: ignore[arg-type]
+
+
+@pytest.mark.asyncio
+async def test_store_expires_conversations(monkeypatch):
+    persistence = MockConversationPersistence()
+    store = ConversationStore(chatgpt_model="gpt-35-turbo", persistence=persistence, ttl=60)
+    conversation = store.create("user1")
+    await store.save(conversation)
+
+    monkeypatch.setattr("time.time", lambda: conversation.updated_at + 61)
+    assert await store.get(conversation.id, "user1") is None
+    assert conversation.id not in store.conversations
+    assert conversation.id not in persistence.blobs
+
+
+@pytest.mark.asyncio
+async def test_store_limits_conversations_per_user():
+    store = ConversationStore(chatgpt_model="gpt-35-turbo", max_conversations_per_user=2)
+    conversations = [store.create("user1") for _ in range(3)]
+    for conversation in conversations:
+        await store.save(conversation)
+    anonymous = [store.create("") for _ in range(3)]
+    for conversation in anonymous:
+        await store.save(conversation)
+
+    # The least recently used conversation of the user is evicted
+    assert await store.get(conversations[0].id, "user1") is None
+    assert await store.get(conversations[2].id, "user1") is conversations[2]
+    # Anonymous users only share the global limit
+    assert all([await store.get(conversation.id, "") for conversation in anonymous])
+
+
+@pytest.mark.asyncio
+async def test_store_limits_conversations():
+    store = ConversationStore(chatgpt_model="gpt-35-turbo", max_conversations=2)
+    conversations = [store.create(f"user{i}") for i in range(3)]
+    for conversation in conversations:
+        await store.save(conversation)
+
+    assert list(store.conversations) == [conversations[1].id, conversations[2].id]
+    assert list(store.user_conversations) == ["user1", "user2"]
+
+
+@pytest.mark.asyncio
+async def test_store_loads_from_persistence():
+    persistence = MockConversationPersistence()
+    store = ConversationStore(chatgpt_model="gpt-35-turbo", persistence=persistence)
+    conversation = store.create("user1")
+    store.add_messages(conversation, make_turn("What is a grant?"))
+    await store.save(conversation)
+
+    # Another instance of the app
+    other_store = ConversationStore(chatgpt_model="gpt-35-turbo", persistence=persistence)
+    loaded = await other_store.get(conversation.id, "user1")
+    assert loaded is not None
+    assert loaded.messages == conversation.messages
+    assert loaded.token_counts == conversation.token_counts
+    assert conversation.id in other_store.conversations
+
+
+@pytest.mark.asyncio
+async def test_store_revalidates_conversation_in_memory():
+    persistence = MockConversationPersistence()
+    store = ConversationStore(chatgpt_model="gpt-35-turbo", persistence=persistence)
+    conversation = store.create("user1")
+    store.add_messages(conversation, make_turn("What is a grant?"))
+    await store.save(conversation)
+
+    # Unchanged, so the copy in memory is used without downloading it again
+    assert await store.get(conversation.id, "user1") is conversation
+    assert persistence.downloads == 0
+
+    # The next turn reaches another worker process
+    other_store = ConversationStore(chatgpt_model="gpt-35-turbo", persistence=persistence)
+    other_conversation = await other_store.get(conversation.id, "user1")
+    assert other_conversation is not None
+    other_store.add_messages(other_conversation, make_turn("How do I apply?"))
+    await other_store.save(other_conversation)
+
+    # The turn after that comes back to the first one, which picks up the newer turn instead of overwriting it
+    loaded = await store.get(conversation.id, "user1")
+    assert loaded is not None
+    assert loaded.messages == other_conversation.messages
+    store.add_messages(loaded, make_turn("What is the deadline?"))
+    await store.save(loaded)
+    assert len(persistence.blobs[conversation.id]["messages"]) == 6
+
+
+@pytest.mark.asyncio
+async def test_store_keeps_first_of_concurrent_turns():
+    persistence = MockConversationPersistence()
+    store = ConversationStore(chatgpt_model="gpt-35-turbo", persistence=persistence)
+    conversation = store.create("user1")
+    store.add_messages(conversation, make_turn("What is a grant?"))
+    await store.save(conversation)
+    other_store = ConversationStore(chatgpt_model="gpt-35-turbo", persistence=persistence)
+    other_conversation = await other_store.get(conversation.id, "user1")
+    assert other_conversation is not None
+
+    store.add_messages(conversation, make_turn("How do I apply?"))
+    await store.save(conversation)
+    other_store.add_messages(other_conversation, make_turn("What is the deadline?"))
+    await other_store.save(other_conversation)
+
+    assert persistence.blobs[conversation.id]["messages"] == conversation.messages
+    # The stale copy is dropped, so the next turn on that worker loads the saved one
+    assert conversation.id not in other_store.conversations
+
+
+def test_add_messages_drops_oldest_turns():
+    store = ConversationStore(chatgpt_model="gpt-35-turbo")
+    conversation = Conversation(id="conversation", user_id="user1")
+    store.add_messages(conversation, make_turn("What is a grant?") + make_turn("Who can apply?"))
+    store.max_history_tokens = sum(conversation.token_counts[2:]) + 1
+
+    store.add_messages(conversation, make_turn("How do I apply?"))
+
+    # Whole turns are dropped, so the history still starts with a user message
+    assert [message["content"] for message in conversation.messages[::2]] == ["How do I apply?"]
+    assert len(conversation.token_counts) == len(conversation.messages)
+
+
+def test_conversation_keeps_recent_results():
+    conversation = Conversation(id="conversation", user_id="user1")
+    results = [
+        [
+            Document(
+                id=str(i),
+                content="content",
+                embedding=None,
+                image_embedding=None,
+                category=None,
+                sourcepage="grants.pdf",
+                sourcefile="grants.pdf",
+                oids=None,
+                groups=None,
+                captions=[],
+            )
+        ]
+        for i in range(4)
+    ]
+    for i in range(4):
+        conversation.add_results(f"query{i}", results[i])
+
+    assert conversation.get_results("query0") is None
+    assert conversation.get_results("query3") is results[3]
+    assert "retrievals" not in conversation.serialize()
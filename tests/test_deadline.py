@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from approaches.deadline import SKIPPED_QUERY_REWRITE, Deadline
+from core.metrics import metrics
+
+
+async def slow_stage():
+    await asyncio.sleep(1)
+    return "done"
+
+
+@pytest.mark.asyncio
+async def test_deadline_degrades_slow_stage():
+    deadline = Deadline(0.1)
+    degradations = metrics.counters["deadline.degradations"]
+
+    assert await deadline.run(slow_stage(), 0.5, SKIPPED_QUERY_REWRITE) is None
+    assert await deadline.run(slow_stage(), 0.5, SKIPPED_QUERY_REWRITE) is None
+
+    assert deadline.degradations == [SKIPPED_QUERY_REWRITE]
+    assert metrics.counters["deadline.degradations"] == degradations + 2
+    assert deadline.remaining() < 0.1
+
+
+@pytest.mark.asyncio
+async def test_deadline_without_seconds_waits():
+    deadline = Deadline()
+
+    assert deadline.remaining() is None
+    assert await deadline.run(asyncio.sleep(0.01, result="done"), 0.1, SKIPPED_QUERY_REWRITE) == "done"
+    assert deadline.degradations == []
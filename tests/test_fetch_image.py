@@ -99,3 +99,21 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
     test_document.sourcepage = ""
     image_url = await fetch_image(blob_container_client, test_document)
     assert image_url is None
+
+
+def test_document_is_compact():
+    document = Document(
+        id="test",
+        content="test content",
+        embedding=None,
+        image_embedding=None,
+        oids=None,
+        groups=None,
+        captions=None,
+        category=None,
+        sourcefile="test.pdf",
+        sourcepage="test.pdf#page2",
+    )
+    assert not hasattr(document, "__dict__")
+    assert document.captions == []
+    assert document.serialize_for_results()["captions"] == []
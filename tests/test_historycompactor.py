@@ -0,0 +1,169 @@
+import asyncio
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+from approaches.historycompactor import HistoryCompactor
+
+
+class MockChatCompletions:
+    def __init__(self, answer: str, delay: float = 0):
+        self.answer = answer
+        self.delay = delay
+        self.calls: list[dict] = []
+
+    async def create(self, *args, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.delay)
+        return ChatCompletion.model_validate(
+            {
+                "id": "test-summary",
+                "object": "chat.completion",
+                "created": 1,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": self.answer},
+                    }
+                ],
+            }
+        )
+
+
+class MockOpenAIClient:
+    def __init__(self, completions: MockChatCompletions):
+        self.chat = type("MockChat", (), {"completions": completions})()
+
+
+def make_messages(turns: int) -> list:
+    messages = []
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"Question {turn} about business grants in New Zealand?"})
+        messages.append({"role": "assistant", "content": f"Answer {turn} with lots of detail [grants.pdf]. " * 10})
+    messages.append({"role": "user", "content": "Latest question?"})
+    return messages
+
+
+def make_compactor(completions: MockChatCompletions, **kwargs) -> HistoryCompactor:
+    return HistoryCompactor(
+        openai_client=MockOpenAIClient(completions),  # type: ignore[arg-type]
+        chatgpt_model="gpt-35-turbo",
+        summary_model="gpt-35-turbo",
+        summary_deployment="summary",
+        token_threshold=200,
+        **kwargs,
+    )
+
+
+def test_short_history_is_not_compacted():
+    compactor = make_compactor(MockChatCompletions("summary"))
+    messages = make_messages(1)
+    assert compactor.needs_compaction(messages, None) is False
+    assert compactor.apply(messages, None) == messages
+
+
+def test_unknown_session_state_is_not_compacted():
+    compactor = make_compactor(MockChatCompletions("summary"))
+    assert compactor.needs_compaction(make_messages(6), "not-a-dict") is False
+
+
+def next_turn(messages: list) -> list:
+    # The client sends the answer and a new question with the next request
+    return messages + [
+        {"role": "assistant", "content": "Latest answer."},
+        {"role": "user", "content": "Next question?"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_compact_and_apply():
+    completions = MockChatCompletions("The user asked about grants.")
+    compactor = make_compactor(completions)
+    messages = make_messages(6)
+
+    session_state, task = compactor.start(messages, None)
+    assert task is not None
+    # The response only says which summary is being written, so it doesn't wait for the summary
+    pending = session_state["pending_history_summary"]
+    assert pending["message_count"] == len(messages) - 4
+    await task
+    assert completions.calls[0]["model"] == "summary"
+
+    # The next request picks up the finished summary
+    next_messages = next_turn(messages)
+    session_state = compactor.resolve(session_state)
+    assert "pending_history_summary" not in session_state
+    summary = session_state["history_summary"]
+    assert summary["content"] == "The user asked about grants."
+    assert summary["message_count"] == pending["message_count"]
+    compacted = compactor.apply(next_messages, session_state)
+    assert compacted[0] == {
+        "role": "assistant",
+        "content": "Summary of the earlier conversation: The user asked about grants.",
+    }
+    assert compacted[1:] == next_messages[summary["message_count"] :]
+    assert compactor.summaries == {}
+
+
+@pytest.mark.asyncio
+async def test_summary_still_being_written_is_kept_pending():
+    completions = MockChatCompletions("summary", delay=1)
+    compactor = make_compactor(completions)
+    messages = make_messages(6)
+    session_state, task = compactor.start(messages, None)
+
+    # Until the summary is written, the next turn goes without it and doesn't start another one
+    next_messages = next_turn(messages)
+    assert compactor.resolve(session_state) == session_state
+    assert compactor.start(next_messages, session_state) == (session_state, None)
+    assert compactor.apply(next_messages, session_state) == next_messages
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_compact_merges_previous_summary():
+    completions = MockChatCompletions("Merged summary.")
+    compactor = make_compactor(completions)
+    messages = make_messages(6)
+    session_state = {
+        "history_summary": {
+            "content": "Earlier summary.",
+            "message_count": 2,
+            "messages_hash": HistoryCompactor.hash_messages(messages[:2]),
+        },
+        "other": "kept",
+    }
+
+    session_state, task = compactor.start(messages, session_state)
+    await task
+    session_state = compactor.resolve(session_state)
+
+    assert "Previous summary: Earlier summary." in completions.calls[0]["messages"][1]["content"]
+    assert session_state["other"] == "kept"
+    assert session_state["history_summary"]["content"] == "Merged summary."
+
+
+def test_summary_ignored_when_history_changes():
+    compactor = make_compactor(MockChatCompletions("summary"))
+    messages = make_messages(6)
+    session_state = {
+        "history_summary": {
+            "content": "Summary of a different conversation.",
+            "message_count": 4,
+            "messages_hash": HistoryCompactor.hash_messages(
+                [{"role": "user", "content": "A different question?"}] + messages[1:4]
+            ),
+        }
+    }
+    assert compactor.apply(messages, session_state) == messages
+
+
+@pytest.mark.asyncio
+async def test_summary_dropped_on_timeout():
+    compactor = make_compactor(MockChatCompletions("summary", delay=1), timeout=0.01)
+    session_state, task = compactor.start(make_messages(6), {"other": "kept"})
+    await task
+    # The next request goes without a summary, and can start another
+    assert compactor.resolve(session_state) == {"other": "kept"}
@@ -3,15 +3,17 @@ import io
 import os
 import tempfile
 
+import azure.storage.filedatalake
 import pytest
 
+from prepdocslib.filemanifest import FileManifest
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
     File,
     LocalListFileStrategy,
 )
 
-from .mocks import MockAzureCredential
+from .mocks import MockAsyncPageIterator, MockAzureCredential
 
 
 def test_file_filename():
@@ -41,7 +43,7 @@ def test_file_filename_to_id():
     # test ascii filename
     assert File(empty).filename_to_id() == "file-foo_pdf-666F6F2E706466"
     # test filename containing unicode
-    empty.name = "foo\u00A9.txt"
+    empty.name = "foo\u00a9.txt"
     assert File(empty).filename_to_id() == "file-foo__txt-666F6FC2A92E747874"
     # test filenaming starting with unicode
     empty.name = "ファイル名.pdf"
@@ -114,21 +116,57 @@ async def test_locallistfilestrategy_nesteddir():
         assert files[2].filename() == "c.pdf"
 
 
-def test_locallistfilestrategy_checkmd5():
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        with open(os.path.join(tmpdirname, "test.pdf"), "w") as pdf_file:
-            pdf_file.write("test")
-            f1_hash = hashlib.md5(b"test").hexdigest()
-        with open(os.path.join(tmpdirname, "test.pdf.md5"), "w", encoding="utf-8") as md5_file:
-            md5_file.write(f1_hash)
+@pytest.mark.asyncio
+async def test_locallistfilestrategy_manifest(tmp_path):
+    for filename in ["a.pdf", "b.pdf", "c.pdf"]:
+        (tmp_path / filename).write_text(filename)
+    manifest = FileManifest(str(tmp_path / ".prepdocs" / "manifest.sqlite"))
+
+    async def list_and_ingest() -> list[str]:
+        local_list_strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/*", manifest=manifest, hash_workers=2)
+        filenames = []
+        async for file in local_list_strategy.list():
+            filenames.append(file.filename())
+            local_list_strategy.mark_ingested(file)
+            file.close()
+        return sorted(filenames)
+
+    assert await list_and_ingest() == ["a.pdf", "b.pdf", "c.pdf"]
+    assert await list_and_ingest() == []
+    assert manifest.get(str(tmp_path / "a.pdf")).md5 == hashlib.md5(b"a.pdf").hexdigest()
+
+    # A file that was touched without changing is skipped once hashed, and a changed one is listed again
+    os.utime(tmp_path / "a.pdf", ns=(0, 0))
+    (tmp_path / "b.pdf").write_text("changed")
+    assert await list_and_ingest() == ["b.pdf"]
+    assert manifest.get(str(tmp_path / "a.pdf")).mtime_ns == 0
+
+    # A file that isn't marked as ingested, such as one that failed, is listed again
+    (tmp_path / "c.pdf").write_text("changed")
+    local_list_strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/*", manifest=manifest)
+    assert [file.filename() async for file in local_list_strategy.list()] == ["c.pdf"]
+    assert await list_and_ingest() == ["c.pdf"]
+
+    local_list_strategy.mark_removed(str(tmp_path / "a.pdf"))
+    assert await list_and_ingest() == ["a.pdf"]
+    local_list_strategy.mark_removed()
+    assert await list_and_ingest() == ["a.pdf", "b.pdf", "c.pdf"]
+    manifest.close()
 
-        local_list_strategy = LocalListFileStrategy(path_pattern=f"{tmpdirname}/*")
-        assert local_list_strategy.check_md5(md5_file.name) is True
-        assert local_list_strategy.check_md5(pdf_file.name) is True
-        # now change the file, hash should no longer match
-        with open(os.path.join(tmpdirname, "test.pdf"), "w") as pdf_file:
-            pdf_file.write("test2")
-        assert local_list_strategy.check_md5(pdf_file.name) is False
+
+@pytest.mark.asyncio
+async def test_locallistfilestrategy_reads_md5_files(tmp_path):
+    (tmp_path / "test.pdf").write_text("test")
+    (tmp_path / "test.pdf.md5").write_text(hashlib.md5(b"test").hexdigest())
+    (tmp_path / "changed.pdf").write_text("changed")
+    (tmp_path / "changed.pdf.md5").write_text(hashlib.md5(b"test").hexdigest())
+
+    local_list_strategy = LocalListFileStrategy(
+        path_pattern=f"{tmp_path}/*", manifest=FileManifest(str(tmp_path / ".prepdocs" / "manifest.sqlite"))
+    )
+    # The .md5 files written by earlier versions count as ingested, and aren't listed themselves
+    assert [file.filename() async for file in local_list_strategy.list()] == ["changed.pdf"]
+    assert local_list_strategy.manifest.get(str(tmp_path / "test.pdf")) is not None
 
 
 @pytest.mark.asyncio
@@ -145,3 +183,63 @@ async def test_read_adls_gen2_files(monkeypatch, mock_data_lake_service_client):
     assert files[1].acls == {"oids": ["B-USER-ID"], "groups": ["B-GROUP-ID"]}
     assert files[2].filename() == "c.txt"
     assert files[2].acls == {"oids": ["C-USER-ID"], "groups": ["C-GROUP-ID"]}
+    for file in files:
+        file.close()
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_same_name(monkeypatch, mock_data_lake_service_client):
+    def mock_get_paths(self, *args, **kwargs):
+        return MockAsyncPageIterator(
+            [azure.storage.filedatalake.PathProperties(name=path) for path in ["x/a.txt", "y/a.txt", "z/a.txt"]]
+        )
+
+    async def mock_get_access_control(self, *args, **kwargs):
+        return {"acl": f"user:{self.path[0].upper()}-USER-ID:r-x"}
+
+    download_kwargs = []
+
+    async def mock_download_file(self, *args, **kwargs):
+        download_kwargs.append(kwargs)
+        return azure.storage.filedatalake.aio.StorageStreamDownloader(None)
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.FileSystemClient, "get_paths", mock_get_paths)
+    monkeypatch.setattr(
+        azure.storage.filedatalake.aio.DataLakeFileClient, "get_access_control", mock_get_access_control
+    )
+    monkeypatch.setattr(azure.storage.filedatalake.aio.DataLakeFileClient, "download_file", mock_download_file)
+    adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a",
+        data_lake_filesystem="a",
+        data_lake_path="a",
+        credential=MockAzureCredential(),
+        prefetch=2,
+        download_concurrency=3,
+    )
+
+    files = [file async for file in adlsgen2_list_strategy.list()]
+    assert [file.filename() for file in files] == ["a.txt", "a.txt", "a.txt"]
+    assert [file.acls["oids"] for file in files] == [["X-USER-ID"], ["Y-USER-ID"], ["Z-USER-ID"]]
+    assert download_kwargs == [{"max_concurrency": 3}] * 3
+    # Each file is downloaded to a path of its own, which is deleted once the file is closed
+    paths = [file.content.name for file in files]
+    assert len(set(paths)) == 3
+    assert all(file.content.read() == b"texttext" for file in files)
+    for file in files:
+        file.close()
+    assert not any(os.path.exists(path) for path in paths)
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_stopped_early(monkeypatch, mock_data_lake_service_client, tmp_path):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a", data_lake_filesystem="a", data_lake_path="a", credential=MockAzureCredential()
+    )
+
+    files = adlsgen2_list_strategy.list()
+    first = await files.__anext__()
+    await files.aclose()
+    first.close()
+    # The files that were downloaded ahead but never listed are deleted too
+    assert os.listdir(tmp_path) == []
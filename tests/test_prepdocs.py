@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 import openai
@@ -11,6 +12,7 @@ from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     OpenAIEmbeddingService,
 )
+from prepdocslib.ratelimiter import RateLimiter, retry_after
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
@@ -31,6 +33,9 @@ class MockClient:
     def __init__(self, embeddings_client):
         self.embeddings = embeddings_client
 
+    async def close(self):
+        pass
+
 
 @pytest.mark.asyncio
 async def test_compute_embedding_success(monkeypatch):
@@ -210,3 +215,135 @@ async def test_compute_embedding_autherror(monkeypatch, capsys):
         )
         monkeypatch.setattr(embeddings, "create_client", create_auth_error_limit_client)
         await embeddings.create_embeddings(texts=["foo"])
+
+
+class EchoMockEmbeddingsClient:
+    """Embeds each text as its number, after a delay that finishes the later batches first"""
+
+    def __init__(self, rate_limited_calls: int = 0):
+        self.rate_limited_calls = rate_limited_calls
+        self.inputs: list[list[str]] = []
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        if self.rate_limited_calls > 0:
+            self.rate_limited_calls -= 1
+            raise openai.RateLimitError(
+                message="Rate limited on the OpenAI embeddings API",
+                response=Response(
+                    429, headers={"retry-after-ms": "10"}, request=Request(method="get", url="https://foo.bar/")
+                ),
+                body=None,
+            )
+        self.inputs.append(kwargs["input"])
+        await asyncio.sleep(0.01 / len(self.inputs))
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[float(text)], index=index, object="embedding")
+                for index, text in enumerate(kwargs["input"])
+            ],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_batches_concurrently(monkeypatch):
+    embeddings_client = EchoMockEmbeddingsClient(rate_limited_calls=1)
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential="key",
+        max_batch_size=3,
+        rate_limiter=RateLimiter(max_concurrency=4),
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    texts = [str(number) for number in range(10)]
+
+    assert await embeddings.create_embeddings(texts=texts) == [[float(number)] for number in range(10)]
+    assert sorted(embeddings_client.inputs) == [["0", "1", "2"], ["3", "4", "5"], ["6", "7", "8"], ["9"]]
+
+
+def test_retry_after():
+    def rate_limit_error(headers):
+        return openai.RateLimitError(
+            message="Rate limited",
+            response=Response(429, headers=headers, request=Request(method="get", url="https://foo.bar/")),
+            body=None,
+        )
+
+    assert retry_after(rate_limit_error({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after(rate_limit_error({"retry-after": "7"})) == 7
+    assert retry_after(rate_limit_error({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0
+    assert retry_after(rate_limit_error({"retry-after": "soon"})) is None
+    assert retry_after(rate_limit_error({})) is None
+    assert retry_after(ValueError("not an API error")) is None
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_paces_requests(monkeypatch):
+    now = 0.0
+    sleeps = []
+
+    async def mock_sleep(seconds):
+        nonlocal now
+        sleeps.append(seconds)
+        now += seconds
+
+    monkeypatch.setattr("prepdocslib.ratelimiter.time.monotonic", lambda: now)
+    monkeypatch.setattr("prepdocslib.ratelimiter.asyncio.sleep", mock_sleep)
+
+    # 600 tokens per minute allows 100 tokens in each 10 second window, refilled at 10 tokens a second
+    rate_limiter = RateLimiter(tokens_per_minute=600, requests_per_minute=60)
+    for _ in range(2):
+        async with rate_limiter.limit(100):
+            pass
+    assert sleeps == [10]
+
+    rate_limiter.pause(5)
+    async with rate_limiter.limit(10):
+        pass
+    assert sleeps == [10, 5]
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_reuses_client(monkeypatch):
+    created = []
+    closed = []
+
+    class ClosingMockClient(MockClient):
+        async def close(self):
+            closed.append(self)
+
+    async def mock_create_client(*args, **kwargs):
+        created.append(ClosingMockClient(embeddings_client=EchoMockEmbeddingsClient()))
+        return created[-1]
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential="key",
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    await embeddings.create_embeddings(texts=["1", "2"])
+    await embeddings.create_embeddings(texts=["3"])
+    assert len(created) == 1
+
+    await embeddings.close()
+    await embeddings.close()
+    assert closed == created
+    await embeddings.create_embeddings(texts=["4"])
+    assert len(created) == 2
+
+
+def test_calculate_token_lengths():
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME, open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS, credential="key"
+    )
+    texts = ["", "Hello world", "Contoso's benefits <|endoftext|> include dental"]
+    assert embeddings.calculate_token_lengths(texts) == [embeddings.calculate_token_length(text) for text in texts]
+    assert embeddings.calculate_token_lengths(texts)[:2] == [0, 2]
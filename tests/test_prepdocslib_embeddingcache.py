@@ -0,0 +1,105 @@
+import os
+import time
+
+import openai.types
+import pytest
+from openai.types.create_embedding_response import Usage
+
+from prepdocslib.embeddingcache import EmbeddingCache
+from prepdocslib.embeddings import OpenAIEmbeddingService
+
+from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME, MockClient
+
+
+def test_embedding_cache(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    assert cache.get("model", 3, ["a", "b"]) == [None, None]
+
+    cache.put("model", 3, [("a", [1.0, 2.0, 3.0]), ("b", [4.0, 5.0, 6.0])])
+    assert cache.get("model", 3, ["b", "c", "a"]) == [[4.0, 5.0, 6.0], None, [1.0, 2.0, 3.0]]
+    # The model and dimensions are part of the key
+    assert cache.get("model", 2, ["a"]) == [None]
+    assert cache.get("other-model", 3, ["a"]) == [None]
+    cache.close()
+
+    cache = EmbeddingCache(str(tmp_path))
+    assert cache.get("model", 3, ["a"]) == [[1.0, 2.0, 3.0]]
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["vectors_bytes"] == 2 * 3 * 4
+    assert stats["hits"] == 3
+    assert stats["misses"] == 5
+    assert stats["hit_rate"] == 3 / 8
+    cache.close()
+
+
+def test_embedding_cache_compact(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put("model", None, [("a", [1.0, 2.0]), ("b", [3.0, 4.0]), ("c", [5.0, 6.0, 7.0])])
+    # Replacing an embedding leaves the old vector in the file until compaction
+    cache.put("model", None, [("a", [8.0, 9.0])])
+    assert cache.stats()["reclaimable_bytes"] == 2 * 4
+
+    assert cache.compact() == 2 * 4
+    assert cache.stats()["reclaimable_bytes"] == 0
+    assert cache.get("model", None, ["a", "b", "c"]) == [[8.0, 9.0], [3.0, 4.0], [5.0, 6.0, 7.0]]
+
+    cache.db.execute("UPDATE embeddings SET last_used = ?", (time.time() - 10 * 24 * 60 * 60,))
+    cache.get("model", None, ["b"])
+    assert cache.compact(max_age_days=7) == 2 * 4 + 3 * 4
+    assert cache.get("model", None, ["a", "b", "c"]) == [None, [3.0, 4.0], None]
+    assert len([name for name in os.listdir(tmp_path) if name.startswith("vectors-")]) == 1
+    cache.close()
+
+
+def test_embedding_cache_after_torn_write(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put("model", None, [("a", [1.0, 2.0])])
+    # A run that was interrupted while appending wrote part of a row, and never added it to the index
+    [file] = [name for name in os.listdir(tmp_path) if name.startswith("vectors-")]
+    with open(tmp_path / file, "ab") as vectors:
+        vectors.write(b"\0" * 5)
+
+    cache.put("model", None, [("b", [3.0, 4.0]), ("c", [5.0, 6.0])])
+    assert cache.get("model", None, ["a", "b", "c"]) == [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]
+    assert cache.stats()["vectors_bytes"] == 3 * 2 * 4
+    cache.close()
+
+
+class CountingMockEmbeddingsClient:
+    def __init__(self):
+        self.inputs: list[str] = []
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        self.inputs.extend(kwargs["input"])
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[float(len(text))], index=index, object="embedding")
+                for index, text in enumerate(kwargs["input"])
+            ],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_create_embeddings_uses_cache(monkeypatch, tmp_path):
+    embeddings_client = CountingMockEmbeddingsClient()
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential="key",
+        cache=EmbeddingCache(str(tmp_path)),
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+
+    assert await embeddings.create_embeddings(["a", "bb", "a"]) == [[1.0], [2.0], [1.0]]
+    assert embeddings_client.inputs == ["a", "bb"]
+    assert await embeddings.create_embeddings(["ccc", "bb"]) == [[3.0], [2.0]]
+    assert embeddings_client.inputs == ["a", "bb", "ccc"]
+    await embeddings.close()
@@ -1,14 +1,20 @@
+import hashlib
+import io
 import os
+from typing import Optional
 
 import pytest
 from azure.search.documents.aio import SearchClient
 
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.fileprocessor import FileProcessor
-from prepdocslib.filestrategy import FileStrategy
+from prepdocslib.filestrategy import FileStrategy, UploadUserFileStrategy
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
+    File,
+    ListFileStrategy,
 )
+from prepdocslib.searchmanager import SearchManager
 from prepdocslib.strategy import SearchInfo
 from prepdocslib.textparser import TextParser
 from prepdocslib.textsplitter import SimpleTextSplitter
@@ -16,6 +22,23 @@ from prepdocslib.textsplitter import SimpleTextSplitter
 from .mocks import MockAzureCredential
 
 
+class AsyncSearchResultsIterator:
+    def __init__(self, results):
+        self.results = results
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self.results) == 0:
+            raise StopAsyncIteration
+        return self.results.pop()
+
+
+async def mock_search_no_results(self, *args, **kwargs):
+    return AsyncSearchResultsIterator([])
+
+
 @pytest.mark.asyncio
 async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service_client):
     adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
@@ -56,6 +79,7 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
         uploaded_to_search.extend(documents)
 
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "search", mock_search_no_results)
 
     file_strategy = FileStrategy(
         list_file_strategy=adlsgen2_list_strategy,
@@ -69,9 +93,15 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
 
     assert len(uploaded_to_blob) == 0
     assert len(uploaded_to_search) == 3
+    section_ids = [document.pop("id") for document in uploaded_to_search]
+    # The access control isn't part of the ids, so that a change to it updates the sections in place
+    assert [section_id.rpartition("-section-")[0].rpartition("-")[0] for section_id in section_ids] == [
+        "file-a_txt-612E747874",
+        "file-b_txt-622E747874",
+        "file-c_txt-632E747874",
+    ]
     assert uploaded_to_search == [
         {
-            "id": "file-a_txt-612E7478747B276F696473273A205B27412D555345522D4944275D2C202767726F757073273A205B27412D47524F55502D4944275D7D-page-0",
             "content": "texttext",
             "category": None,
             "groups": ["A-GROUP-ID"],
@@ -81,7 +111,6 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "storageUrl": "https://test.blob.core.windows.net/a.txt",
         },
         {
-            "id": "file-b_txt-622E7478747B276F696473273A205B27422D555345522D4944275D2C202767726F757073273A205B27422D47524F55502D4944275D7D-page-0",
             "content": "texttext",
             "category": None,
             "groups": ["B-GROUP-ID"],
@@ -91,7 +120,6 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "storageUrl": "https://test.blob.core.windows.net/b.txt",
         },
         {
-            "id": "file-c_txt-632E7478747B276F696473273A205B27432D555345522D4944275D2C202767726F757073273A205B27432D47524F55502D4944275D7D-page-0",
             "content": "texttext",
             "category": None,
             "groups": ["C-GROUP-ID"],
@@ -101,3 +129,194 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "storageUrl": "https://test.blob.core.windows.net/c.txt",
         },
     ]
+
+
+@pytest.mark.asyncio
+async def test_upload_user_file_strategy_deduplicates(monkeypatch):
+    copied = []
+    updated = []
+
+    async def mock_copy_content(self, file, content_hash):
+        copied.append((file.filename(), content_hash))
+        return ["copied-section"] if file.filename() == "copy.txt" else None
+
+    async def mock_update_content(self, sections, image_embeddings=None, url=None, content_hash=None, ids=None):
+        updated.append((sections[0].content.filename(), content_hash))
+
+    async def mock_get_indexed_sections(self, file, fields=None):
+        return {}
+
+    monkeypatch.setattr(SearchManager, "copy_content", mock_copy_content)
+    monkeypatch.setattr(SearchManager, "update_content", mock_update_content)
+    monkeypatch.setattr(SearchManager, "get_indexed_sections", mock_get_indexed_sections)
+
+    strategy = UploadUserFileStrategy(
+        search_info=SearchInfo(
+            endpoint="https://testsearchclient.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            index_name="test",
+        ),
+        file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter())},
+        deduplicate=True,
+    )
+
+    new_file = io.BytesIO(b"text")
+    new_file.name = "new.txt"
+    await strategy.add_file(File(new_file))
+    copy_file = io.BytesIO(b"text")
+    copy_file.name = "copy.txt"
+    await strategy.add_file(File(copy_file, content_hash="abc123"))
+
+    text_hash = hashlib.sha256(b"text").hexdigest()
+    assert copied == [("new.txt", text_hash), ("copy.txt", "abc123")]
+    # The copy isn't parsed or embedded
+    assert updated == [("new.txt", text_hash)]
+
+
+@pytest.mark.asyncio
+async def test_upload_user_file_strategy_replaces_earlier_upload(monkeypatch):
+    index: dict[str, dict] = {}
+
+    async def mock_search(self, *args, **kwargs):
+        return AsyncSearchResultsIterator([{"id": document["id"]} for document in index.values()])
+
+    async def mock_upload_documents(self, documents):
+        index.update((document["id"], document) for document in documents)
+
+    async def mock_delete_documents(self, documents):
+        for document in documents:
+            index.pop(document["id"])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    strategy = UploadUserFileStrategy(
+        search_info=SearchInfo(
+            endpoint="https://testsearchclient.blob.core.windows.net",
+            credential=MockAzureCredential(),
+            index_name="test",
+        ),
+        file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter(max_object_length=5))},
+    )
+
+    async def upload(content: bytes, oid: str):
+        stream = io.BytesIO(content)
+        stream.name = "a.txt"
+        # Each user's uploads are in a folder of their own
+        await strategy.add_file(File(stream, acls={"oids": [oid]}, url=f"https://test/user-content/{oid}/a.txt"))
+
+    await upload(b"aaaa bbbb", "OID_X")
+    await upload(b"aaaa bbbb", "OID_Y")
+    await upload(b"aaaa CCCC", "OID_X")
+
+    # The sections that are no longer in the user's file are removed, and other users' uploads are kept
+    contents = sorted((document["oids"][0], document["content"]) for document in index.values())
+    assert contents == [("OID_X", "CCCC"), ("OID_X", "aaaa "), ("OID_Y", "aaaa "), ("OID_Y", "bbbb")]
+
+
+class MemoryListFileStrategy(ListFileStrategy):
+    def __init__(self, contents: dict[str, bytes], acls: Optional[dict[str, list]] = None):
+        self.contents = contents
+        self.acls = acls
+
+    async def list(self):
+        for name, content in self.contents.items():
+            stream = io.BytesIO(content)
+            stream.name = name
+            yield File(stream, acls=self.acls)
+
+
+@pytest.mark.asyncio
+async def test_file_strategy_indexes_changed_sections(monkeypatch):
+    index: dict[str, dict] = {}
+    uploaded = []
+    merged = []
+    deleted = []
+
+    async def mock_search(self, *args, **kwargs):
+        filename = kwargs["filter"].removeprefix("sourcefile eq '").removesuffix("'")
+        return AsyncSearchResultsIterator(
+            [
+                {field: document.get(field) for field in kwargs["select"]}
+                for document in index.values()
+                if document["sourcefile"] == filename
+            ]
+        )
+
+    async def mock_upload_documents(self, documents):
+        uploaded.extend(documents)
+        index.update((document["id"], document) for document in documents)
+
+    async def mock_merge_documents(self, documents):
+        merged.extend(documents)
+        for document in documents:
+            index[document["id"]].update(document)
+
+    async def mock_delete_documents(self, documents):
+        deleted.extend(documents)
+        for document in documents:
+            index.pop(document["id"])
+
+    async def mock_upload_blob(self, file):
+        return None
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+    monkeypatch.setattr(BlobManager, "upload_blob", mock_upload_blob)
+
+    async def ingest(contents: dict[str, bytes], acls: Optional[dict[str, list]] = None):
+        uploaded.clear()
+        merged.clear()
+        deleted.clear()
+        await FileStrategy(
+            list_file_strategy=MemoryListFileStrategy(contents, acls),
+            blob_manager=BlobManager(
+                endpoint="https://test.blob.core.windows.net",
+                container="test",
+                account="test",
+                credential="key",
+                resourceGroup="test",
+                subscriptionId="test",
+            ),
+            search_info=SearchInfo(
+                endpoint="https://testsearchclient.blob.core.windows.net",
+                credential=MockAzureCredential(),
+                index_name="test",
+            ),
+            file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter(max_object_length=5))},
+            use_acls=True,
+        ).run()
+
+    await ingest({"a.txt": b"aaaa bbbb cccc dddd", "b.txt": b"aaaa"})
+    assert len(uploaded) == 5
+    assert deleted == []
+
+    # The same sections keep their ids, so nothing is uploaded again
+    await ingest({"a.txt": b"aaaa bbbb cccc dddd"})
+    assert uploaded == []
+    assert merged == []
+
+    # A change to the access control is merged into the sections, without embedding or uploading them again
+    await ingest({"a.txt": b"aaaa bbbb cccc dddd"}, acls={"oids": ["OID_X"], "groups": []})
+    assert uploaded == []
+    assert deleted == []
+    assert len(merged) == 4
+    assert all(document["oids"] == ["OID_X"] and "content" not in document for document in merged)
+    await ingest({"a.txt": b"aaaa bbbb cccc dddd"}, acls={"oids": ["OID_X"], "groups": []})
+    assert merged == []
+
+    # Only the edited section is uploaded, and the section that was cut is removed
+    await ingest({"a.txt": b"aaaa bbbb CCCC"})
+    assert [document["content"] for document in uploaded] == ["CCCC"]
+    assert len(deleted) == 2
+    # The access control was removed from the file, so also from its remaining sections
+    assert len(merged) == 2
+    assert sorted(document["content"] for document in index.values() if document["sourcefile"] == "a.txt") == [
+        "CCCC",
+        "aaaa ",
+        "bbbb ",
+    ]
+    assert len(index) == 4
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from prepdocslib.pipeline import PipelineStage, run_pipeline
+
+
+async def numbers(count: int):
+    for number in range(count):
+        yield number
+
+
+@pytest.mark.asyncio
+async def test_run_pipeline():
+    running = 0
+    most_running = 0
+    discarded = []
+
+    async def slow_double(number: int):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return number * 2
+
+    async def drop_zero(number: int):
+        return number or None
+
+    await run_pipeline(
+        numbers(6),
+        [PipelineStage("double", slow_double, workers=3), PipelineStage("drop", drop_zero)],
+        discarded.append,
+    )
+
+    assert most_running == 3
+    assert sorted(discarded) == [0, 2, 4, 6, 8, 10]
+
+
+@pytest.mark.asyncio
+async def test_run_pipeline_discards_items_on_failure():
+    fed = []
+    discarded = []
+
+    async def source():
+        async for number in numbers(10):
+            fed.append(number)
+            yield number
+
+    async def identity(number: int):
+        return number
+
+    async def fail_on_two(number: int):
+        if number == 2:
+            raise ValueError("bad item")
+        await asyncio.sleep(0.01)
+        return number
+
+    with pytest.raises(ValueError):
+        await run_pipeline(
+            source(),
+            [PipelineStage("identity", identity), PipelineStage("fail", fail_on_two)],
+            discarded.append,
+            queue_size=2,
+        )
+
+    # Every item that entered the pipeline left it, and the source stopped early
+    assert sorted(discarded) == fed
+    assert 2 in fed
+    assert len(fed) < 10
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from approaches.approach import Document
+from approaches.reranker import LocalReranker, reciprocal_rank_fusion
+
+
+def make_document(id: str, content: str, score: float, embedding=None) -> Document:
+    return Document(
+        id=id,
+        content=content,
+        embedding=embedding,
+        image_embedding=None,
+        category=None,
+        sourcepage=f"{id}.pdf",
+        sourcefile=f"{id}.pdf",
+        oids=None,
+        groups=None,
+        captions=[],
+        score=score,
+    )
+
+
+def test_from_overrides_disabled():
+    assert LocalReranker.from_overrides({}, top=3) is None
+
+
+def test_from_overrides_overfetches():
+    reranker = LocalReranker.from_overrides({"use_mmr": True}, top=3)
+    assert reranker is not None
+    assert reranker.candidates == 9
+    assert LocalReranker.from_overrides({"use_bm25": True, "rerank_candidates": 1}, top=3).candidates == 3
+    # Numbers from JSON may be floats, but the candidates are counted in whole results
+    assert LocalReranker.from_overrides({"use_bm25": True, "rerank_candidates": 12.0}, top=3).candidates == 12
+
+
+def test_bm25_prefers_matching_documents():
+    reranker = LocalReranker(top=2, candidates=3, use_bm25=True, bm25_weight=1.0)
+    documents = [
+        make_document("weather", "The weather is sunny today", 3.0),
+        make_document("grants", "Small business grants are available for exporters", 1.0),
+        make_document("loans", "Business loans need a business plan", 2.0),
+    ]
+
+    reranked = reranker.rerank(documents, "small business grants", None)
+
+    assert [document.id for document in reranked] == ["grants", "loans"]
+
+
+def test_bm25_scores_rarer_terms_higher():
+    reranker = LocalReranker(top=3, candidates=3, use_bm25=True)
+    scores = reranker.bm25_scores("tax grants", ["tax tax", "tax grants", "grants"])
+    assert scores[1] > scores[2] > 0
+    assert scores.shape == (3,)
+    assert np.all(reranker.bm25_scores("", ["tax"]) == 0)
+
+
+def test_mmr_skips_near_duplicates():
+    reranker = LocalReranker(top=2, candidates=3, use_mmr=True, mmr_lambda=0.5)
+    documents = [
+        make_document("first", "a", 3.0, embedding=[1.0, 0.0, 0.0]),
+        make_document("duplicate", "b", 2.9, embedding=[0.99, 0.01, 0.0]),
+        make_document("different", "c", 2.0, embedding=[0.0, 1.0, 0.0]),
+    ]
+
+    reranked = reranker.rerank(documents, "query", query_vector=None)
+
+    assert [document.id for document in reranked] == ["first", "different"]
+
+
+def test_mmr_uses_query_vector():
+    reranker = LocalReranker(top=1, candidates=2, use_mmr=True, mmr_lambda=1.0)
+    documents = [
+        make_document("first", "a", 3.0, embedding=[1.0, 0.0]),
+        make_document("second", "b", 1.0, embedding=[0.0, 1.0]),
+    ]
+
+    reranked = reranker.rerank(documents, "query", query_vector=[0.0, 2.0])
+
+    assert [document.id for document in reranked] == ["second"]
+
+
+@pytest.mark.parametrize("embedding", [None, []])
+def test_mmr_without_embeddings_sorts_by_score(embedding):
+    reranker = LocalReranker(top=2, candidates=3, use_mmr=True)
+    documents = [
+        make_document("low", "a", 1.0, embedding=embedding),
+        make_document("high", "b", 3.0, embedding=embedding),
+        make_document("middle", "c", 2.0, embedding=embedding),
+    ]
+
+    reranked = reranker.rerank(documents, "query", query_vector=None)
+
+    assert [document.id for document in reranked] == ["high", "middle"]
+
+
+def test_reciprocal_rank_fusion():
+    a, b, c, d = (make_document(id, id, 1.0) for id in "abcd")
+    fused = reciprocal_rank_fusion([[a, b, c], [b, c, d], [b, a]], top=3)
+    # b is found by every search, and ranked higher than a by two of them
+    assert fused == [b, a, c]
+
+
+def test_reciprocal_rank_fusion_merges_same_document():
+    first = make_document("a", "first copy", 1.0)
+    second = make_document("a", "second copy", 2.0)
+    fused = reciprocal_rank_fusion([[first], [second]], top=3)
+    assert len(fused) == 1
+    assert fused[0] is first
@@ -169,7 +169,8 @@ async def test_create_index_acls(monkeypatch, search_info):
     await manager.create_index()
     assert len(indexes) == 1, "It should have created one index"
     assert indexes[0].name == "test"
-    assert len(indexes[0].fields) == 9
+    assert len(indexes[0].fields) == 10
+    assert "contentHash" in [field.name for field in indexes[0].fields]
 
 
 @pytest.mark.asyncio
@@ -204,6 +205,44 @@ async def test_update_content(monkeypatch, search_info):
     )
 
 
+def test_section_ids(search_info):
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io, acls={"oids": ["OID_X"]})
+    sections = [
+        Section(split_page=SplitPage(page_num=page_num, text=text), content=file, category="test")
+        for page_num, text in [(0, "intro"), (1, "repeated"), (1, "repeated"), (2, "end")]
+    ]
+
+    manager = SearchManager(search_info)
+    ids = manager.section_ids(file, sections)
+    assert all(
+        section_id.startswith(f"file-foo_pdf-666F6F2E706466-{file.location_to_id()}-section-") for section_id in ids
+    )
+    # Repeated sections are kept apart, and a section keeps its id when the ones before it change
+    assert len(set(ids)) == 4
+    assert manager.section_ids(file, sections[1:]) == ids[1:]
+    # Only the text is part of the id, so moving a section to another page, or changing its access control, doesn't
+    # change it
+    moved = Section(split_page=SplitPage(page_num=3, text="end"), content=file, category="other")
+    assert manager.section_ids(File(test_io), [moved]) == ids[3:]
+    # Files with the same name in other folders, such as the uploads of different users, each have their own sections
+    other_io = io.BytesIO(b"test content")
+    other_io.name = "other/foo.pdf"
+    assert manager.section_ids(File(other_io), sections[:1]) != ids[:1]
+    assert manager.section_ids(File(test_io, url="https://test/OID_Y/foo.pdf"), sections[:1]) != ids[:1]
+
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=AzureKeyCredential("test"),
+    )
+    manager_with_embeddings = SearchManager(search_info, embeddings=embeddings)
+    assert manager_with_embeddings.section_ids(file, sections) != ids
+
+
 @pytest.mark.asyncio
 async def test_update_content_many(monkeypatch, search_info):
     ids = []
@@ -489,3 +528,124 @@ async def test_remove_content_no_inf_loop(monkeypatch, search_info):
     assert len(searched_filters) == 1, "It should have searched once"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 0, "It should have deleted no documents"
+
+
+@pytest.mark.asyncio
+async def test_get_indexed_sections(monkeypatch, search_info):
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "foo.pdf"
+    file = File(test_io, acls={"oids": ["OID_X"]}, url="https://test/content/a/foo.pdf")
+    other_io = io.BytesIO(b"test content")
+    other_io.name = "foo.pdf"
+    other_file = File(other_io, acls={"oids": ["OID_Y"]}, url="https://test/content/b/foo.pdf")
+    manager = SearchManager(search_info)
+    section = Section(split_page=SplitPage(page_num=0, text="text"), content=file, category=None)
+    [section_id] = manager.section_ids(file, [section])
+    [other_section_id] = manager.section_ids(other_file, [section])
+
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return AsyncSearchResultsIterator(
+            [
+                {"id": section_id, "storageUrl": "https://test/content/a/foo.pdf"},
+                {"id": other_section_id, "storageUrl": "https://test/content/b/foo.pdf"},
+                # Indexed before the ids were derived from the text, with the access control of the time
+                {"id": f"{file.filename_to_id()}-page-0", "storageUrl": "https://test/content/a/foo.pdf"},
+                {"id": f"{other_file.filename_to_id()}-page-0", "storageUrl": "https://test/content/b/foo.pdf"},
+            ]
+        )
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    indexed = await manager.get_indexed_sections(file, fields=["oids"])
+    assert searches[0]["filter"] == "sourcefile eq 'foo.pdf'"
+    assert searches[0]["select"] == ["id", "oids", "storageUrl"]
+    # The sections of the file in the other folder are left alone
+    assert sorted(indexed) == sorted([section_id, f"{file.filename_to_id()}-page-0"])
+
+
+@pytest.mark.asyncio
+async def test_copy_content(monkeypatch, search_info):
+    search_results = AsyncSearchResultsIterator(
+        [
+            {
+                "id": f"file-{name}_pdf-{oid}-section-{i}",
+                "content": f"content {i}",
+                "category": None,
+                "sourcepage": f"{name}.pdf#page={i + 1}",
+                "sourcefile": f"{name}.pdf",
+                "embedding": [0.1 * i],
+            }
+            for name, oid in (("form", "A"), ("copy", "B"))
+            for i in range(3)
+        ]
+        # Sections with positional ids from before sections had content-derived ids aren't copied
+        + [{"id": "file-old_pdf-C-page-0", "content": "old", "sourcepage": "old.pdf#page=1", "sourcefile": "old.pdf"}]
+    )
+
+    searched_filters = []
+
+    async def mock_search(self, *args, **kwargs):
+        searched_filters.append(kwargs.get("filter"))
+        return search_results
+
+    documents_uploaded = []
+
+    async def mock_upload_documents(self, documents):
+        documents_uploaded.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+
+    manager = SearchManager(search_info, use_acls=True)
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "My Form.PDF"
+    file = File(test_io, acls={"oids": ["OID_X"]}, url="https://test/My Form.PDF")
+
+    ids = await manager.copy_content(file, "abc123")
+    assert searched_filters == ["contentHash eq 'abc123'"]
+    # The sections of only one of the earlier uploads are copied
+    assert sorted(document["content"] for document in documents_uploaded) == ["content 0", "content 1", "content 2"]
+    # The copies have the ids and documents that parsing the file would give them
+    sections = [
+        Section(split_page=SplitPage(page_num=i, text=f"content {i}"), content=file, category=None) for i in range(3)
+    ]
+    expected_ids = manager.section_ids(file, sections)
+    assert ids is not None and sorted(ids) == sorted(expected_ids)
+    copied = next(document for document in documents_uploaded if document["content"] == "content 1")
+    assert copied == {
+        "id": expected_ids[1],
+        "content": "content 1",
+        "category": None,
+        "sourcepage": "My Form.PDF#page=2",
+        "sourcefile": "My Form.PDF",
+        "contentHash": "abc123",
+        "oids": ["OID_X"],
+        "storageUrl": "https://test/My Form.PDF",
+        "embedding": [0.1],
+    }
+
+
+@pytest.mark.asyncio
+async def test_copy_content_needs_same_extension(monkeypatch, search_info):
+    async def mock_search(self, *args, **kwargs):
+        return AsyncSearchResultsIterator(
+            [
+                {
+                    "id": "file-form_txt-A-section-0",
+                    "content": "content",
+                    "category": None,
+                    "sourcepage": "form.txt",
+                    "sourcefile": "form.txt",
+                }
+            ]
+        )
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    manager = SearchManager(search_info, use_acls=True)
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "form.md"
+    assert await manager.copy_content(File(test_io), "abc123") is None
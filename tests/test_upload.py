@@ -13,9 +13,10 @@ from openai.types.create_embedding_response import (
 )
 from quart.datastructures import FileStorage
 
+import app
 from prepdocslib.embeddings import AzureOpenAIEmbeddingService
 
-from .mocks import MockClient, MockEmbeddingsClient
+from .mocks import MockAsyncPageIterator, MockClient, MockEmbeddingsClient
 
 
 # parameterize for directory existing or not
@@ -51,12 +52,37 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
 
     monkeypatch.setattr(DataLakeDirectoryClient, "get_file_client", mock_directory_get_file_client)
 
-    async def mock_upload_file(self, *args, **kwargs):
-        assert kwargs.get("overwrite") is True
+    appended = []
+
+    async def mock_create_file(self, *args, **kwargs):
         assert kwargs.get("metadata") == {"UploadedBy": "OID_X"}
         return None
 
-    monkeypatch.setattr(DataLakeFileClient, "upload_data", mock_upload_file)
+    async def mock_append_data(self, data, offset, length=None):
+        assert offset == sum(len(block) for block in appended)
+        appended.append(data)
+
+    async def mock_flush_data(self, offset, *args, **kwargs):
+        assert offset == len(b"foo;bar")
+
+    async def mock_set_metadata(self, metadata, *args, **kwargs):
+        assert metadata["UploadedBy"] == "OID_X"
+        assert len(metadata["ContentHash"]) == 64
+
+    monkeypatch.setattr(DataLakeFileClient, "create_file", mock_create_file)
+    monkeypatch.setattr(DataLakeFileClient, "append_data", mock_append_data)
+    monkeypatch.setattr(DataLakeFileClient, "flush_data", mock_flush_data)
+    renamed = []
+
+    async def mock_rename_file(self, new_name, *args, **kwargs):
+        renamed.append((self.path_name, new_name))
+        file_system_name, _, path = new_name.partition("/")
+        return DataLakeFileClient(
+            account_url="https://test.blob.core.windows.net/", file_system_name=file_system_name, file_path=path
+        )
+
+    monkeypatch.setattr(DataLakeFileClient, "set_metadata", mock_set_metadata)
+    monkeypatch.setattr(DataLakeFileClient, "rename_file", mock_rename_file)
 
     async def mock_create_client(self, *args, **kwargs):
         # From https://platform.openai.com/docs/api-reference/embeddings/create
@@ -86,7 +112,12 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
     async def mock_upload_documents(self, documents):
         documents_uploaded.extend(documents)
 
+    async def mock_search(self, *args, **kwargs):
+        # The user hasn't uploaded the file before
+        return MockAsyncPageIterator(data=[])
+
     monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "search", mock_search)
     monkeypatch.setattr(AzureOpenAIEmbeddingService, "create_client", mock_create_client)
 
     response = await auth_client.post(
@@ -96,15 +127,27 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
     )
     message = (await response.get_json())["message"]
     assert message == "File uploaded successfully"
-    assert response.status_code == 200
+    assert response.status_code == 202
+
+    # The file is ingested in the background
+    await auth_client.app.config[app.CONFIG_UPLOAD_QUEUE].join()
+    response = await auth_client.get("/upload/status", headers={"Authorization": "Bearer test"})
+    assert (await response.get_json()) == [{"filename": "a.txt", "status": "succeeded", "attempts": 1, "error": None}]
     assert len(documents_uploaded) == 1
-    assert documents_uploaded[0]["id"] == "file-a_txt-612E7478747B276F696473273A205B274F49445F58275D7D-page-0"
+    # The user's folder is part of the id, so the uploads of other users with the same name have their own sections
+    assert documents_uploaded[0]["id"].startswith("file-a_txt-612E747874-")
+    assert documents_uploaded[0]["id"].rpartition("-section-")[0] != "file-a_txt-612E747874"
     assert documents_uploaded[0]["sourcepage"] == "a.txt"
     assert documents_uploaded[0]["sourcefile"] == "a.txt"
     assert documents_uploaded[0]["embedding"] == [0.0023064255, -0.009327292, -0.0028842222]
     assert documents_uploaded[0]["category"] is None
     assert documents_uploaded[0]["oids"] == ["OID_X"]
     assert directory_created[0] == (not directory_exists)
+    assert b"".join(appended) == b"foo;bar"
+    # The file was written to a partial file, which replaced any earlier upload only once it was complete
+    assert len(renamed) == 1
+    assert renamed[0][0].startswith("a.txt.") and renamed[0][0].endswith(".partial")
+    assert renamed[0][1] == "user-content/a.txt"
 
 
 @pytest.mark.asyncio
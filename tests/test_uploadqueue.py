@@ -0,0 +1,134 @@
+import asyncio
+import io
+
+import pytest
+
+from core.uploadqueue import UploadJob, UploadQueue, UploadStatus
+from prepdocslib.listfilestrategy import File
+
+
+class MockIngester:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.files: list[str] = []
+
+    async def add_file(self, file: File):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Embeddings service unavailable")
+        self.files.append(file.filename())
+
+
+def make_job(filename: str, user_oid: str = "OID_X") -> UploadJob:
+    async def open_file() -> File:
+        content = io.BytesIO(b"foo;bar")
+        content.name = filename
+        return File(content=content, acls={"oids": [user_oid]})
+
+    return UploadJob(user_oid=user_oid, filename=filename, open_file=open_file)
+
+
+async def run_queue(upload_queue: UploadQueue):
+    upload_queue.start()
+    await upload_queue.join()
+    await upload_queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_retries():
+    ingester = MockIngester(failures=1)
+    upload_queue = UploadQueue(ingester, retry_delay=0)  # type: ignore[arg-type]
+    job = make_job("a.txt")
+    upload_queue.submit(job)
+
+    await run_queue(upload_queue)
+
+    assert ingester.files == ["a.txt"]
+    assert job.serialize() == {"filename": "a.txt", "status": "succeeded", "attempts": 2, "error": None}
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_gives_up():
+    ingester = MockIngester(failures=5)
+    upload_queue = UploadQueue(ingester, max_attempts=3, retry_delay=0)  # type: ignore[arg-type]
+    job = make_job("a.txt")
+    upload_queue.submit(job)
+
+    await run_queue(upload_queue)
+
+    assert job.status == UploadStatus.FAILED
+    assert job.attempts == 3
+    assert job.error == "Embeddings service unavailable"
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_skips_superseded_and_cancelled_jobs():
+    ingester = MockIngester()
+    upload_queue = UploadQueue(ingester)  # type: ignore[arg-type]
+    first, second, deleted = make_job("a.txt"), make_job("a.txt"), make_job("b.txt")
+    for job in (first, second, deleted):
+        upload_queue.submit(job)
+    await upload_queue.cancel("OID_X", "b.txt")
+
+    await run_queue(upload_queue)
+
+    assert ingester.files == ["a.txt"]
+    assert first.attempts == 0
+    assert upload_queue.get_jobs("OID_X") == [second]
+    assert upload_queue.get_jobs("OID_Y") == []
+
+
+class BlockingIngester(MockIngester):
+    def __init__(self):
+        super().__init__()
+        self.started = asyncio.Event()
+        self.cancelled = False
+
+    async def add_file(self, file: File):
+        if file.filename() == "slow.txt":
+            self.started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+        await super().add_file(file)
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_cancels_job_in_progress():
+    ingester = BlockingIngester()
+    upload_queue = UploadQueue(ingester, workers=1)  # type: ignore[arg-type]
+    slow, other = make_job("slow.txt"), make_job("other.txt")
+    upload_queue.submit(slow)
+    upload_queue.submit(other)
+    upload_queue.start()
+    await ingester.started.wait()
+
+    await upload_queue.cancel("OID_X", "slow.txt")
+
+    assert ingester.cancelled
+    assert slow.status == UploadStatus.CANCELLED
+    await upload_queue.join()
+    await upload_queue.stop()
+    # The worker carries on with the next job
+    assert ingester.files == ["other.txt"]
+    assert upload_queue.get_jobs("OID_X") == [other]
+
+
+def test_upload_queue_is_bounded():
+    upload_queue = UploadQueue(MockIngester(), max_size=1)  # type: ignore[arg-type]
+    upload_queue.submit(make_job("a.txt"))
+    with pytest.raises(asyncio.QueueFull):
+        upload_queue.submit(make_job("b.txt"))
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_forgets_finished_jobs(monkeypatch):
+    upload_queue = UploadQueue(MockIngester(), status_ttl=60)  # type: ignore[arg-type]
+    job = make_job("a.txt")
+    upload_queue.submit(job)
+    await run_queue(upload_queue)
+
+    monkeypatch.setattr("time.time", lambda: job.updated_at + 61)
+    assert upload_queue.get_jobs("OID_X") == []
@@ -0,0 +1,188 @@
+import hashlib
+import os
+from typing import Optional
+
+import pytest
+
+from core.uploadstream import is_partial_file, partial_file_name, receive_file
+
+BOUNDARY = b"boundary"
+
+
+def make_body(content: bytes, filename: str = "a.txt") -> bytes:
+    return b"".join(
+        [
+            b"--" + BOUNDARY + b"\r\n",
+            b'Content-Disposition: form-data; name="note"\r\n\r\n',
+            b"not a file\r\n",
+            b"--" + BOUNDARY + b"\r\n",
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'.encode(),
+            b"Content-Type: text/plain\r\n\r\n",
+            content + b"\r\n",
+            b"--" + BOUNDARY + b"--\r\n",
+        ]
+    )
+
+
+async def chunks(body: bytes, size: int):
+    for i in range(0, len(body), size):
+        yield body[i : i + size]
+
+
+class MockFileClient:
+    def __init__(self, filename: str, lake: Optional[dict[str, bytes]] = None):
+        self.file_system_name = "user-content"
+        self.path_name = f"OID_X/{filename}"
+        self.url = f"https://test.dfs.core.windows.net/user-content/{self.path_name}"
+        # The content of the files in the data lake, by path
+        self.lake = {} if lake is None else lake
+        self.appended: list[bytes] = []
+        self.flushed_offset = None
+        self.metadata: dict[str, str] = {}
+
+    @property
+    def created(self) -> bool:
+        return self.path_name in self.lake
+
+    async def create_file(self, metadata=None):
+        self.lake[self.path_name] = b""
+        self.metadata = metadata
+
+    async def delete_file(self):
+        del self.lake[self.path_name]
+
+    async def append_data(self, data, offset, length=None):
+        assert offset == sum(len(block) for block in self.appended)
+        self.appended.append(data)
+
+    async def flush_data(self, offset):
+        self.flushed_offset = offset
+        self.lake[self.path_name] = b"".join(self.appended)
+
+    async def set_metadata(self, metadata):
+        self.metadata = metadata
+
+    async def rename_file(self, new_name: str):
+        file_system_name, _, path_name = new_name.partition("/")
+        assert file_system_name == self.file_system_name
+        self.lake[path_name] = self.lake.pop(self.path_name)
+        return MockFileClient(path_name.removeprefix("OID_X/"), self.lake)
+
+
+@pytest.mark.asyncio
+async def test_receive_file_in_blocks():
+    content = os.urandom(10000)
+    file_clients = []
+
+    async def get_file_client(filename: str):
+        file_clients.append(MockFileClient(filename))
+        return file_clients[0]
+
+    received = await receive_file(
+        chunks(make_body(content, "../b.pdf"), 700),
+        BOUNDARY,
+        "file",
+        get_file_client,
+        metadata={"UploadedBy": "OID_X"},
+        block_size=1024,
+    )
+
+    assert received is not None
+    file_client = file_clients[0]
+    assert len(file_clients) == 1
+    assert b"".join(file_client.appended) == content
+    # Blocks are sent as soon as they are full, so the upload never holds much more than one in memory
+    assert all(len(block) < 1024 + 700 for block in file_client.appended)
+    assert file_client.flushed_offset == len(content)
+    assert received.content_hash == hashlib.sha256(content).hexdigest()
+    assert file_client.metadata == {"UploadedBy": "OID_X", "ContentHash": received.content_hash}
+    assert received.filename == "b.pdf"
+    # The file is written to a partial file, which is renamed once it's complete
+    assert file_client.path_name.startswith("OID_X/b.pdf.") and file_client.path_name.endswith(".partial")
+    assert file_client.lake == {"OID_X/b.pdf": content}
+    assert received.url == "https://test.dfs.core.windows.net/user-content/OID_X/b.pdf"
+    assert received.size == len(content)
+    with open(received.path, "rb") as local_file:
+        assert local_file.read() == content
+
+    received.remove()
+    assert not os.path.exists(received.path)
+
+
+@pytest.mark.asyncio
+async def test_receive_file_without_file():
+    async def get_file_client(filename: str):
+        raise AssertionError("No file should be created")
+
+    body = make_body(b"foo").replace(b'name="file"', b'name="other"')
+    assert await receive_file(chunks(body, 64), BOUNDARY, "file", get_file_client, metadata={}) is None
+
+
+@pytest.mark.asyncio
+async def test_receive_file_windows_path():
+    file_clients = []
+
+    async def get_file_client(filename: str):
+        file_clients.append(MockFileClient(filename))
+        return file_clients[0]
+
+    body = make_body(b"foo", "C:\\Users\\me\\b.pdf")
+    received = await receive_file(chunks(body, 64), BOUNDARY, "file", get_file_client, metadata={})
+
+    assert received is not None
+    assert received.filename == "b.pdf"
+    received.remove()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("filename", ["", "folder/", "folder\\"])
+async def test_receive_file_without_filename(filename):
+    async def get_file_client(filename: str):
+        raise AssertionError("No file should be created")
+
+    body = make_body(b"foo", filename)
+    assert await receive_file(chunks(body, 64), BOUNDARY, "file", get_file_client, metadata={}) is None
+
+
+@pytest.mark.asyncio
+async def test_receive_file_interrupted():
+    # The user uploaded the file before
+    lake = {"OID_X/a.txt": b"earlier upload"}
+    file_clients = []
+
+    async def get_file_client(filename: str):
+        file_clients.append(MockFileClient(filename, lake))
+        return file_clients[0]
+
+    async def interrupted_body():
+        body = make_body(os.urandom(10000))
+        yield body[:5000]
+        raise ConnectionError("Client disconnected")
+
+    with pytest.raises(ConnectionError):
+        await receive_file(interrupted_body(), BOUNDARY, "file", get_file_client, metadata={}, block_size=1024)
+
+    # The partial file, created before the content arrived, is deleted along with the local copy,
+    # and the earlier upload is untouched
+    assert len(file_clients) == 1
+    assert lake == {"OID_X/a.txt": b"earlier upload"}
+
+
+@pytest.mark.asyncio
+async def test_receive_file_truncated():
+    lake = {"OID_X/a.txt": b"earlier upload"}
+    file_clients = []
+
+    async def get_file_client(filename: str):
+        file_clients.append(MockFileClient(filename, lake))
+        return file_clients[0]
+
+    body = make_body(os.urandom(10000))[:5000]
+    assert await receive_file(chunks(body, 700), BOUNDARY, "file", get_file_client, metadata={}) is None
+    assert lake == {"OID_X/a.txt": b"earlier upload"}
+
+
+def test_partial_file_name():
+    assert is_partial_file(partial_file_name("a.txt"))
+    assert not is_partial_file("a.txt")
+    assert not is_partial_file("notes.partial")